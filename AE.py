@@ -1,4 +1,4 @@
-import utils, torch, time, os, pickle
+import utils, torch, time, os
 from scipy.misc import imsave
 import numpy as np
 import torch.nn as nn
@@ -235,6 +235,7 @@ class AutoEncoder(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.model_name = args.gan_type
 
 
@@ -257,6 +258,8 @@ class AutoEncoder(object):
 		self.D = Encoder('D', self.Nd, self.Np, self.Ni)
 		self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G': self.G, 'D': self.D}, {'G': self.G_optimizer, 'D': self.D_optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.G.cuda()
@@ -287,17 +290,18 @@ class AutoEncoder(object):
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'MultiPie' or self.dataset == 'miniPie':
-			self.data_loader = DataLoader( utils.MultiPie(data_dir,
-				transform=transforms.Compose(
+			self.data_loader = utils.multipie_loader( data_dir, transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]),
-				cam_ids=[51]),
-				batch_size=self.batch_size, shuffle=True) 
+				self.batch_size, args.num_workers, cam_ids=[51], fname_image_store=args.fname_image_store,
+				stream=args.stream, buffer_size=args.shuffle_buffer )
 		elif self.dataset == 'CASIA-WebFace':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 
 		# fixed noise, all poses, all illums
 		for iB, (sample_x_,sample_y_) in enumerate(self.data_loader):
@@ -348,7 +352,7 @@ class AutoEncoder(object):
 		#	self.sample_z_illum_ = Variable(self.sample_z_illum_, volatile=True)
 
 	def train(self):
-		self.train_hist = {}
+		self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 		#self.train_hist['D_loss'] = []
 		self.train_hist['G_loss'] = []
 		self.train_hist['per_epoch_time'] = []
@@ -406,7 +410,7 @@ class AutoEncoder(object):
 				#D_fake_loss = self.CE_loss(D_fake, self.y_fake_)
 
 				#D_loss = D_real_loss_id + D_real_loss_pose + D_real_loss_illum + D_fake_loss
-				#self.train_hist['D_loss'].append(D_loss.data[0])
+				#self.train_hist['D_loss'].append(D_loss.data)
 
 				#D_loss.backward()
 				#self.D_optimizer.step()
@@ -424,7 +428,7 @@ class AutoEncoder(object):
 					#D_fake_loss_illum = self.CE_loss(D_fake_illum, y_illum_)
 					#G_loss = D_fake_loss_id + D_fake_loss_pose + D_fake_loss_illum
 					if iG == 0:
-						self.train_hist['G_loss'].append(G_loss.data[0])
+						self.train_hist['G_loss'].append(G_loss.data)
 	
 					G_loss.backward()
 					self.G_optimizer.step()
@@ -444,6 +448,7 @@ class AutoEncoder(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name,
 								 self.epoch)
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
@@ -479,19 +484,7 @@ class AutoEncoder(object):
 						  self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name + '_epoch%03d' % epoch + '.png')
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
+		self.checkpointer.load()
@@ -6,7 +6,7 @@ from torch.autograd import Variable, grad
 from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 
-import utils, torch, time, os, pickle, imageio, math
+import utils, torch, time, os, imageio, math
 from utils import Flatten, Inflate
 import pdb
 
@@ -139,6 +139,7 @@ class AutoEncoder3D(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.num_workers = args.num_workers
 		self.model_name = args.gan_type
 		self.use_GP = args.use_GP
@@ -182,7 +183,8 @@ class AutoEncoder3D(object):
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'MultiPie' or self.dataset == 'miniPie':
 			self.data_loader = DataLoader( utils.MultiPie(data_dir,
 					transform=transforms.Compose(
@@ -191,9 +193,11 @@ class AutoEncoder3D(object):
 		elif self.dataset == 'CASIA-WebFace':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'Bosphorus':
 			self.data_loader = DataLoader( utils.Bosphorus(data_dir, skipCodes=['YR','PR','CR'],
+											fname_store=args.fname_store,
 											transform=transforms.ToTensor(),
 											shape=128, image_shape=256),
 											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
@@ -222,6 +226,8 @@ class AutoEncoder3D(object):
 		self.AE = AE3D()
 		
 		self.optimizer = optim.Adam(self.AE.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'AE': self.AE}, {'AE': self.optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.AE.cuda()
@@ -245,7 +251,7 @@ class AutoEncoder3D(object):
 
 	def train(self):
 		if not hasattr(self, 'train_hist') :
-			self.train_hist = {}
+			self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 			self.train_hist['recon_loss'] = []
 
 			self.train_hist['per_epoch_time'] = []
@@ -283,7 +289,7 @@ class AutoEncoder3D(object):
 				loss_recon.backward()
 				self.optimizer.step()
 
-				self.train_hist['recon_loss'].append(loss_recon.data[0])
+				self.train_hist['recon_loss'].append(loss_recon.data)
 
 				if ((iB + 1) % 10) == 0:
 					secs = time.time()-start_time_epoch
@@ -305,6 +311,7 @@ class AutoEncoder3D(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name,
 								 self.epoch)
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
@@ -330,29 +337,14 @@ class AutoEncoder3D(object):
 		recon.dump(fname)
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.AE.state_dict(), os.path.join(save_dir, self.model_name + '_AE.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-		print( 'loading from {}...'.format(save_dir) )
-
-		self.AE.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_AE.pkl')))
-
-		try:
-			fhandle = open(os.path.join(save_dir, self.model_name + '_history.pkl'))
-			self.train_hist = pickle.load(fhandle)
-			fhandle.close()
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-		except:
+		state = self.checkpointer.load()
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
 
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
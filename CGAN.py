@@ -1,4 +1,4 @@
-import utils, torch, time, os, pickle
+import utils, torch, time, os
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
@@ -86,6 +86,8 @@ class CGAN(object):
         self.dataset = args.dataset
         self.log_dir = args.log_dir
         self.gpu_mode = args.gpu_mode
+        self.flush_metrics = args.flush_metrics
+        self.fuse_step = args.fuse_step
         self.model_name = args.gan_type
 
         # networks init
@@ -93,6 +95,9 @@ class CGAN(object):
         self.D = discriminator(self.dataset)
         self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
         self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+        self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+                                                {'G': self.G, 'D': self.D},
+                                                {'G': self.G_optimizer, 'D': self.D_optimizer}, args.keep_last, args.keep_every )
 
         if self.gpu_mode:
             self.G.cuda()
@@ -134,7 +139,7 @@ class CGAN(object):
             self.sample_z_, self.sample_y_ = Variable(self.sample_z_, volatile=True), Variable(self.sample_y_, volatile=True)
 
     def train(self):
-        self.train_hist = {}
+        self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
         self.train_hist['D_loss'] = []
         self.train_hist['G_loss'] = []
         self.train_hist['per_epoch_time'] = []
@@ -174,11 +179,13 @@ class CGAN(object):
                 D_real_loss = self.BCE_loss(D_real, self.y_real_)
 
                 G_ = self.G(z_, y_vec_)
+                if self.fuse_step:
+                    G_fused, G_ = G_, G_.detach()
                 D_fake = self.D(G_, y_fill_)
                 D_fake_loss = self.BCE_loss(D_fake, self.y_fake_)
 
                 D_loss = D_real_loss + D_fake_loss
-                self.train_hist['D_loss'].append(D_loss.data[0])
+                self.train_hist['D_loss'].append(D_loss.data)
 
                 D_loss.backward()
                 self.D_optimizer.step()
@@ -186,10 +193,13 @@ class CGAN(object):
                 # update G network
                 self.G_optimizer.zero_grad()
 
-                G_ = self.G(z_, y_vec_)
+                if self.fuse_step:
+                    G_ = G_fused
+                else:
+                    G_ = self.G(z_, y_vec_)
                 D_fake = self.D(G_, y_fill_)
                 G_loss = self.BCE_loss(D_fake, self.y_real_)
-                self.train_hist['G_loss'].append(G_loss.data[0])
+                self.train_hist['G_loss'].append(G_loss.data)
 
                 G_loss.backward()
                 self.G_optimizer.step()
@@ -207,6 +217,7 @@ class CGAN(object):
         print("Training finish!... save training results")
 
         self.save()
+        self.checkpointer.wait()
         utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name,
                                  self.epoch)
         utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
@@ -246,19 +257,7 @@ class CGAN(object):
                           self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name + '_epoch%03d' % epoch + '.png')
 
     def save(self):
-        save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-
-        torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-        torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-        with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-            pickle.dump(self.train_hist, f)
+        self.checkpointer.save( self.train_hist )
 
     def load(self):
-        save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-        self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-        self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
+        self.checkpointer.load()
@@ -1,4 +1,4 @@
-import utils, torch, time, os, pickle
+import utils, torch, time, os
 from scipy.misc import imsave
 import numpy as np
 import torch.nn as nn
@@ -200,6 +200,7 @@ class DRGAN(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.model_name = args.gan_type
 		if len(args.comment) > 0:
 			self.model_name = self.model_name + '_' + args.comment
@@ -222,6 +223,8 @@ class DRGAN(object):
 		self.D = Encoder('D', self.Nd, self.Np, self.Ni)
 		self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G': self.G, 'D': self.D}, {'G': self.G_optimizer, 'D': self.D_optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.G.cuda()
@@ -254,16 +257,18 @@ class DRGAN(object):
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'MultiPie' or self.dataset == 'miniPie':
-			self.data_loader = DataLoader( utils.MultiPie(data_dir,
-					transform=transforms.Compose(
-					[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()])),
-				batch_size=self.batch_size, shuffle=True) 
+			self.data_loader = utils.multipie_loader( data_dir, transforms.Compose(
+					[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]),
+					self.batch_size, args.num_workers, fname_image_store=args.fname_image_store,
+					stream=args.stream, buffer_size=args.shuffle_buffer )
 		elif self.dataset == 'CASIA-WebFace':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		# fixed samples for reconstruction visualization
 		nSamples = self.Np*self.Ni
 		sample_x_s = []
@@ -295,7 +300,7 @@ class DRGAN(object):
 			self.sample_illum_ = Variable(self.sample_illum_, volatile=True)
 
 	def train(self):
-		self.train_hist = {}
+		self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 		self.train_hist['D_loss'] = []
 		self.train_hist['D_loss_GAN_real'] = []
 		self.train_hist['D_loss_id'] = []
@@ -386,12 +391,12 @@ class DRGAN(object):
 				gradient_penalty = self.lambda_ * ((gradients.view(gradients.size(0),-1).norm(2,1)-1)**2).mean()
 
 				D_loss = D_loss_GANreal + D_loss_real_id + D_loss_real_pose + D_loss_real_illum + D_loss_GANfake + gradient_penalty
-				self.train_hist['D_loss'].append(D_loss.data[0])
-				self.train_hist['D_loss_GAN_real'].append(D_loss_GANreal.data[0])
-				self.train_hist['D_loss_id'].append(D_loss_real_id.data[0])
-				self.train_hist['D_loss_pose'].append(D_loss_real_pose.data[0])
-				self.train_hist['D_loss_illum'].append(D_loss_real_illum.data[0])
-				self.train_hist['D_loss_GAN_fake'].append(D_loss_GANfake.data[0])
+				self.train_hist['D_loss'].append(D_loss.data)
+				self.train_hist['D_loss_GAN_real'].append(D_loss_GANreal.data)
+				self.train_hist['D_loss_id'].append(D_loss_real_id.data)
+				self.train_hist['D_loss_pose'].append(D_loss_real_pose.data)
+				self.train_hist['D_loss_illum'].append(D_loss_real_illum.data)
+				self.train_hist['D_loss_GAN_fake'].append(D_loss_GANfake.data)
 
 				D_loss.backward()
 				self.D_optimizer.step()
@@ -408,11 +413,11 @@ class DRGAN(object):
 					G_loss_illum = self.CE_loss(D_fake_illum, y_illum_)
 					G_loss = G_loss_GANfake + G_loss_id + G_loss_pose + G_loss_illum
 					if iG == 0:
-						self.train_hist['G_loss'].append(G_loss.data[0])
-						self.train_hist['G_loss_GAN_fake'].append(G_loss_GANfake.data[0])
-						self.train_hist['G_loss_id'].append(G_loss_id.data[0])
-						self.train_hist['G_loss_pose'].append(G_loss_pose.data[0])
-						self.train_hist['G_loss_illum'].append(G_loss_illum.data[0])
+						self.train_hist['G_loss'].append(G_loss.data)
+						self.train_hist['G_loss_GAN_fake'].append(G_loss_GANfake.data)
+						self.train_hist['G_loss_id'].append(G_loss_id.data)
+						self.train_hist['G_loss_pose'].append(G_loss_pose.data)
+						self.train_hist['G_loss_illum'].append(G_loss_illum.data)
 	
 					G_loss.backward()
 					self.G_optimizer.step()
@@ -439,6 +444,7 @@ class DRGAN(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name,
 								 self.epoch)
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
@@ -479,19 +485,7 @@ class DRGAN(object):
 						  self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name + '_epoch%03d' % epoch + '.png')
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
+		self.checkpointer.load()
@@ -153,7 +153,12 @@ class DRGAN3D(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.num_workers = args.num_workers
+		self.prefetch = args.prefetch
+		self.save_every = args.save_every
+		self.augment_voxel = utils.VoxelAugmenter( [op for op in args.augment_voxel.split(',') if len(op) > 0],
+								args.augment_shift, args.augment_angle, args.augment_color, gpu_mode=self.gpu_mode )
 		self.model_name = args.gan_type
 		self.centerBosphorus = args.centerBosphorus
 		self.loss_option = args.loss_option
@@ -165,6 +170,10 @@ class DRGAN3D(object):
 		self.lambda_ = 0.25
 		self.n_critic = args.n_critic
 		self.n_gen = args.n_gen
+		self.fuse_step = args.fuse_step
+		if self.fuse_step:
+			print('[warning] --fuse_step trains D on fakes of y_pcode_, the pose codes the G step uses, instead of random pose codes.')
+			print('[warning] D never sees random pose samples, which changes the training objective of {}.'.format(args.gan_type))
 		self.c = 0.01 # for wgan
 		self.nDaccAvg = args.nDaccAvg
 		if 'wass' in self.loss_option:
@@ -203,7 +212,8 @@ class DRGAN3D(object):
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'MultiPie' or self.dataset == 'miniPie':
 			self.data_loader = DataLoader( utils.MultiPie(data_dir,
 					transform=transforms.Compose(
@@ -216,7 +226,8 @@ class DRGAN3D(object):
 		elif self.dataset == 'CASIA-WebFace':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 			self.Nd = 10885 
 			self.Np = 13
 			self.Ni = 20
@@ -237,11 +248,18 @@ class DRGAN3D(object):
 #							]
 			inclCodes = []
 
-			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, fname_cache=args.fname_cache,
-											transform=transforms.ToTensor(),
-											shape=128, image_shape=256, center=self.centerBosphorus,
-											inclCodes=inclCodes),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+			if len(args.dir_shards) > 0:
+				self.data_loader = utils.bosphorus_shard_loader( args.dir_shards, self.batch_size, self.num_workers, args.shuffle_buffer,
+													shape=128, image_shape=256, center=self.centerBosphorus,
+													sparse=args.sparse_voxel, compact=args.compact_voxel, stream=args.stream )
+			else:
+				self.data_loader = utils.resumable_loader( utils.Bosphorus(data_dir, use_image=True, fname_cache=args.fname_cache, fname_store=args.fname_store,
+												fname_image_store=args.fname_image_store,
+												transform=transforms.ToTensor(),
+												shape=128, image_shape=256, center=self.centerBosphorus,
+												inclCodes=inclCodes, sparse=args.sparse_voxel, compact=args.compact_voxel),
+												batch_size=self.batch_size, num_workers=self.num_workers,
+												collate_fn=utils.collate_voxel)
 			self.Nid = 105
 			self.Npcode = len(self.data_loader.dataset.posecodemap)
 			self.Nz = 50
@@ -251,6 +269,10 @@ class DRGAN3D(object):
 		self.D = discriminator(self.Nid, self.Npcode)
 		self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.D_gate = utils.UpdateGate( 0.8, self.nDaccAvg, self.flush_metrics )
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G': self.G, 'D': self.D}, {'G': self.G_optimizer, 'D': self.D_optimizer}, args.keep_last, args.keep_every,
+						states={'D_gate': self.D_gate} )
 
 		if hasattr(args, 'comment1'):
 			return
@@ -266,6 +288,7 @@ class DRGAN3D(object):
 			sample_x2D_s = []
 			sample_x3D_s = []
 			for iB, (sample_x3D_,sample_y_,sample_x2D_) in enumerate(self.data_loader):
+				sample_x3D_ = utils.voxel_to_float( utils.densify_voxel( sample_x3D_ ) )
 				sample_x2D_s.append( sample_x2D_ )
 				sample_x3D_s.append( sample_x3D_ )
 				if iB > nSamples // self.batch_size:
@@ -359,6 +382,8 @@ class DRGAN3D(object):
                            'G_loss_id',
                            'G_loss_pcode',
                            'per_epoch_time',
+                           'data_wait_time',
+                           'D_skip_rate',
                            'total_time']
 		if 'recon' in self.loss_option:
 			train_hist_keys.append('G_loss_recon')
@@ -368,7 +393,7 @@ class DRGAN3D(object):
 		if not hasattr(self, 'epoch_start'):
 			self.epoch_start = 0
 		if not hasattr(self, 'train_hist') :
-			self.train_hist = {}
+			self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 			for key in train_hist_keys:
 				self.train_hist[key] = []
 		else:
@@ -387,143 +412,148 @@ class DRGAN3D(object):
 			self.y_real_ = Variable((torch.ones(self.batch_size,1)))
 			self.y_fake_ = Variable((torch.zeros(self.batch_size,1)))
 
-		nPairs = self.batch_size*(self.batch_size-1)
-		normalizerA = self.data_loader.dataset.muA/self.data_loader.dataset.stddevA # normalization
-		normalizerB = self.data_loader.dataset.muB/self.data_loader.dataset.stddevB # normalization
-		eps = 1e-16
+		if 'dist' in self.loss_option:
+			dist_loss = utils.PairwiseDistanceLoss( self.data_loader.dataset )
 
 		self.D.train()
 		start_time = time.time()
 		print('training start from epoch {}!!'.format(self.epoch_start+1))
+		self.prepare_batch = utils.BatchPreparer( self.batch_size, self.Npcode, self.Nz, self.gpu_mode )
+		prefetcher = utils.Prefetcher( self.data_loader, self.prefetch, self.gpu_mode )
+		data_position = utils.data_position( self.data_loader )
 		for epoch in range(self.epoch_start, self.epoch):
 			self.G.train()
 			epoch_start_time = time.time()
 			start_time_epoch = time.time()
-
-			for iB, (x3D_, y_, x2D_ ) in enumerate(self.data_loader):
+			data_position.set_epoch( epoch )
+			iB_start = data_position.position // self.batch_size
+			if iB_start == 0:
+				self.D_gate.reset_counts()
+			for iB, (x3D_, y_, x2D_ ) in enumerate(prefetcher, iB_start):
 				if iB == self.data_loader.dataset.__len__() // self.batch_size:
 					break
+				data_position.position = iB*self.batch_size
+				if self.save_every > 0 and iB > iB_start and iB % self.save_every == 0:
+					self.save()
+				x3D_ = utils.densify_voxel( x3D_ )
+				x3D_, x2D_ = self.augment_voxel( x3D_, x2D_ )
 
-				z_ = torch.rand((self.batch_size, self.Nz))
-				y_random_pcode_ = torch.floor(torch.rand(self.batch_size)*self.Npcode).long()
-				y_random_pcode_onehot_ = torch.zeros( self.batch_size, self.Npcode )
-				y_random_pcode_onehot_.scatter_(1, y_random_pcode_.view(-1,1), 1)
-				y_id_ = y_['id']
-				y_pcode_ = y_['pcode']
-				y_pcode_onehot_ = torch.zeros( self.batch_size, self.Npcode )
-				y_pcode_onehot_.scatter_(1, y_pcode_.view(-1,1), 1)
+				y_id_, y_pcode_, y_pcode_onehot_, y_random_pcode_, y_random_pcode_onehot_, z_ = self.prepare_batch( y_ )
 
 				if self.gpu_mode:
-					x2D_, z_ = Variable(x2D_.cuda()), Variable(z_.cuda())
-					x3D_ = Variable(x3D_.cuda())
-					y_id_ = Variable( y_id_.cuda() )
-					y_pcode_ = Variable(y_pcode_.cuda())
-					y_pcode_onehot_ = Variable( y_pcode_onehot_.cuda() )
-					y_random_pcode_ = Variable(y_random_pcode_.cuda())
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_.cuda() )
+					x2D_ = Variable(x2D_.cuda())
+					x3D_ = Variable(utils.voxel_to_float(x3D_.cuda()))
 				else:
-					x2D_, z_ = Variable(x2D_), Variable(z_)
-					x3D_ = Variable(x3D_)
-					y_id_ = Variable(y_id_)
-					y_pcode_ = Variable(y_pcode_)
-					y_pcode_onehot_ = Variable( y_pcode_onehot_ )
-					y_random_pcode_ = Variable(y_random_pcode_)
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_ )
+					x2D_ = Variable(x2D_)
+					x3D_ = Variable(utils.voxel_to_float(x3D_))
+
+				if self.fuse_step:
+					# conditioned on y_pcode_ as the generator step needs, so D sees no random pose codes in fuse_step mode
+					x3D_hat_fused = self.G(x2D_, y_pcode_onehot_, z_)
 
 				# update D network
 				for iD in range(self.n_critic) :
+					# decided before the forward pass, a closed gate only measures D_acc
+					train_D = self.D_gate.is_open()
 					self.D_optimizer.zero_grad()
+					with utils.set_grad_enabled( train_D ):
 	
-					D_GAN_real, D_id, D_pcode = self.D(x3D_)
-					if 'wass' in self.loss_option:
-						D_loss_GANreal = -torch.mean(D_GAN_real)
-					else:
-						D_loss_GANreal = self.BCE_loss(D_GAN_real, self.y_real_)
-					D_loss_real_id = self.CE_loss(D_id, y_id_)
-					D_loss_real_pcode = self.CE_loss(D_pcode, y_pcode_)
+						D_GAN_real, D_id, D_pcode = self.D(x3D_)
+						if 'wass' in self.loss_option:
+							D_loss_GANreal = -torch.mean(D_GAN_real)
+						else:
+							D_loss_GANreal = self.BCE_loss(D_GAN_real, self.y_real_)
+						D_loss_real_id = self.CE_loss(D_id, y_id_)
+						D_loss_real_pcode = self.CE_loss(D_pcode, y_pcode_)
 	
-					x3D_hat = self.G(x2D_, y_random_pcode_onehot_, z_)
-					D_GAN_fake, _, _ = self.D(x3D_hat)
-					if 'wass' in self.loss_option:
-						D_loss_GANfake = torch.mean(D_GAN_fake)
-					else:
-						D_loss_GANfake = self.BCE_loss(D_GAN_fake, self.y_fake_)
+						if self.fuse_step:
+							x3D_hat = x3D_hat_fused.detach()
+						else:
+							x3D_hat = self.G(x2D_, y_random_pcode_onehot_, z_)
+						D_GAN_fake, _, _ = self.D(x3D_hat)
+						if 'wass' in self.loss_option:
+							D_loss_GANfake = torch.mean(D_GAN_fake)
+						else:
+							D_loss_GANfake = self.BCE_loss(D_GAN_fake, self.y_fake_)
 	
-					num_correct_real = torch.sum(D_GAN_real>0.5)
-					num_correct_fake = torch.sum(D_GAN_fake<0.5)
-					D_acc = float(num_correct_real.data[0] + num_correct_fake.data[0]) / (self.batch_size*2)
+						num_correct_real = torch.sum(D_GAN_real>0.5)
+						num_correct_fake = torch.sum(D_GAN_fake<0.5)
+						D_acc = (num_correct_real.float() + num_correct_fake.float()) / (self.batch_size*2)
 	
-					if 'GP' in self.loss_option:
-						if 'wass' in self.loss_option:
-							# gradient penalty from WGAN_GP.py
-							if self.gpu_mode:
-								alpha = torch.rand(x3D_.size()).cuda()
-							else:
-								alpha = torch.rand(x3D_.size())
+						if 'GP' in self.loss_option and train_D:
+							if 'wass' in self.loss_option:
+								# gradient penalty from WGAN_GP.py
+								if self.gpu_mode:
+									alpha = torch.rand(x3D_.size()).cuda()
+								else:
+									alpha = torch.rand(x3D_.size())
 			
-							x_hat = Variable(alpha * x3D_.data + (1 - alpha) * x3D_hat.data, requires_grad=True)
+								x_hat = Variable(alpha * x3D_.data + (1 - alpha) * x3D_hat.data, requires_grad=True)
 			
-							pred_hat, _, _ = self.D(x_hat)
-							if self.gpu_mode:
-								gradients = grad(outputs=pred_hat, inputs=x_hat, grad_outputs=torch.ones(pred_hat.size()).cuda(),
-											 create_graph=True, retain_graph=True, only_inputs=True)[0]
-							else:
-								gradients = grad(outputs=pred_hat, inputs=x_hat, grad_outputs=torch.ones(pred_hat.size()),
+								pred_hat, _, _ = self.D(x_hat)
+								if self.gpu_mode:
+									gradients = grad(outputs=pred_hat, inputs=x_hat, grad_outputs=torch.ones(pred_hat.size()).cuda(),
 												 create_graph=True, retain_graph=True, only_inputs=True)[0]
+								else:
+									gradients = grad(outputs=pred_hat, inputs=x_hat, grad_outputs=torch.ones(pred_hat.size()),
+													 create_graph=True, retain_graph=True, only_inputs=True)[0]
 			
-							gradient_penalty = self.lambda_ * ((gradients.view(gradients.size()[0], -1).norm(2, 1) - 1) ** 2).mean()
+								gradient_penalty = self.lambda_ * ((gradients.view(gradients.size()[0], -1).norm(2, 1) - 1) ** 2).mean()
 
 
-						else:
-							# DRAGAN Loss (Gradient penalty)
-							if self.gpu_mode:
-								alpha = torch.rand(x2D_.size()).cuda()
-								x2D_hat = Variable(alpha*x2D_.data +
-													(1-alpha)*(x2D_.data+0.5*x2D_.data.std()*torch.rand(x2D_.size()).cuda()),
-													requires_grad=True)
-							else:
-								alpha = torch.rand(x2D_.size())
-								x2D_hat = Variable(alpha*x2D_.data +
-													(1-alpha)*(x2D_.data+0.5*x2D_.data.std()*torch.rand(x2D_.size())),
-													requires_grad=True)
-							pred_hat,_,_,_ = self.D(x2D_hat)
-							if self.gpu_mode:
-								gradients = grad(outputs=pred_hat, inputs=x2D_hat, grad_outputs=torch.ones(pred_hat.size()).cuda(),
-													create_graph=True, retain_graph=True, only_inputs=True)[0]
 							else:
-								gradients = grad(outputs=pred_hat, inputs=x2D_hat, grad_outputs=torch.ones(pred_hat.size()),
-													create_graph=True, retain_graph=True, only_inputs=True)[0]
+								# DRAGAN Loss (Gradient penalty)
+								if self.gpu_mode:
+									alpha = torch.rand(x2D_.size()).cuda()
+									x2D_hat = Variable(alpha*x2D_.data +
+														(1-alpha)*(x2D_.data+0.5*x2D_.data.std()*torch.rand(x2D_.size()).cuda()),
+														requires_grad=True)
+								else:
+									alpha = torch.rand(x2D_.size())
+									x2D_hat = Variable(alpha*x2D_.data +
+														(1-alpha)*(x2D_.data+0.5*x2D_.data.std()*torch.rand(x2D_.size())),
+														requires_grad=True)
+								pred_hat,_,_,_ = self.D(x2D_hat)
+								if self.gpu_mode:
+									gradients = grad(outputs=pred_hat, inputs=x2D_hat, grad_outputs=torch.ones(pred_hat.size()).cuda(),
+														create_graph=True, retain_graph=True, only_inputs=True)[0]
+								else:
+									gradients = grad(outputs=pred_hat, inputs=x2D_hat, grad_outputs=torch.ones(pred_hat.size()),
+														create_graph=True, retain_graph=True, only_inputs=True)[0]
 			
-							gradient_penalty = self.lambda_ * ((gradients.view(gradients.size(0),-1).norm(2,1)-1)**2).mean()
+								gradient_penalty = self.lambda_ * ((gradients.view(gradients.size(0),-1).norm(2,1)-1)**2).mean()
 		
-						D_loss = D_loss_GANreal + D_loss_real_id + D_loss_real_pcode + D_loss_GANfake + gradient_penalty
-					else:
-						D_loss = D_loss_GANreal + D_loss_real_id + D_loss_real_pcode + D_loss_GANfake
+							D_loss = D_loss_GANreal + D_loss_real_id + D_loss_real_pcode + D_loss_GANfake + gradient_penalty
+						else:
+							D_loss = D_loss_GANreal + D_loss_real_id + D_loss_real_pcode + D_loss_GANfake
 
 					if iD == 0:	
-						self.train_hist['D_loss'].append(D_loss.data[0])
-						self.train_hist['D_loss_GAN_real'].append(D_loss_GANreal.data[0])
-						self.train_hist['D_loss_id'].append(D_loss_real_id.data[0])
-						self.train_hist['D_loss_pcode'].append(D_loss_real_pcode.data[0])
-						self.train_hist['D_loss_GAN_fake'].append(D_loss_GANfake.data[0])
-						self.train_hist['D_acc'].append(D_acc)
+						self.train_hist['D_loss'].append(D_loss.data)
+						self.train_hist['D_loss_GAN_real'].append(D_loss_GANreal.data)
+						self.train_hist['D_loss_id'].append(D_loss_real_id.data)
+						self.train_hist['D_loss_pcode'].append(D_loss_real_pcode.data)
+						self.train_hist['D_loss_GAN_fake'].append(D_loss_GANfake.data)
+						self.train_hist['D_acc'].append(D_acc.data)
 	
-					divisor = min( len(self.train_hist['D_acc']), self.nDaccAvg )
-					D_acc_avg = sum( self.train_hist['D_acc'][-self.nDaccAvg:] )/divisor
-					D_loss.backward()
-					if D_acc_avg < 0.8:
+					self.D_gate.update( D_acc.data, train_D )
+					D_acc_avg = self.D_gate.average()
+					if train_D:
+						D_loss.backward()
 						self.D_optimizer.step()
 
-					if 'wass' in self.loss_option and 'GP' not in self.loss_option:
-						for p in self.D.parameters():
-							p.data.clamp_(-self.c, self.c)
+						if 'wass' in self.loss_option and 'GP' not in self.loss_option:
+							for p in self.D.parameters():
+								p.data.clamp_(-self.c, self.c)
 
 	
 				# update G network
 				for iG in range( self.n_gen ):
 					self.G_optimizer.zero_grad()
 		
-					x3D_hat = self.G(x2D_, y_pcode_onehot_, z_)
+					if self.fuse_step and iG == 0:
+						x3D_hat = x3D_hat_fused
+					else:
+						x3D_hat = self.G(x2D_, y_pcode_onehot_, z_)
 					D_fake_GAN, D_fake_id, D_fake_pcode = self.D(x3D_hat)
 					G_loss_GANfake = self.BCE_loss(D_fake_GAN, self.y_real_)
 					G_loss_id = self.CE_loss(D_fake_id, y_id_)
@@ -538,34 +568,19 @@ class DRGAN3D(object):
 						G_loss += G_loss_recon
 	
 					if 'dist' in self.loss_option:
-						sumA = 0
-						sumB = 0
-						for iA in range(self.batch_size):
-							dist_2D = x2D_[iA]-x2D_ + eps
-							dist_3D = x3D_hat[iA]-x3D_hat + eps
-							normdist_2D = torch.norm(dist_2D.view(self.batch_size,-1),1, dim=1)
-							normdist_3D = torch.norm(dist_3D.view(self.batch_size,-1),1, dim=1)
-							sumA += normdist_2D
-							sumB += normdist_3D
-		
-						sumA /= self.data_loader.dataset.stddevA # normalization
-						sumB /= self.data_loader.dataset.stddevB # normalization
-						sumA /= nPairs # expectation
-						sumB /= nPairs # expectation
-		
-						G_loss_distance = torch.abs( torch.sum( sumA - sumB - normalizerA + normalizerB )) / self.batch_size
+						G_loss_distance = dist_loss( x2D_, x3D_hat )
 						G_loss += G_loss_distance
 	
 	
 					if iG == 0:
-						self.train_hist['G_loss'].append(G_loss.data[0])
-						self.train_hist['G_loss_GAN_fake'].append(G_loss_GANfake.data[0])
-						self.train_hist['G_loss_id'].append(G_loss_id.data[0])
-						self.train_hist['G_loss_pcode'].append(G_loss_pcode.data[0])
+						self.train_hist['G_loss'].append(G_loss.data)
+						self.train_hist['G_loss_GAN_fake'].append(G_loss_GANfake.data)
+						self.train_hist['G_loss_id'].append(G_loss_id.data)
+						self.train_hist['G_loss_pcode'].append(G_loss_pcode.data)
 						if 'recon' in self.loss_option or 'reconL1' in self.loss_option:
-							self.train_hist['G_loss_recon'].append(G_loss_recon.data[0])
+							self.train_hist['G_loss_recon'].append(G_loss_recon.data)
 						if 'dist' in self.loss_option:
-							self.train_hist['G_loss_dist'].append(G_loss_distance.data[0])
+							self.train_hist['G_loss_dist'].append(G_loss_distance.data)
 		
 					G_loss.backward()
 					self.G_optimizer.step()
@@ -588,13 +603,18 @@ class DRGAN3D(object):
 					#print("%2dh%2dm E:[%2d] B:[%4d/%4d] D: %.4f=%.4f+%.4f+%.4f+%.4f,\n\t\t\t G: %.4f=%.4f+%.4f+%.4f" %
 					print("%2dh%2dm E[%2d] B[%d/%d] D: %.4f,G: %.4f, D_acc:%.4f/%.4f" %
 						  (hours,mins, (epoch + 1), (iB + 1), self.data_loader.dataset.__len__() // self.batch_size, 
-						  D_loss.data[0], G_loss.data[0], D_acc, D_acc_avg) )
+						  D_loss.data[0], G_loss.data[0], D_acc.data[0], D_acc_avg) )
 #						  D_loss.data[0], D_loss_GANreal.data[0], D_loss_real_id.data[0],
 #						  D_loss_real_pcode.data[0], D_loss_GANfake.data[0],
 #						  G_loss.data[0], G_loss_GANfake.data[0], G_loss_id.data[0],
 #						  G_loss_pcode.data[0]) )
 
 			self.train_hist['per_epoch_time'].append(time.time() - epoch_start_time)
+			self.train_hist['data_wait_time'].append(prefetcher.wait_time)
+			print('E[%2d] waited %.2f of %.2f sec on data' % ((epoch + 1), prefetcher.wait_time, self.train_hist['per_epoch_time'][-1]))
+			self.train_hist['D_skip_rate'].append(self.D_gate.skip_rate())
+			print('E[%2d] D update skipped in %d of %d critic steps' % ((epoch + 1), self.D_gate.nSkipped, self.D_gate.nSteps))
+			data_position.set_epoch( epoch+1 )
 			self.save()
 			utils.loss_plot(self.train_hist,
 							os.path.join(self.save_dir, self.dataset, self.model_name),
@@ -607,6 +627,7 @@ class DRGAN3D(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.loss_plot(self.train_hist,
 						os.path.join(self.save_dir, self.dataset, self.model_name),
 						self.model_name, use_subplot=True)
@@ -641,7 +662,8 @@ class DRGAN3D(object):
 
 	def get_image_batch(self):
 		dataIter = iter(self.data_loader)
-		return next(dataIter)
+		x3D, y, x2D = next(dataIter)
+		return utils.voxel_to_float(utils.densify_voxel(x3D)), y, x2D
 
 	def visualize_results(self,a=None,b=None):
 		print( 'visualizing result...' )
@@ -707,33 +729,19 @@ class DRGAN3D(object):
 
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist, self.data_loader )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
-
-		try:
-			with open(os.path.join(save_dir, self.model_name + '_history.pkl')) as fhandle:
-				self.train_hist = pickle.load(fhandle)
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-			print( 'history has following keys:' )
-			print( self.train_hist.keys() )
-		except:
+		state = self.checkpointer.load( self.data_loader )
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
+
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
+		print( 'history has following keys:' )
+		print( self.train_hist.keys() )
 
 	def interpolate_z(self, opts):
 		save_dir = os.path.join(self.result_dir, self.dataset, self.model_name, 'interp_z') 
@@ -6,7 +6,7 @@ from torch.autograd import Variable, grad
 from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 
-import utils, torch, time, os, pickle, imageio, math
+import utils, torch, time, os, imageio, math
 from utils import Flatten, Inflate
 import pdb
 
@@ -296,7 +296,9 @@ class DRcycleGAN3D(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.num_workers = args.num_workers
+		self.prefetch = args.prefetch
 		self.model_name = args.gan_type
 		self.loss_option = args.loss_option
 		if len(args.loss_option) > 0:
@@ -339,7 +341,8 @@ class DRcycleGAN3D(object):
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'MultiPie' or self.dataset == 'miniPie':
 			self.data_loader = DataLoader( utils.MultiPie(data_dir,
 					transform=transforms.Compose(
@@ -348,12 +351,18 @@ class DRcycleGAN3D(object):
 		elif self.dataset == 'CASIA-WebFace':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'Bosphorus':
-			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, skipCodes=['YR','PR','CR'],
-											transform=transforms.ToTensor(),
-											shape=128, image_shape=256),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+			if len(args.dir_shards) > 0:
+				self.data_loader = utils.bosphorus_shard_loader( args.dir_shards, self.batch_size, self.num_workers, args.shuffle_buffer,
+													shape=128, image_shape=256, center=True, stream=args.stream )
+			else:
+				self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, skipCodes=['YR','PR','CR'],
+												fname_store=args.fname_store,
+												transform=transforms.ToTensor(),
+												shape=128, image_shape=256),
+												batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
 			self.Nid = 105
 			self.Npcode = len(self.data_loader.dataset.posecodemap)
 
@@ -413,6 +422,9 @@ class DRcycleGAN3D(object):
 		
 		self.G_3Dto2D_optimizer = optim.Adam(self.G_3Dto2D.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_2D_optimizer = optim.Adam(self.D_2D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G_2Dto3D': self.G_2Dto3D, 'G_3Dto2D': self.G_3Dto2D, 'D_2D': self.D_2D, 'D_3D': self.D_3D},
+						{'G_2Dto3D': self.G_2Dto3D_optimizer, 'D_3D': self.D_3D_optimizer, 'G_3Dto2D': self.G_3Dto2D_optimizer, 'D_2D': self.D_2D_optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.G_2Dto3D.cuda()
@@ -438,7 +450,7 @@ class DRcycleGAN3D(object):
 
 
 	def train(self):
-		self.train_hist = {}
+		self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 		self.train_hist['D_3D_loss'] = []
 		self.train_hist['D_3D_loss_GAN_real'] = []
 		self.train_hist['D_3D_loss_id'] = []
@@ -466,6 +478,7 @@ class DRcycleGAN3D(object):
 		self.train_hist['G_2D_loss_pcode'] = []
 
 		self.train_hist['per_epoch_time'] = []
+		self.train_hist['data_wait_time'] = []
 		self.train_hist['total_time'] = []
 
 		if self.gpu_mode:
@@ -480,41 +493,26 @@ class DRcycleGAN3D(object):
 
 		print('training start!!')
 		start_time = time.time()
+		self.prepare_batch = utils.BatchPreparer( self.batch_size, self.Npcode, self.Nz, self.gpu_mode )
+		prefetcher = utils.Prefetcher( self.data_loader, self.prefetch, self.gpu_mode )
 		for epoch in range(self.epoch):
 			self.G_2Dto3D.train()
 			self.G_3Dto2D.train()
 			epoch_start_time = time.time()
 			start_time_epoch = time.time()
 
-			for iB, (x3D_, y_, x2D_ ) in enumerate(self.data_loader):
+			for iB, (x3D_, y_, x2D_ ) in enumerate(prefetcher):
 				if iB == self.data_loader.dataset.__len__() // self.batch_size:
 					break
 
-				z_ = torch.rand((self.batch_size, self.Nz))
-				y_id_ = y_['id']
-				y_pcode_ = y_['pcode']
-				y_pcode_onehot_ = torch.zeros( self.batch_size, self.Npcode )
-				y_pcode_onehot_.scatter_(1, y_pcode_.view(-1,1), 1)
-				y_random_pcode_ = torch.floor(torch.rand(self.batch_size)*self.Npcode).long()
-				y_random_pcode_onehot_ = torch.zeros( self.batch_size, self.Npcode )
-				y_random_pcode_onehot_.scatter_(1, y_random_pcode_.view(-1,1), 1)
+				y_id_, y_pcode_, y_pcode_onehot_, y_random_pcode_, y_random_pcode_onehot_, z_ = self.prepare_batch( y_ )
 
 				if self.gpu_mode:
-					x2D_, z_ = Variable(x2D_.cuda()), Variable(z_.cuda())
+					x2D_ = Variable(x2D_.cuda())
 					x3D_ = Variable(x3D_.cuda())
-					y_id_ = Variable( y_id_.cuda() )
-					y_pcode_ = Variable(y_pcode_.cuda())
-					y_pcode_onehot_ = Variable( y_pcode_onehot_.cuda() )
-					y_random_pcode_ = Variable(y_random_pcode_.cuda())
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_.cuda() )
 				else:
-					x2D_, z_ = Variable(x2D_), Variable(z_)
+					x2D_ = Variable(x2D_)
 					x3D_ = Variable(x3D_)
-					y_id_ = Variable(y_id_)
-					y_pcode_ = Variable(y_pcode_)
-					y_pcode_onehot_ = Variable( y_pcode_onehot_ )
-					y_random_pcode_ = Variable(y_random_pcode_)
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_ )
 
 				# update D_3D network
 				self.D_3D_optimizer.zero_grad()
@@ -538,11 +536,11 @@ class DRcycleGAN3D(object):
 				if D_3D_acc < 0.8:
 					self.D_3D_optimizer.step()
 
-				self.train_hist['D_3D_loss'].append(D_3D_loss.data[0])
-				self.train_hist['D_3D_loss_GAN_real'].append(D_3D_loss_GANreal.data[0])
-				self.train_hist['D_3D_loss_id'].append(D_3D_loss_real_id.data[0])
-				self.train_hist['D_3D_loss_pcode'].append(D_3D_loss_real_pcode.data[0])
-				self.train_hist['D_3D_loss_GAN_fake'].append(D_3D_loss_GANfake.data[0])
+				self.train_hist['D_3D_loss'].append(D_3D_loss.data)
+				self.train_hist['D_3D_loss_GAN_real'].append(D_3D_loss_GANreal.data)
+				self.train_hist['D_3D_loss_id'].append(D_3D_loss_real_id.data)
+				self.train_hist['D_3D_loss_pcode'].append(D_3D_loss_real_pcode.data)
+				self.train_hist['D_3D_loss_GAN_fake'].append(D_3D_loss_GANfake.data)
 				self.train_hist['D_3D_acc'].append(D_3D_acc)
 
 
@@ -568,11 +566,11 @@ class DRcycleGAN3D(object):
 				if D_2D_acc < 0.8:
 					self.D_2D_optimizer.step()
 
-				self.train_hist['D_2D_loss'].append(D_2D_loss.data[0])
-				self.train_hist['D_2D_loss_GAN_real'].append(D_2D_loss_GANreal.data[0])
-				self.train_hist['D_2D_loss_id'].append(D_2D_loss_real_id.data[0])
-				self.train_hist['D_2D_loss_pcode'].append(D_2D_loss_real_pcode.data[0])
-				self.train_hist['D_2D_loss_GAN_fake'].append(D_2D_loss_GANfake.data[0])
+				self.train_hist['D_2D_loss'].append(D_2D_loss.data)
+				self.train_hist['D_2D_loss_GAN_real'].append(D_2D_loss_GANreal.data)
+				self.train_hist['D_2D_loss_id'].append(D_2D_loss_real_id.data)
+				self.train_hist['D_2D_loss_pcode'].append(D_2D_loss_real_pcode.data)
+				self.train_hist['D_2D_loss_GAN_fake'].append(D_2D_loss_GANfake.data)
 				self.train_hist['D_2D_acc'].append(D_2D_acc)
 
 
@@ -611,14 +609,14 @@ class DRcycleGAN3D(object):
 #					G_2Dto3D_cycle_loss = loss_recon + loss_id + loss_pose
 
 					if iG == 0:
-						self.train_hist['G_3D_loss'].append(G_3D_loss.data[0])
-						self.train_hist['G_3D_loss_GAN_fake'].append(G_3D_loss_GANfake.data[0])
-						self.train_hist['G_3D_loss_id'].append(G_3D_loss_id.data[0])
-						self.train_hist['G_3D_loss_pcode'].append(G_3D_loss_pcode.data[0])
-						self.train_hist['G_2D_loss'].append(G_2D_loss.data[0])
-						self.train_hist['G_2D_loss_GAN_fake'].append(G_2D_loss_GANfake.data[0])
-						self.train_hist['G_2D_loss_id'].append(G_2D_loss_id.data[0])
-						self.train_hist['G_2D_loss_pcode'].append(G_2D_loss_pcode.data[0])
+						self.train_hist['G_3D_loss'].append(G_3D_loss.data)
+						self.train_hist['G_3D_loss_GAN_fake'].append(G_3D_loss_GANfake.data)
+						self.train_hist['G_3D_loss_id'].append(G_3D_loss_id.data)
+						self.train_hist['G_3D_loss_pcode'].append(G_3D_loss_pcode.data)
+						self.train_hist['G_2D_loss'].append(G_2D_loss.data)
+						self.train_hist['G_2D_loss_GAN_fake'].append(G_2D_loss_GANfake.data)
+						self.train_hist['G_2D_loss_id'].append(G_2D_loss_id.data)
+						self.train_hist['G_2D_loss_pcode'].append(G_2D_loss_pcode.data)
 	
 					G_loss = G_2D_loss + G_3D_loss + loss_recon2D + loss_recon3D
 					G_loss.backward()
@@ -636,6 +634,8 @@ class DRcycleGAN3D(object):
 					utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
 
 			self.train_hist['per_epoch_time'].append(time.time() - epoch_start_time)
+			self.train_hist['data_wait_time'].append(prefetcher.wait_time)
+			print('E[%2d] waited %.2f of %.2f sec on data' % ((epoch + 1), prefetcher.wait_time, self.train_hist['per_epoch_time'][-1]))
 			self.save()
 			utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
 			self.visualize_results((epoch+1))
@@ -646,6 +646,7 @@ class DRcycleGAN3D(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name,
 								 self.epoch)
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
@@ -694,35 +695,14 @@ class DRcycleGAN3D(object):
 		utils.save_images(recon_2D[:nRows*nCols,:,:,:], [nRows, nCols],fname)
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.G_2Dto3D.state_dict(), os.path.join(save_dir, self.model_name + '_G_2Dto3D.pkl'))
-		torch.save(self.G_3Dto2D.state_dict(), os.path.join(save_dir, self.model_name + '_G_3Dto2D.pkl'))
-		torch.save(self.D_2D.state_dict(), os.path.join(save_dir, self.model_name + '_D_2D.pkl'))
-		torch.save(self.D_3D.state_dict(), os.path.join(save_dir, self.model_name + '_D_3D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-		print( 'loading from {}...'.format(save_dir) )
-
-		self.G_2Dto3D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G_2Dto3D.pkl')))
-		self.G_3Dto2D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G_3Dto2D.pkl')))
-		self.D_2D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D_2D.pkl')))
-		self.D_3D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D_3D.pkl')))
-
-		try:
-			fhandle = open(os.path.join(save_dir, self.model_name + '_history.pkl'))
-			self.train_hist = pickle.load(fhandle)
-			fhandle.close()
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-		except:
+		state = self.checkpointer.load()
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
 
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
@@ -235,8 +235,13 @@ class DRecon3DGAN(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.multi_gpu = args.multi_gpu
 		self.num_workers = args.num_workers
+		self.prefetch = args.prefetch
+		self.save_every = args.save_every
+		self.augment_voxel = utils.VoxelAugmenter( [op for op in args.augment_voxel.split(',') if len(op) > 0],
+								args.augment_shift, args.augment_angle, args.augment_color, gpu_mode=self.gpu_mode )
 		self.model_name = args.gan_type
 		self.centerBosphorus = args.centerBosphorus
 		self.loss_option = args.loss_option
@@ -248,6 +253,10 @@ class DRecon3DGAN(object):
 		self.lambda_ = 0.25
 		self.n_critic = args.n_critic
 		self.n_gen = args.n_gen
+		self.fuse_step = args.fuse_step
+		if self.fuse_step:
+			print('[warning] --fuse_step trains D on fakes of y_pcode_, the pose codes the G step uses, instead of random pose codes.')
+			print('[warning] D never sees random pose samples, which changes the training objective of {}.'.format(args.gan_type))
 		self.c = 0.01 # for wgan
 		self.nDaccAvg = args.nDaccAvg
 		if 'wass' in self.loss_option:
@@ -286,7 +295,8 @@ class DRecon3DGAN(object):
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'MultiPie' or self.dataset == 'miniPie':
 			self.data_loader = DataLoader( utils.MultiPie(data_dir,
 					transform=transforms.Compose(
@@ -299,17 +309,25 @@ class DRecon3DGAN(object):
 		elif self.dataset == 'CASIA-WebFace':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 			self.Nd = 10885 
 			self.Np = 13
 			self.Ni = 20
 			self.Nz = 50
 		elif self.dataset == 'Bosphorus':
-			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, fname_cache=args.fname_cache,
-											transform=transforms.ToTensor(),
-											shape=128, image_shape=256, center=self.centerBosphorus,
-											use_colorPCL=True),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+			if len(args.dir_shards) > 0:
+				self.data_loader = utils.bosphorus_shard_loader( args.dir_shards, self.batch_size, self.num_workers, args.shuffle_buffer,
+													shape=128, image_shape=256, center=self.centerBosphorus,
+													sparse=args.sparse_voxel, compact=args.compact_voxel, stream=args.stream )
+			else:
+				self.data_loader = utils.resumable_loader( utils.Bosphorus(data_dir, use_image=True, fname_cache=args.fname_cache, fname_store=args.fname_store,
+												fname_image_store=args.fname_image_store,
+												transform=transforms.ToTensor(),
+												shape=128, image_shape=256, center=self.centerBosphorus,
+												use_colorPCL=True, sparse=args.sparse_voxel, compact=args.compact_voxel),
+												batch_size=self.batch_size, num_workers=self.num_workers,
+												collate_fn=utils.collate_voxel)
 			self.num_id = 105
 			self.num_c_expr = len(self.data_loader.dataset.posecodemap)
 			self.dim_fx = 320
@@ -321,6 +339,12 @@ class DRecon3DGAN(object):
 		self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D2d_optimizer = optim.Adam(self.D2d.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
 		self.D3d_optimizer = optim.Adam(self.D3d.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.D2d_gate = utils.UpdateGate( 0.8, self.nDaccAvg, self.flush_metrics )
+		self.D3d_gate = utils.UpdateGate( 0.8, self.nDaccAvg, self.flush_metrics )
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G': self.G, 'D2d': self.D2d, 'D3d': self.D3d},
+						{'G': self.G_optimizer, 'D2d': self.D2d_optimizer, 'D3d': self.D3d_optimizer}, args.keep_last, args.keep_every,
+						states={'D2d_gate': self.D2d_gate, 'D3d_gate': self.D3d_gate} )
 
 		if self.gpu_mode:
 			self.G.cuda()
@@ -355,6 +379,7 @@ class DRecon3DGAN(object):
                            'D3d_acc',
                            'G_loss',
                            'per_epoch_time',
+                           'data_wait_time',
                            'total_time']
 		if 'recon' in self.loss_option:
 			train_hist_keys.append('G_loss_recon')
@@ -364,7 +389,7 @@ class DRecon3DGAN(object):
 		if not hasattr(self, 'epoch_start'):
 			self.epoch_start = 0
 		if not hasattr(self, 'train_hist') :
-			self.train_hist = {}
+			self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 			for key in train_hist_keys:
 				self.train_hist[key] = []
 		else:
@@ -383,54 +408,47 @@ class DRecon3DGAN(object):
 			self.y_real_ = Variable((torch.ones(self.batch_size,1)))
 			self.y_fake_ = Variable((torch.zeros(self.batch_size,1)))
 
-		nPairs = self.batch_size*(self.batch_size-1)
-		normalizerA = self.data_loader.dataset.muA/self.data_loader.dataset.stddevA # normalization
-		normalizerB = self.data_loader.dataset.muB/self.data_loader.dataset.stddevB # normalization
-		eps = 1e-16
-
 		self.D2d.train()
 		self.D3d.train()
 		start_time = time.time()
 
 		nBatchesPerEpoch = self.data_loader.dataset.__len__() // self.batch_size
 		print('training start from epoch {}!!'.format(self.epoch_start+1))
+		self.prepare_batch = utils.BatchPreparer( self.batch_size, self.num_c_expr, 0, self.gpu_mode )
+		prefetcher = utils.Prefetcher( self.data_loader, self.prefetch, self.gpu_mode )
+		data_position = utils.data_position( self.data_loader )
 		for epoch in range(self.epoch_start, self.epoch):
 			self.G.train()
 			epoch_start_time = time.time()
 			start_time_epoch = time.time()
 
-			for iB, (x3D_, y_, x2D_ ) in enumerate(self.data_loader):
+			data_position.set_epoch( epoch )
+			iB_start = data_position.position // self.batch_size
+			for iB, (x3D_, y_, x2D_ ) in enumerate(prefetcher, iB_start):
 				if iB == nBatchesPerEpoch:
 					break
+				data_position.position = iB*self.batch_size
+				if self.save_every > 0 and iB > iB_start and iB % self.save_every == 0:
+					self.save()
+				x3D_ = utils.densify_voxel( x3D_ )
+				x3D_, x2D_ = self.augment_voxel( x3D_, x2D_ )
 
 				projected, _ = torch.max( x3D_[:,1:,:,:,:], 4, keepdim=False)
 				x3D_ = x3D_[:,0:1,:,:,:]
-				y_random_pcode_ = torch.floor(torch.rand(self.batch_size)*self.num_c_expr).long()
-				y_random_pcode_onehot_ = torch.zeros( self.batch_size, self.num_c_expr )
-				y_random_pcode_onehot_.scatter_(1, y_random_pcode_.view(-1,1), 1)
-				y_id_ = y_['id']
-				y_pcode_ = y_['pcode']
-				y_pcode_onehot_ = torch.zeros( self.batch_size, self.num_c_expr )
-				y_pcode_onehot_.scatter_(1, y_pcode_.view(-1,1), 1)
+				y_id_, y_pcode_, y_pcode_onehot_, y_random_pcode_, y_random_pcode_onehot_, _ = self.prepare_batch( y_ )
 
 				if self.gpu_mode:
 					x2D_= Variable(x2D_.cuda())
-					x3D_ = Variable(x3D_.cuda())
-					projected = Variable(projected.cuda())
-					y_id_ = Variable( y_id_.cuda() )
-					y_pcode_ = Variable(y_pcode_.cuda())
-					y_pcode_onehot_ = Variable( y_pcode_onehot_.cuda() )
-					y_random_pcode_ = Variable(y_random_pcode_.cuda())
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_.cuda() )
+					x3D_ = Variable(utils.voxel_to_float(x3D_.cuda()))
+					projected = Variable(utils.voxel_to_float(projected.cuda(), has_occupancy=False))
 				else:
 					x2D_= Variable(x2D_)
-					x3D_ = Variable(x3D_)
-					projected = Variable(projected)
-					y_id_ = Variable(y_id_)
-					y_pcode_ = Variable(y_pcode_)
-					y_pcode_onehot_ = Variable( y_pcode_onehot_ )
-					y_random_pcode_ = Variable(y_random_pcode_)
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_ )
+					x3D_ = Variable(utils.voxel_to_float(x3D_))
+					projected = Variable(utils.voxel_to_float(projected, has_occupancy=False))
+
+				if self.fuse_step:
+					# conditioned on y_pcode_ as the generator step needs, so D sees no random pose codes in fuse_step mode
+					xhat2d_fused, xhat3d_fused = self.G(x2D_, y_pcode_onehot_)
 
 				# update D network
 				for iD in range(self.n_critic) :
@@ -447,7 +465,10 @@ class DRecon3DGAN(object):
 					loss_d_real_id3d = self.CE_loss(d_id3d, y_id_)
 					loss_d_real_expr3d = self.CE_loss(d_expr3d, y_pcode_)
 	
-					xhat2d, xhat3d = self.G(x2D_, y_random_pcode_onehot_)
+					if self.fuse_step:
+						xhat2d, xhat3d = xhat2d_fused.detach(), xhat3d_fused.detach()
+					else:
+						xhat2d, xhat3d = self.G(x2D_, y_random_pcode_onehot_)
 					d_fake_gan2d, _, _ = self.D2d( xhat2d )
 					d_fake_gan3d, _, _ = self.D3d( xhat3d )
 					loss_d_fake_gan2d = self.BCE_loss(d_fake_gan2d, self.y_fake_)
@@ -455,32 +476,38 @@ class DRecon3DGAN(object):
 	
 					num_correct_real2d = torch.sum(d_gan2d>0.5)
 					num_correct_fake2d = torch.sum(d_fake_gan2d<0.5)
-					D2d_acc = float(num_correct_real2d.data[0] + num_correct_fake2d.data[0]) / (self.batch_size*2)
+					D2d_acc = (num_correct_real2d.float() + num_correct_fake2d.float()) / (self.batch_size*2)
 					num_correct_real3d = torch.sum(d_gan3d>0.5)
 					num_correct_fake3d = torch.sum(d_fake_gan3d<0.5)
-					D3d_acc = float(num_correct_real3d.data[0] + num_correct_fake3d.data[0]) / (self.batch_size*2)
+					D3d_acc = (num_correct_real3d.float() + num_correct_fake3d.float()) / (self.batch_size*2)
 	
 					D2d_loss = loss_d_real_gan2d + loss_d_real_id2d + loss_d_real_expr2d + loss_d_fake_gan2d
 					D3d_loss = loss_d_real_gan3d + loss_d_real_id3d + loss_d_real_expr3d + loss_d_fake_gan3d
 
 					if iD == 0:	
-						self.train_hist['D2d_loss'].append(D2d_loss.data[0])
-						self.train_hist['D3d_loss'].append(D3d_loss.data[0])
-						self.train_hist['D2d_acc'].append(D2d_acc)
-						self.train_hist['D3d_acc'].append(D3d_acc)
+						self.train_hist['D2d_loss'].append(D2d_loss.data)
+						self.train_hist['D3d_loss'].append(D3d_loss.data)
+						self.train_hist['D2d_acc'].append(D2d_acc.data)
+						self.train_hist['D3d_acc'].append(D3d_acc.data)
 	
 					D2d_loss.backward(retain_graph=True)
 					D3d_loss.backward()
-					if D2d_acc < 0.8:
+					train_D2d, train_D3d = self.D2d_gate.is_open(), self.D3d_gate.is_open()
+					if train_D2d:
 						self.D2d_optimizer.step()
-					if D3d_acc < 0.8:
+					if train_D3d:
 						self.D3d_optimizer.step()
+					self.D2d_gate.update( D2d_acc.data, train_D2d )
+					self.D3d_gate.update( D3d_acc.data, train_D3d )
 
 				# update G network
 				for iG in range( self.n_gen ):
 					self.G_optimizer.zero_grad()
 		
-					xhat2d, xhat3d = self.G(x2D_, y_pcode_onehot_)
+					if self.fuse_step and iG == 0:
+						xhat2d, xhat3d = xhat2d_fused, xhat3d_fused
+					else:
+						xhat2d, xhat3d = self.G(x2D_, y_pcode_onehot_)
 
 					d_gan2d, d_id2d, d_expr2d = self.D2d(xhat2d)
 					loss_g_gan2d = self.BCE_loss(d_gan2d, self.y_real_)
@@ -496,7 +523,7 @@ class DRecon3DGAN(object):
 								loss_g_gan3d + loss_g_id3d + loss_g_expr3d
 	
 					if iG == 0:
-						self.train_hist['G_loss'].append(G_loss.data[0])
+						self.train_hist['G_loss'].append(G_loss.data)
 		
 					G_loss.backward()
 					self.G_optimizer.step()
@@ -511,12 +538,15 @@ class DRecon3DGAN(object):
 						  D2d_loss.data[0],
 						  D3d_loss.data[0],
 						  G_loss.data[0],
-						  D3d_acc,
-						  D2d_acc) )
+						  D3d_acc.data[0],
+						  D2d_acc.data[0]) )
 				
 			self.train_hist['per_epoch_time'].append(time.time() - epoch_start_time)
+			self.train_hist['data_wait_time'].append(prefetcher.wait_time)
+			print('E[%2d] waited %.2f of %.2f sec on data' % ((epoch + 1), prefetcher.wait_time, self.train_hist['per_epoch_time'][-1]))
 			if epoch==0 or (epoch+1)%5 == 0:
 				self.dump_x_hat(xhat2d, xhat3d, epoch+1)
+			data_position.set_epoch( epoch+1 )
 			self.save()
 			utils.loss_plot(self.train_hist,
 							os.path.join(self.save_dir, self.dataset, self.model_name),
@@ -528,6 +558,7 @@ class DRecon3DGAN(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.loss_plot(self.train_hist,
 						os.path.join(self.save_dir, self.dataset, self.model_name),
 						self.model_name, use_subplot=True)
@@ -554,7 +585,8 @@ class DRecon3DGAN(object):
 
 	def get_image_batch(self):
 		dataIter = iter(self.data_loader)
-		return next(dataIter)
+		x3D, y, x2D = next(dataIter)
+		return utils.voxel_to_float(utils.densify_voxel(x3D)), y, x2D
 
 	def visualize_results(self,a=None,b=None):
 		print( 'visualizing result...' )
@@ -636,45 +668,19 @@ class DRecon3DGAN(object):
 
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		if self.multi_gpu:
-			torch.save(self.G.module.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-			torch.save(self.D2d.module.state_dict(), os.path.join(save_dir, self.model_name + '_D2d.pkl'))
-			torch.save(self.D3d.module.state_dict(), os.path.join(save_dir, self.model_name + '_D3d.pkl'))
-		else:
-			torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-			torch.save(self.D2d.state_dict(), os.path.join(save_dir, self.model_name + '_D2d.pkl'))
-			torch.save(self.D3d.state_dict(), os.path.join(save_dir, self.model_name + '_D3d.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist, self.data_loader )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if self.multi_gpu:
-			self.G.module.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-			self.D2d.module.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D2d.pkl')))
-			self.D3d.module.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D3d.pkl')))
-		else:
-			self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-			self.D2d.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D2d.pkl')))
-			self.D3d.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D3d.pkl')))
-
-		try:
-			with open(os.path.join(save_dir, self.model_name + '_history.pkl')) as fhandle:
-				self.train_hist = pickle.load(fhandle)
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-			print( 'history has following keys:' )
-			print( self.train_hist.keys() )
-		except:
+		state = self.checkpointer.load( self.data_loader )
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
+
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
+		print( 'history has following keys:' )
+		print( self.train_hist.keys() )
 
 	def interpolate_id(self, opts):
 		print( 'interpolate_id()...' )
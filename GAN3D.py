@@ -92,6 +92,7 @@ class GAN3D(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.model_name = args.gan_type
 		self.num_workers = args.num_workers
 		self.centerBosphorus = args.centerBosphorus
@@ -107,10 +108,11 @@ class GAN3D(object):
 		# load dataset
 		data_dir = os.path.join( self.dataroot_dir, self.dataset )
 		if self.dataset == 'ShapeNet':
-			self.data_loader = DataLoader( utils.ShapeNet(data_dir,synsetId=args.synsetId),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+			self.data_loader = utils.shapenet_loader( data_dir, self.batch_size, self.num_workers, synsetId=args.synsetId,
+											voxel_cache_dir=args.voxel_cache_dir, sparse=args.sparse_voxel, stream=args.stream, buffer_size=args.shuffle_buffer )
 		elif self.dataset == 'Bosphorus':
 			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, skipCodes=['YR','PR','CR'],
+											fname_store=args.fname_store,
 											transform=transforms.ToTensor(),
 											shape=128, image_shape=256),
 											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
@@ -143,6 +145,8 @@ class GAN3D(object):
 		self.D = discriminator()
 		self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G': self.G, 'D': self.D}, {'G': self.G_optimizer, 'D': self.D_optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.G.cuda()
@@ -170,7 +174,7 @@ class GAN3D(object):
 		if not hasattr(self, 'epoch_start'):
 			self.epoch_start = 0
 		if not hasattr(self, 'train_hist') :
-			self.train_hist = {}
+			self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 			for key in train_hist_keys:
 				self.train_hist[key] = []
 		else:
@@ -206,6 +210,7 @@ class GAN3D(object):
 			for iB, (x_, _, _) in enumerate(self.data_loader):
 				if iB == self.data_loader.dataset.__len__() // self.batch_size:
 					break
+				x_ = utils.densify_voxel( x_ )
 
 				z_ = torch.normal( torch.zeros(self.batch_size, self.Nz), torch.ones(self.batch_size,self.Nz)*0.33)
 				
@@ -251,7 +256,7 @@ class GAN3D(object):
 				else:
 					D_loss = D_real_loss + D_fake_loss
 				D_loss.backward()
-				self.train_hist['D_loss'].append(D_loss.data[0])
+				self.train_hist['D_loss'].append(D_loss.data)
 
 				# D gets updated only if its accuracy is below 80%
 				D_acc = float(num_correct_real.data[0] + num_correct_fake.data[0]) / (self.batch_size*2)
@@ -266,7 +271,7 @@ class GAN3D(object):
 				D_fake = self.D(G_)
 
 				G_loss = self.BCE_loss(D_fake, self.y_real_)
-				self.train_hist['G_loss'].append(G_loss.data[0])
+				self.train_hist['G_loss'].append(G_loss.data)
 
 				G_loss.backward()
 				self.G_optimizer.step()
@@ -295,6 +300,7 @@ class GAN3D(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
 
 	def dump_x_hat(self, epoch, iB=0, fix=True):
@@ -358,33 +364,19 @@ class GAN3D(object):
 			np.expand_dims(samples[i],0).dump( filename )
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
-
-		try:
-			with open(os.path.join(save_dir, self.model_name + '_history.pkl')) as fhandle:
-				self.train_hist = pickle.load(fhandle)
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-			print( 'history has following keys:' )
-			print( self.train_hist.keys() )
-		except:
+		state = self.checkpointer.load()
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
+
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
+		print( 'history has following keys:' )
+		print( self.train_hist.keys() )
 
 	def get_image_batch(self):
 		dataIter = iter(self.data_loader)
@@ -1,10 +1,9 @@
-import utils, torch, time, os, pickle
+import utils, torch, time, os
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
-from torch.utils.data import DataLoader
-from torchvision import datasets, transforms
+from torchvision import transforms
 
 class generator(nn.Module):
 	# Network Architecture is exactly same as in infoGAN (https://arxiv.org/abs/1606.03657)
@@ -97,6 +96,8 @@ class LSGAN(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
+		self.fuse_step = args.fuse_step
 		self.model_name = args.gan_type
 
 		# networks init
@@ -104,6 +105,8 @@ class LSGAN(object):
 		self.D = discriminator(self.dataset)
 		self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G': self.G, 'D': self.D}, {'G': self.G_optimizer, 'D': self.D_optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.G.cuda()
@@ -119,20 +122,14 @@ class LSGAN(object):
 
 		# load dataset
 		data_dir = os.path.join( self.dataroot_dir, self.dataset )
-		if self.dataset == 'mnist':
-			self.data_loader = DataLoader(datasets.MNIST(data_dir, train=True, download=True,
-														 transform=transforms.Compose(
-															 [transforms.ToTensor()])),
-										  batch_size=self.batch_size, shuffle=True)
-		elif self.dataset == 'fashion-mnist':
-			self.data_loader = DataLoader(
-				datasets.FashionMNIST(data_dir, train=True, download=True, transform=transforms.Compose(
-					[transforms.ToTensor()])),
-				batch_size=self.batch_size, shuffle=True)
+		if self.dataset == 'mnist' or self.dataset == 'fashion-mnist':
+			data_X, data_y = utils.load_mnist_uint8(self.dataset, self.dataroot_dir, split='train')
+			self.data_loader = utils.TensorLoader(data_X, data_y, self.batch_size, shuffle=True, gpu_mode=self.gpu_mode)
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		self.z_dim = 62
 
 		# fixed noise
@@ -142,7 +139,7 @@ class LSGAN(object):
 			self.sample_z_ = Variable(torch.rand((self.batch_size, self.z_dim)), volatile=True)
 
 	def train(self):
-		self.train_hist = {}
+		self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 		self.train_hist['D_loss'] = []
 		self.train_hist['G_loss'] = []
 		self.train_hist['per_epoch_time'] = []
@@ -177,11 +174,13 @@ class LSGAN(object):
 				D_real_loss = self.MSE_loss(D_real, self.y_real_)
 
 				G_ = self.G(z_)
+				if self.fuse_step:
+					G_fused, G_ = G_, G_.detach()
 				D_fake = self.D(G_)
 				D_fake_loss = self.MSE_loss(D_fake, self.y_fake_)
 
 				D_loss = D_real_loss + D_fake_loss
-				self.train_hist['D_loss'].append(D_loss.data[0])
+				self.train_hist['D_loss'].append(D_loss.data)
 
 				D_loss.backward()
 				self.D_optimizer.step()
@@ -189,10 +188,13 @@ class LSGAN(object):
 				# update G network
 				self.G_optimizer.zero_grad()
 
-				G_ = self.G(z_)
+				if self.fuse_step:
+					G_ = G_fused
+				else:
+					G_ = self.G(z_)
 				D_fake = self.D(G_)
 				G_loss = self.MSE_loss(D_fake, self.y_real_)
-				self.train_hist['G_loss'].append(G_loss.data[0])
+				self.train_hist['G_loss'].append(G_loss.data)
 
 				G_loss.backward()
 				self.G_optimizer.step()
@@ -210,6 +212,7 @@ class LSGAN(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name,
 								 self.epoch)
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
@@ -244,19 +247,7 @@ class LSGAN(object):
 						  self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name + '_epoch%03d' % epoch + '.png')
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
+		self.checkpointer.load()
@@ -1,4 +1,4 @@
-import utils, torch, time, os, pickle, imageio
+import utils, torch, time, os, imageio
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
@@ -64,6 +64,7 @@ class Recog3D(object):
 		self.centerBosphorus = args.centerBosphorus
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.model_name = args.gan_type
 		self.num_workers = args.num_workers
 		if len(args.comment) > 0:
@@ -77,14 +78,17 @@ class Recog3D(object):
 		# load dataset
 		data_dir = os.path.join( self.dataroot_dir, self.dataset )
 		if self.dataset == 'ShapeNet':
-			self.data_loader = DataLoader( utils.ShapeNet(data_dir,synsetId=args.synsetId),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+			self.data_loader = utils.shapenet_loader( data_dir, self.batch_size, self.num_workers, synsetId=args.synsetId,
+											compact=args.compact_voxel, voxel_cache_dir=args.voxel_cache_dir,
+											sparse=args.sparse_voxel, stream=args.stream, buffer_size=args.shuffle_buffer )
 		elif self.dataset == 'Bosphorus':
-			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, fname_cache=args.fname_cache,
+			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, fname_cache=args.fname_cache, fname_store=args.fname_store,
+											fname_image_store=args.fname_image_store,
 											transform=transforms.ToTensor(),
 											shape=128, image_shape=256, center=self.centerBosphorus,
-											use_colorPCL=True),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+											use_colorPCL=True, sparse=args.sparse_voxel, compact=args.compact_voxel),
+											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers,
+											collate_fn=utils.collate_voxel)
 			self.Nid = 105
 			self.Npcode = len(self.data_loader.dataset.posecodemap)
 		elif self.dataset == 'IKEA':
@@ -95,6 +99,7 @@ class Recog3D(object):
 			exit("unknown dataset: " + self.dataset)
 
 		for iB, (sample_x_, sample_y_, sample_image_) in enumerate(self.data_loader):
+			sample_x_ = utils.voxel_to_float( utils.densify_voxel( sample_x_ ) )
 			self.sample_x_ = sample_x_[:,0:1,:,:,:]
 			self.sample_image_ = sample_image_
 			self.sample_y_id_ = sample_y_['id']
@@ -135,6 +140,8 @@ class Recog3D(object):
 		# networks init
 		self.D = discriminator(self.Nid, self.Npcode)
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'D': self.D}, {'D': self.D_optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.D.cuda()
@@ -150,7 +157,7 @@ class Recog3D(object):
 
 	def train(self):
 		if not hasattr(self, 'train_hist') :
-			self.train_hist = {}
+			self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 			self.train_hist['D_loss'] = []
 			self.train_hist['D_loss_id'] = []
 			self.train_hist['D_loss_pcode'] = []
@@ -178,18 +185,19 @@ class Recog3D(object):
 			for iB, (x_, y_, image_) in enumerate(self.data_loader):
 				if iB == nBatchesPerEpoch:
 					break
+				x_ = utils.densify_voxel( x_ )
 
 				x_ = x_[:,0:1,:,:,:]
 				y_id_ = y_['id']
 				y_pcode_ = y_['pcode']
 
 				if self.gpu_mode:
-					x_ = Variable(x_.cuda())
+					x_ = Variable(utils.voxel_to_float(x_.cuda()))
 					image_ = Variable(image_.cuda())
 					y_id_ = Variable(y_id_.cuda())
 					y_pcode_ = Variable(y_pcode_.cuda())
 				else:
-					x_ = Variable(x_)
+					x_ = Variable(utils.voxel_to_float(x_))
 					image_ = Variable(image_)
 					y_id_ = Variable(y_id_)
 					y_pcode_ = Variable(y_pcode_)
@@ -205,9 +213,9 @@ class Recog3D(object):
 				D_loss = D_loss_id + D_loss_pcode
 				D_loss.backward()
 
-				self.train_hist['D_loss'].append(D_loss.data[0])
-				self.train_hist['D_loss_id'].append(D_loss_id.data[0])
-				self.train_hist['D_loss_pcode'].append(D_loss_pcode.data[0])
+				self.train_hist['D_loss'].append(D_loss.data)
+				self.train_hist['D_loss_id'].append(D_loss_id.data)
+				self.train_hist['D_loss_pcode'].append(D_loss_pcode.data)
 
 				if self.gpu_mode:
 					_, predicted_id = torch.max(D_id.cpu().data, 1)
@@ -248,6 +256,7 @@ class Recog3D(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
 
 	def write_validation_result(self, epoch, fix=True):
@@ -281,28 +290,14 @@ class Recog3D(object):
 		self.write_validation_result(epoch)
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		print( 'loading from {}...'.format(save_dir) )
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
-
-		try:
-			fhandle = open(os.path.join(save_dir, self.model_name + '_history.pkl'))
-			self.train_hist = pickle.load(fhandle)
-			fhandle.close()
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-		except:
+		state = self.checkpointer.load()
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
+
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
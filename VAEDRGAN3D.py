@@ -170,7 +170,12 @@ class VAEDRGAN3D(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.num_workers = args.num_workers
+		self.prefetch = args.prefetch
+		self.save_every = args.save_every
+		self.augment_voxel = utils.VoxelAugmenter( [op for op in args.augment_voxel.split(',') if len(op) > 0],
+								args.augment_shift, args.augment_angle, args.augment_color, gpu_mode=self.gpu_mode )
 		self.model_name = args.gan_type
 		self.centerBosphorus = args.centerBosphorus
 		self.loss_option = args.loss_option
@@ -219,7 +224,8 @@ class VAEDRGAN3D(object):
 		elif self.dataset == 'celebA':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 		elif self.dataset == 'MultiPie' or self.dataset == 'miniPie':
 			self.data_loader = DataLoader( utils.MultiPie(data_dir,
 					transform=transforms.Compose(
@@ -232,16 +238,22 @@ class VAEDRGAN3D(object):
 		elif self.dataset == 'CASIA-WebFace':
 			self.data_loader = utils.CustomDataLoader(data_dir, transform=transforms.Compose(
 				[transforms.Scale(100), transforms.RandomCrop(96), transforms.ToTensor()]), batch_size=self.batch_size,
-												 shuffle=True)
+												 shuffle=True, num_workers=args.num_workers,
+												 fname_store=args.fname_image_store)
 			self.Nd = 10885 
 			self.Np = 13
 			self.Ni = 20
 			self.Nz = 50
 		elif self.dataset == 'Bosphorus':
-			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, skipCodes=['YR','PR','CR'],
-											transform=transforms.ToTensor(),
-											shape=128, image_shape=256, center=self.centerBosphorus),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+			if len(args.dir_shards) > 0:
+				self.data_loader = utils.bosphorus_shard_loader( args.dir_shards, self.batch_size, self.num_workers, args.shuffle_buffer,
+													shape=128, image_shape=256, center=self.centerBosphorus, stream=args.stream )
+			else:
+				self.data_loader = utils.resumable_loader( utils.Bosphorus(data_dir, use_image=True, skipCodes=['YR','PR','CR'],
+												fname_store=args.fname_store,
+												transform=transforms.ToTensor(),
+												shape=128, image_shape=256, center=self.centerBosphorus),
+												batch_size=self.batch_size, num_workers=self.num_workers)
 			self.Nid = 105
 			self.Npcode = len(self.data_loader.dataset.posecodemap)
 			self.Nz = 50
@@ -331,6 +343,9 @@ class VAEDRGAN3D(object):
 		self.Genc_optimizer = optim.Adam(self.Genc.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
 		self.Gdec_optimizer = optim.Adam(self.Gdec.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'Genc': self.Genc, 'Gdec': self.Gdec, 'D': self.D},
+						{'Genc': self.Genc_optimizer, 'Gdec': self.Gdec_optimizer, 'D': self.D_optimizer}, args.keep_last, args.keep_every )
 
 		if self.gpu_mode:
 			self.Genc.cuda()
@@ -367,12 +382,13 @@ class VAEDRGAN3D(object):
                            'Gdec_loss_recon',
                            'Gdec_loss_dist',
                            'per_epoch_time',
+                           'data_wait_time',
                            'total_time']
 
 		if not hasattr(self, 'epoch_start'):
 			self.epoch_start = 0
 		if not hasattr(self, 'train_hist') :
-			self.train_hist = {}
+			self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 			for key in train_hist_keys:
 				self.train_hist[key] = []
 		else:
@@ -391,49 +407,39 @@ class VAEDRGAN3D(object):
 			self.y_real_ = Variable((torch.ones(self.batch_size,1)))
 			self.y_fake_ = Variable((torch.zeros(self.batch_size,1)))
 
-		nPairs = self.batch_size*(self.batch_size-1)
-		normalizerA = self.data_loader.dataset.muA/self.data_loader.dataset.stddevA # normalization
-		normalizerB = self.data_loader.dataset.muB/self.data_loader.dataset.stddevB # normalization
-		eps = 1e-16
+		if 'dist' in self.loss_option:
+			dist_loss = utils.PairwiseDistanceLoss( self.data_loader.dataset )
 
 		self.D.train()
 		start_time = time.time()
 		print('training start from epoch {}!!'.format(self.epoch_start+1))
+		self.prepare_batch = utils.BatchPreparer( self.batch_size, self.Npcode, self.Nz, self.gpu_mode )
+		prefetcher = utils.Prefetcher( self.data_loader, self.prefetch, self.gpu_mode )
+		data_position = utils.data_position( self.data_loader )
 		for epoch in range(self.epoch_start, self.epoch):
 			self.Genc.train()
 			self.Gdec.train()
 			epoch_start_time = time.time()
 			start_time_epoch = time.time()
 
-			for iB, (x3D_, y_, x2D_ ) in enumerate(self.data_loader):
+			data_position.set_epoch( epoch )
+			iB_start = data_position.position // self.batch_size
+			for iB, (x3D_, y_, x2D_ ) in enumerate(prefetcher, iB_start):
 				if iB == self.data_loader.dataset.__len__() // self.batch_size:
 					break
+				data_position.position = iB*self.batch_size
+				if self.save_every > 0 and iB > iB_start and iB % self.save_every == 0:
+					self.save()
+				x3D_, x2D_ = self.augment_voxel( x3D_, x2D_ )
 
-				z_ = torch.rand((self.batch_size, self.Nz))
-				y_random_pcode_ = torch.floor(torch.rand(self.batch_size)*self.Npcode).long()
-				y_random_pcode_onehot_ = torch.zeros( self.batch_size, self.Npcode )
-				y_random_pcode_onehot_.scatter_(1, y_random_pcode_.view(-1,1), 1)
-				y_id_ = y_['id']
-				y_pcode_ = y_['pcode']
-				y_pcode_onehot_ = torch.zeros( self.batch_size, self.Npcode )
-				y_pcode_onehot_.scatter_(1, y_pcode_.view(-1,1), 1)
+				y_id_, y_pcode_, y_pcode_onehot_, y_random_pcode_, y_random_pcode_onehot_, z_ = self.prepare_batch( y_ )
 
 				if self.gpu_mode:
-					x2D_, z_ = Variable(x2D_.cuda()), Variable(z_.cuda())
+					x2D_ = Variable(x2D_.cuda())
 					x3D_ = Variable(x3D_.cuda())
-					y_id_ = Variable( y_id_.cuda() )
-					y_pcode_ = Variable(y_pcode_.cuda())
-					y_pcode_onehot_ = Variable( y_pcode_onehot_.cuda() )
-					y_random_pcode_ = Variable(y_random_pcode_.cuda())
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_.cuda() )
 				else:
-					x2D_, z_ = Variable(x2D_), Variable(z_)
+					x2D_ = Variable(x2D_)
 					x3D_ = Variable(x3D_)
-					y_id_ = Variable(y_id_)
-					y_pcode_ = Variable(y_pcode_)
-					y_pcode_onehot_ = Variable( y_pcode_onehot_ )
-					y_random_pcode_ = Variable(y_random_pcode_)
-					y_random_pcode_onehot_ = Variable( y_random_pcode_onehot_ )
 
 				# update D network
 				for iD in range(self.n_critic) :
@@ -517,11 +523,11 @@ class VAEDRGAN3D(object):
 						D_loss = D_loss_GANreal + D_loss_real_id + D_loss_real_pcode + D_loss_GANfake
 
 					if iD == 0:	
-						self.train_hist['D_loss'].append(D_loss.data[0])
-						self.train_hist['D_loss_GAN_real'].append(D_loss_GANreal.data[0])
-						self.train_hist['D_loss_id'].append(D_loss_real_id.data[0])
-						self.train_hist['D_loss_pcode'].append(D_loss_real_pcode.data[0])
-						self.train_hist['D_loss_GAN_fake'].append(D_loss_GANfake.data[0])
+						self.train_hist['D_loss'].append(D_loss.data)
+						self.train_hist['D_loss_GAN_real'].append(D_loss_GANreal.data)
+						self.train_hist['D_loss_id'].append(D_loss_real_id.data)
+						self.train_hist['D_loss_pcode'].append(D_loss_real_pcode.data)
+						self.train_hist['D_loss_GAN_fake'].append(D_loss_GANfake.data)
 						self.train_hist['D_acc'].append(D_acc)
 	
 					D_loss.backward()
@@ -558,7 +564,7 @@ class VAEDRGAN3D(object):
 
 				Genc_loss.backward()
 
-				self.train_hist['Genc_loss'].append(Genc_loss.data[0])
+				self.train_hist['Genc_loss'].append(Genc_loss.data)
 				self.Genc_optimizer.step()
 
 				# update Gdec network
@@ -593,34 +599,19 @@ class VAEDRGAN3D(object):
 						G_loss += G_loss_recon
 	
 					if 'dist' in self.loss_option:
-						sumA = 0
-						sumB = 0
-						for iA in range(self.batch_size):
-							dist_2D = x2D_[iA]-x2D_ + eps
-							dist_3D = x3D_hat[iA]-x3D_hat + eps
-							normdist_2D = torch.norm(dist_2D.view(self.batch_size,-1),1, dim=1)
-							normdist_3D = torch.norm(dist_3D.view(self.batch_size,-1),1, dim=1)
-							sumA += normdist_2D
-							sumB += normdist_3D
-		
-						sumA /= self.data_loader.dataset.stddevA # normalization
-						sumB /= self.data_loader.dataset.stddevB # normalization
-						sumA /= nPairs # expectation
-						sumB /= nPairs # expectation
-		
-						G_loss_distance = torch.abs( torch.sum( sumA - sumB - normalizerA + normalizerB )) / self.batch_size
+						G_loss_distance = dist_loss( x2D_, x3D_hat )
 						G_loss += G_loss_distance
 	
 	
 					if iG == 0:
-						self.train_hist['Gdec_loss'].append(G_loss.data[0])
-						self.train_hist['Gdec_loss_GAN_fake'].append(G_loss_GANfake.data[0])
-						self.train_hist['Gdec_loss_id'].append(G_loss_id.data[0])
-						self.train_hist['Gdec_loss_pcode'].append(G_loss_pcode.data[0])
+						self.train_hist['Gdec_loss'].append(G_loss.data)
+						self.train_hist['Gdec_loss_GAN_fake'].append(G_loss_GANfake.data)
+						self.train_hist['Gdec_loss_id'].append(G_loss_id.data)
+						self.train_hist['Gdec_loss_pcode'].append(G_loss_pcode.data)
 						if 'recon' in self.loss_option or 'reconL1' in self.loss_option:
-							self.train_hist['Gdec_loss_recon'].append(G_loss_recon.data[0])
+							self.train_hist['Gdec_loss_recon'].append(G_loss_recon.data)
 						if 'dist' in self.loss_option:
-							self.train_hist['Gdec_loss_dist'].append(G_loss_distance.data[0])
+							self.train_hist['Gdec_loss_dist'].append(G_loss_distance.data)
 		
 					G_loss.backward()
 					self.Genc_optimizer.step()
@@ -651,6 +642,9 @@ class VAEDRGAN3D(object):
 #						  G_loss_pcode.data[0]) )
 
 			self.train_hist['per_epoch_time'].append(time.time() - epoch_start_time)
+			self.train_hist['data_wait_time'].append(prefetcher.wait_time)
+			print('E[%2d] waited %.2f of %.2f sec on data' % ((epoch + 1), prefetcher.wait_time, self.train_hist['per_epoch_time'][-1]))
+			data_position.set_epoch( epoch+1 )
 			self.save()
 			utils.loss_plot(self.train_hist,
 							os.path.join(self.save_dir, self.dataset, self.model_name),
@@ -663,6 +657,7 @@ class VAEDRGAN3D(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.loss_plot(self.train_hist,
 						os.path.join(self.save_dir, self.dataset, self.model_name),
 						self.model_name, use_subplot=True)
@@ -704,33 +699,16 @@ class VAEDRGAN3D(object):
 
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.Genc.state_dict(), os.path.join(save_dir, self.model_name + '_Genc.pkl'))
-		torch.save(self.Gdec.state_dict(), os.path.join(save_dir, self.model_name + '_Gdec.pkl'))
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist, self.data_loader )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		self.Genc.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_Genc.pkl')))
-		self.Gdec.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_Gdec.pkl')))
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
-
-		try:
-			with open(os.path.join(save_dir, self.model_name + '_history.pkl')) as fhandle:
-				self.train_hist = pickle.load(fhandle)
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-			print( 'history has following keys:' )
-			print( self.train_hist.keys() )
-		except:
+		state = self.checkpointer.load( self.data_loader )
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
 
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
+		print( 'history has following keys:' )
+		print( self.train_hist.keys() )
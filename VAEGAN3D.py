@@ -129,6 +129,7 @@ class VAEGAN3D(object):
 		self.dataroot_dir = args.dataroot_dir
 		self.log_dir = args.log_dir
 		self.gpu_mode = args.gpu_mode
+		self.flush_metrics = args.flush_metrics
 		self.model_name = args.gan_type
 		self.num_workers = args.num_workers
 		self.centerBosphorus = args.centerBosphorus
@@ -161,10 +162,11 @@ class VAEGAN3D(object):
 		# load dataset
 		data_dir = os.path.join( self.dataroot_dir, self.dataset )
 		if self.dataset == 'ShapeNet':
-			self.data_loader = DataLoader( utils.ShapeNet(data_dir,synsetId=args.synsetId),
-											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
+			self.data_loader = utils.shapenet_loader( data_dir, self.batch_size, self.num_workers, synsetId=args.synsetId,
+											voxel_cache_dir=args.voxel_cache_dir, sparse=args.sparse_voxel, stream=args.stream, buffer_size=args.shuffle_buffer )
 		elif self.dataset == 'Bosphorus':
 			self.data_loader = DataLoader( utils.Bosphorus(data_dir, use_image=True, skipCodes=['YR','PR','CR'],
+											fname_store=args.fname_store,
 											transform=transforms.ToTensor(),
 											shape=128, image_shape=256, center=self.centerBosphorus),
 											batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
@@ -188,6 +190,9 @@ class VAEGAN3D(object):
 		self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
 		self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
 		self.Enc_optimizer = optim.Adam(self.Enc.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
+		self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+						{'G': self.G, 'D': self.D, 'Enc': self.Enc},
+						{'G': self.G_optimizer, 'D': self.D_optimizer, 'Enc': self.Enc_optimizer}, args.keep_last, args.keep_every )
 
 		if hasattr(args, 'comment1'):
 			return
@@ -202,7 +207,7 @@ class VAEGAN3D(object):
 			sample_x3D_s = []
 			for iB, (sample_x3D_,sample_y_,sample_x2D_) in enumerate(self.data_loader):
 				sample_x2D_s.append( sample_x2D_ )
-				sample_x3D_s.append( sample_x3D_ )
+				sample_x3D_s.append( utils.densify_voxel( sample_x3D_ ) )
 				if iB > nSamples // self.batch_size:
 					break
 			sample_x2D_s = torch.cat( sample_x2D_s )[:nSamples,:,:,:]
@@ -281,7 +286,7 @@ class VAEGAN3D(object):
 
 	def train(self):
 		if not hasattr(self, 'train_hist') :
-			self.train_hist = {}
+			self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
 			self.train_hist['D_loss'] = []
 			self.train_hist['E_loss'] = []
 			self.train_hist['G_loss'] = []
@@ -308,6 +313,7 @@ class VAEGAN3D(object):
 			for iB, (x_, _, y_) in enumerate(self.data_loader):
 				if iB == self.data_loader.dataset.__len__() // self.batch_size:
 					break
+				x_ = utils.densify_voxel( x_ )
 
 				z_ = torch.normal( torch.zeros(self.batch_size, self.Nz), torch.ones(self.batch_size,self.Nz) )
 				if self.gpu_mode:
@@ -334,7 +340,7 @@ class VAEGAN3D(object):
 
 				D_loss = D_real_loss + D_fake_loss
 				D_loss.backward()
-				self.train_hist['D_loss'].append(D_loss.data[0])
+				self.train_hist['D_loss'].append(D_loss.data)
 
 				# D gets updated only if its accuracy is below 80%
 				D_acc = float(num_correct_real.data[0] + num_correct_fake.data[0]) / (self.batch_size*2)
@@ -360,7 +366,7 @@ class VAEGAN3D(object):
 				E_loss_MSE = self.MSE_loss( Gey_, x_ )
 				E_loss = KL_div*self.alpha1 + E_loss_MSE*self.alpha2
 				E_loss.backward()
-				self.train_hist['E_loss'].append(E_loss.data[0])
+				self.train_hist['E_loss'].append(E_loss.data)
 				self.Enc_optimizer.step()
 
 				# update G network
@@ -383,7 +389,7 @@ class VAEGAN3D(object):
 				G_loss_GAN = self.BCE_loss(D_fake, self.y_real_)
 				G_loss_MSE = self.MSE_loss(Gey_, x_)
 				G_loss = G_loss_GAN + G_loss_MSE*self.alpha2
-				self.train_hist['G_loss'].append(G_loss.data[0])
+				self.train_hist['G_loss'].append(G_loss.data)
 
 				G_loss.backward()
 				self.G_optimizer.step()
@@ -408,6 +414,7 @@ class VAEGAN3D(object):
 		print("Training finish!... save training results")
 
 		self.save()
+		self.checkpointer.wait()
 		utils.loss_plot(self.train_hist, os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name)
 
 	def dump_x_hat(self, epoch, fix=True):
@@ -492,35 +499,17 @@ class VAEGAN3D(object):
 
 
 	def save(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		if not os.path.exists(save_dir):
-			os.makedirs(save_dir)
-
-		torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-		torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-		torch.save(self.Enc.state_dict(), os.path.join(save_dir, self.model_name + '_Enc.pkl'))
-
-		with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-			pickle.dump(self.train_hist, f)
+		self.checkpointer.save( self.train_hist )
 
 	def load(self):
-		save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-		print( 'loading from {}...'.format(save_dir) )
-		self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-		self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
-		self.Enc.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_Enc.pkl')))
-
-		try:
-			fhandle = open(os.path.join(save_dir, self.model_name + '_history.pkl'))
-			self.train_hist = pickle.load(fhandle)
-			fhandle.close()
-			
-			self.epoch_start = len(self.train_hist['per_epoch_time'])
-			print( 'loaded epoch {}'.format(self.epoch_start) )
-		except:
+		state = self.checkpointer.load()
+		if state['history'] is None:
 			print('history is not found and ignored')
+			return
+
+		self.train_hist = utils.load_metric_store( state['history'], os.path.join(self.checkpointer.save_dir, self.model_name + '_metrics'), self.flush_metrics )
+		self.epoch_start = len(self.train_hist['per_epoch_time'])
+		print( 'loaded epoch {}'.format(self.epoch_start) )
 
 	def get_image_batch(self):
 		dataIter = iter(self.data_loader)
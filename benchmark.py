@@ -0,0 +1,717 @@
+from __future__ import print_function
+import argparse, os, time, struct, tempfile, shutil, gzip, importlib, itertools
+import numpy as np
+import torch
+from torch.autograd import Variable
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+from PIL import Image
+
+import utils
+from utils3D.data_io import read_bnt, bnt2voxel, bnt2voxel_wColor, resize, write_binvox, read_binvox_packed, unpack_voxel
+from utils3D import binvox_rw
+from utils3D.image_store import ImageStoreWriter, ImageStore
+
+def read_bnt_unpack(path):
+	# struct based implementation read_bnt had before np.frombuffer, kept as reference
+	with open(path, 'rb') as f:
+		nrows	= struct.unpack('h',f.read(2))[0]
+		ncols	= struct.unpack('h',f.read(2))[0]
+		zmin	= struct.unpack('d',f.read(8))[0]
+		length	= struct.unpack('h',f.read(2))[0]
+		imfile	= f.read(length)
+		length	= struct.unpack('I',f.read(4))[0]
+		pcl		= struct.unpack('d'*length,f.read(length*8))
+		pcl		= np.array(pcl).reshape(5,length//5).transpose()
+	return pcl, nrows, ncols, imfile
+
+def write_bnt(path, pcl, nrows=0, ncols=0, imfile=b'synthetic.png'):
+	with open(path, 'wb') as f:
+		f.write(struct.pack('h', nrows))
+		f.write(struct.pack('h', ncols))
+		f.write(struct.pack('d', pcl[:,2].min()))
+		f.write(struct.pack('h', len(imfile)))
+		f.write(imfile)
+		f.write(struct.pack('I', pcl.size))
+		f.write(np.ascontiguousarray(pcl.T, dtype=np.float64).tobytes())
+
+def bnt2voxel_loop(pcl, shape=64, center=True):
+	# per-point implementation bnt2voxel had before vectorization, kept as reference
+	maxs = pcl[:,:3].max(0)
+	mins = pcl[:,:3].min(0)
+	centers = (maxs + mins)/2
+	xmin, ymin, zmin = mins
+	xc, yc, zc = centers
+	raw_shape = maxs-mins
+	ratio = float(shape-1)/raw_shape
+	ratio_min = min(ratio)
+	ratio = [ratio_min,ratio_min,ratio_min]
+	voxel = np.zeros((1,)+(shape,)*3)
+
+	for i in range(pcl.shape[0]):
+		x,y,z,_,_ = pcl[i]
+		try:
+			if center:
+				xx,yy,zz = int(x)-xc,int(y)-yc,int(z)-zc
+				voxel[0,int(xx*ratio[0]+shape//2),int(yy*ratio[1]+shape//2),int(zz*ratio[2]+shape//2)] = 1
+			else:
+				xx,yy,zz = int(x)-xmin,int(y)-ymin,int(z)-zmin
+				voxel[0,int(xx*ratio[0]),int(yy*ratio[1]),int(zz*ratio[2])] = 1
+		except IndexError:
+			pass
+	return voxel
+
+def bnt2voxel_wColor_loop(pcl, image, shape=64, center=True):
+	# per-point implementation bnt2voxel_wColor had before vectorization, kept as reference
+	maxs = pcl[:,:3].max(0)
+	mins = pcl[:,:3].min(0)
+	centers = (maxs + mins)/2
+	xmin, ymin, zmin = mins
+	xc, yc, zc = centers
+	raw_shape = maxs-mins
+	ratio = float(shape-1)/raw_shape
+	ratio_min = min(ratio)
+	ratio = [ratio_min,ratio_min,ratio_min]
+	voxel = np.zeros((4,)+(shape,)*3)
+
+	for i in range(pcl.shape[0]):
+		x,y,z,u,v = pcl[i]
+		r,g,b = image[:,int(v*image.shape[1]),int(u*image.shape[2])]
+		try:
+			if center:
+				xx,yy,zz = int(x)-xc,int(y)-yc,int(z)-zc
+				idx = int(xx*ratio[0]+shape//2),int(yy*ratio[1]+shape//2),int(zz*ratio[2]+shape//2)
+			else:
+				xx,yy,zz = int(x)-xmin,int(y)-ymin,int(z)-zmin
+				idx = int(xx*ratio[0]),int(yy*ratio[1]),int(zz*ratio[2])
+			voxel[(0,)+idx] = 1
+			voxel[(1,)+idx] = r
+			voxel[(2,)+idx] = g
+			voxel[(3,)+idx] = b
+		except IndexError:
+			pass
+	return voxel
+
+def read_binvox_zoom(path, shape=(64,64,64)):
+	# binvox_rw + scipy.ndimage.zoom implementation read_binvox had before RLE decoding, kept as reference
+	with open(path, 'rb') as f:
+		voxel = binvox_rw.read_as_3d_array(f, True)
+	voxel_data = voxel.data.astype(np.float64)
+	if voxel_data.shape != shape:
+		voxel_data = resize(voxel.data.astype(np.float64), shape)
+	return voxel_data
+
+def synthetic_binvox(path, resolution=128, seed=0):
+	# chair-sized blob: union of random boxes inside the grid
+	rng = np.random.RandomState(seed)
+	voxel = np.zeros((resolution,)*3, dtype=np.uint8)
+	for _ in range(8):
+		lo = rng.randint(0, resolution//2, 3)
+		hi = lo + rng.randint(4, resolution//2, 3)
+		voxel[lo[0]:hi[0],lo[1]:hi[1],lo[2]:hi[2]] = 1
+	write_binvox(voxel, path)
+
+class MNISTPIL(Dataset):
+	# per-sample PIL + ToTensor path of torchvision.datasets.MNIST the 2D models used before TensorLoader
+	def __init__(self, data, labels):
+		self.data = data
+		self.labels = labels
+		self.transform = transforms.Compose([transforms.ToTensor()])
+
+	def __len__(self):
+		return len(self.data)
+
+	def __getitem__(self, idx):
+		return self.transform(Image.fromarray(self.data[idx,0], mode='L')), int(self.labels[idx])
+
+def synthetic_pcl(nPoints=35000, seed=0):
+	# face-sized surface patch in mm with uv in [0,1), shaped like a .bnt point cloud
+	rng = np.random.RandomState(seed)
+	u = rng.rand(nPoints)
+	v = rng.rand(nPoints)
+	x = (u-0.5)*160
+	y = (v-0.5)*200
+	z = -1500 + 60*np.cos(np.pi*(u-0.5))*np.cos(np.pi*(v-0.5)) + rng.randn(nPoints)
+	return np.stack([x,y,z,u,v],1)
+
+def synthetic_image(height=600, width=450, seed=0):
+	# CxHxW float image in [0,1] as produced by transforms.ToTensor()
+	rng = np.random.RandomState(seed)
+	return rng.rand(3, height, width)
+
+def load_pcls(opts):
+	if len(opts.fname_bnt) > 0:
+		pcls = [read_bnt(fname)[0] for fname in opts.fname_bnt.split(',')]
+	else:
+		pcls = [synthetic_pcl(seed=i) for i in range(opts.n_scans)]
+	print( '{} scans, {:.0f} points on average'.format(len(pcls), np.mean([len(p) for p in pcls])) )
+	return pcls
+
+def find_bnts(opts):
+	# real files from --fname_bnt or --dataroot_dir, otherwise synthetic scans in a temporary directory
+	if len(opts.fname_bnt) > 0:
+		return opts.fname_bnt.split(','), None
+	if len(opts.dataroot_dir) > 0:
+		fnames = sorted([os.path.join(dirpath,f) for dirpath, dirnames, files in os.walk(opts.dataroot_dir)
+							for f in files if f.endswith('_trim.bnt')])
+		return fnames, None
+	dir_tmp = tempfile.mkdtemp()
+	fnames = []
+	for i in range(opts.n_scans):
+		fname = os.path.join(dir_tmp, 'bs{:03d}_N_N_0_trim.bnt'.format(i))
+		write_bnt(fname, synthetic_pcl(seed=i))
+		fnames.append(fname)
+	return fnames, dir_tmp
+
+def find_pngs(opts):
+	# face images next to the .bnt files of find_bnts, synthetic images are written for synthetic scans
+	fnames, dir_tmp = find_bnts(opts)
+	fnames = [fname[:-len('_trim.bnt')]+'.png' for fname in fnames]
+	if dir_tmp is not None:
+		for i, fname in enumerate(fnames):
+			image = (synthetic_image(seed=i).transpose(1,2,0)*255).astype(np.uint8)
+			Image.fromarray(image).save(fname)
+	return fnames, dir_tmp
+
+def peak_alloc(func, items):
+	# peak bytes allocated by python while running func over items, None if tracemalloc is unavailable
+	try:
+		import tracemalloc
+	except ImportError:
+		return None
+	tracemalloc.start()
+	for item in items:
+		func(item)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return peak
+
+def rss():
+	# resident set size of this process in bytes (Linux)
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+def timeit(func, items, n_repeat):
+	time_start = time.time()
+	for _ in range(n_repeat):
+		for item in items:
+			func(item)
+	return n_repeat*len(items)/(time.time()-time_start)
+
+def bench_bnt2voxel(opts):
+	pcls = load_pcls(opts)
+	for shape in map(int, opts.shapes.split(',')):
+		for center in [True, False]:
+			for pcl in pcls:
+				assert (bnt2voxel_loop(pcl, shape, center) == bnt2voxel(pcl, shape, center)).all()
+			rate_loop = timeit(lambda p: bnt2voxel_loop(p, shape, center), pcls, 1)
+			rate_vec = timeit(lambda p: bnt2voxel(p, shape, center), pcls, opts.n_repeat)
+			print( 'bnt2voxel shape={} center={}: loop {:.1f} scans/sec, vectorized {:.1f} scans/sec (x{:.1f})'.format(
+					shape, center, rate_loop, rate_vec, rate_vec/rate_loop) )
+
+def bench_bnt2voxel_wColor(opts):
+	pcls = load_pcls(opts)
+	image = synthetic_image()
+	for shape in map(int, opts.shapes.split(',')):
+		for pcl in pcls:
+			assert (bnt2voxel_wColor_loop(pcl, image, shape) == bnt2voxel_wColor(pcl, image, shape)).all()
+		rate_loop = timeit(lambda p: bnt2voxel_wColor_loop(p, image, shape), pcls, 1)
+		print( 'bnt2voxel_wColor shape={}: loop {:.1f} samples/sec/worker'.format(shape, rate_loop) )
+		for sample in ['nearest', 'bilinear']:
+			for collision in ['last', 'mean']:
+				rate_vec = timeit(lambda p: bnt2voxel_wColor(p, image, shape, sample=sample, collision=collision),
+									pcls, opts.n_repeat)
+				print( '\t{}/{}: {:.1f} samples/sec/worker (x{:.1f})'.format(sample, collision, rate_vec, rate_vec/rate_loop) )
+
+def bench_read_bnt(opts):
+	fnames, dir_tmp = find_bnts(opts)
+	print( '{} .bnt files'.format(len(fnames)) )
+	readers = [('struct', read_bnt_unpack),
+				('frombuffer', read_bnt),
+				('memmap', lambda f: read_bnt(f, mmap=True))]
+	for fname in fnames[:opts.n_scans]:
+		reference = read_bnt_unpack(fname)
+		for name, reader in readers[1:]:
+			pcl, nrows, ncols, imfile = reader(fname)
+			assert (pcl == reference[0]).all() and (nrows, ncols, imfile) == reference[1:]
+	for name, reader in readers:
+		rate = timeit(reader, fnames, opts.n_repeat)
+		peak = peak_alloc(reader, fnames[:opts.n_scans])
+		peak = 'n/a' if peak is None else '{:.1f}MB'.format(peak/1e6)
+		print( 'read_bnt {}: {:.1f} files/sec, peak python allocation {}'.format(name, rate, peak) )
+	if dir_tmp is not None:
+		shutil.rmtree(dir_tmp)
+
+def bench_voxel_dtype(opts):
+	pcls = load_pcls(opts)
+	image = synthetic_image()
+	shape = max(map(int, opts.shapes.split(',')))
+	paths = [('float64 -> torch.Tensor float32', np.float64, lambda v: v.astype(np.float32)),
+				('uint8 (compact)', np.uint8, lambda v: v)]
+	for name, dtype, to_tensor in paths:
+		def make_batch():
+			return np.stack([to_tensor(bnt2voxel_wColor(pcls[i%len(pcls)], image, shape, dtype=dtype))
+								for i in range(opts.batch_size)])
+		rss_start = rss()
+		batch = make_batch()
+		rss_batch = rss()-rss_start
+		nbytes = batch.nbytes
+		del batch
+		peak = peak_alloc(lambda _: make_batch(), [None])
+		peak = 'n/a' if peak is None else '{:.0f}MB'.format(peak/1e6)
+		print( '{}: batch of {} at {}^3 holds {:.0f}MB, host RSS +{:.0f}MB, peak allocation {}'.format(
+				name, opts.batch_size, shape, nbytes/1e6, rss_batch/1e6, peak) )
+
+def bench_bosphorus_image(opts):
+	fnames, dir_tmp = find_pngs(opts)
+	dir_store = tempfile.mkdtemp()
+	writer = ImageStoreWriter(dir_store, fnames, opts.image_shape)
+	for fname in fnames:
+		writer.append(utils.resize_pad_image(Image.open(fname), opts.image_shape))
+	writer.close()
+	store = ImageStore(dir_store)
+	rows = store.rows(fnames)
+	for i, fname in enumerate(fnames[:opts.n_scans]):
+		assert (store.get(rows[i]) == utils.resize_pad_image(Image.open(fname), opts.image_shape)).all()
+
+	rate_decode = timeit(lambda f: utils.resize_pad_image(Image.open(f), opts.image_shape), fnames, 1)
+	rate_store = timeit(store.get, rows, opts.n_repeat)
+	print( '{} images at {}^2'.format(len(fnames), opts.image_shape) )
+	print( 'png decode + imresize + pad: {:.1f} images/sec/worker'.format(rate_decode) )
+	print( 'image store slice: {:.1f} images/sec/worker (x{:.1f})'.format(rate_store, rate_store/rate_decode) )
+	shutil.rmtree(dir_store)
+	if dir_tmp is not None:
+		shutil.rmtree(dir_tmp)
+
+def bench_binvox(opts):
+	dir_tmp = tempfile.mkdtemp()
+	fnames = []
+	for i in range(opts.n_scans):
+		fnames.append(os.path.join(dir_tmp, 'model{}.binvox'.format(i)))
+		synthetic_binvox(fnames[-1], opts.binvox_resolution, seed=i)
+	for shape in map(int, opts.shapes.split(',')):
+		if shape > opts.binvox_resolution:
+			continue
+		diff = np.mean([(read_binvox_zoom(f, (shape,)*3) != unpack_voxel(read_binvox_packed(f, shape), shape)).mean()
+						for f in fnames])
+		rate_zoom = timeit(lambda f: read_binvox_zoom(f, (shape,)*3), fnames, 1)
+		rate_rle = timeit(lambda f: unpack_voxel(read_binvox_packed(f, shape), shape), fnames, opts.n_repeat)
+		packed = [os.path.join(dir_tmp, os.path.basename(f)+'.{}.npy'.format(shape)) for f in fnames]
+		for f, fname in zip(fnames, packed):
+			np.save(fname, read_binvox_packed(f, shape))
+		rate_cache = timeit(lambda f: unpack_voxel(np.load(f), shape), packed, opts.n_repeat)
+		print( 'binvox {}^3 -> {}^3: zoom {:.1f} models/sec, rle {:.1f} models/sec (x{:.1f}), cached {:.1f} models/sec (x{:.1f}), {:.2f}% cells differ from zoom'.format(
+				opts.binvox_resolution, shape, rate_zoom, rate_rle, rate_rle/rate_zoom, rate_cache, rate_cache/rate_zoom, 100*diff) )
+	shutil.rmtree(dir_tmp)
+
+def bench_mnist_loader(opts):
+	from GAN import generator, discriminator
+	if len(opts.dataroot_dir) > 0:
+		data_X, data_y = utils.load_mnist_uint8('mnist', opts.dataroot_dir, split='train')
+	else:
+		rng = np.random.RandomState(0)
+		data_X = rng.randint(0, 256, (60000,1,28,28)).astype(np.uint8)
+		data_y = rng.randint(0, 10, 60000).astype(np.int64)
+	gpu_mode = torch.cuda.is_available()
+	loaders = [('DataLoader + ToTensor', DataLoader(MNISTPIL(data_X, data_y), batch_size=opts.batch_size, shuffle=True)),
+				('TensorLoader', utils.TensorLoader(data_X, data_y, opts.batch_size, shuffle=True, gpu_mode=gpu_mode))]
+
+	G, D = generator('mnist'), discriminator('mnist')
+	G_optimizer = torch.optim.Adam(G.parameters(), lr=0.0002, betas=(0.5, 0.999))
+	D_optimizer = torch.optim.Adam(D.parameters(), lr=0.0002, betas=(0.5, 0.999))
+	BCE_loss = torch.nn.BCELoss()
+	y_real_, y_fake_ = torch.ones(opts.batch_size, 1), torch.zeros(opts.batch_size, 1)
+	if gpu_mode:
+		G.cuda(), D.cuda(), BCE_loss.cuda()
+		y_real_, y_fake_ = y_real_.cuda(), y_fake_.cuda()
+	y_real_, y_fake_ = Variable(y_real_), Variable(y_fake_)
+
+	def gan_step(x_):
+		# one iteration of GAN.train
+		z_ = torch.rand((opts.batch_size, 62))
+		if gpu_mode:
+			x_, z_ = x_.cuda(), z_.cuda()
+		x_, z_ = Variable(x_), Variable(z_)
+		D_optimizer.zero_grad()
+		D_loss = BCE_loss(D(x_), y_real_) + BCE_loss(D(G(z_)), y_fake_)
+		D_loss.backward()
+		D_optimizer.step()
+		G_optimizer.zero_grad()
+		G_loss = BCE_loss(D(G(z_)), y_real_)
+		G_loss.backward()
+		G_optimizer.step()
+
+	for name, loader in loaders:
+		for step, label in [(lambda x_: None, 'data only'), (gan_step, 'GAN.py iteration')]:
+			time_start = time.time()
+			for iB, (x_, _) in enumerate(loader):
+				if iB == opts.n_iters:
+					break
+				step(x_)
+			if gpu_mode:
+				torch.cuda.synchronize()
+			print( '{} {}: {:.1f} iters/sec'.format(name, label, iB/(time.time()-time_start)) )
+
+def bench_image_folder(opts):
+	# ImageFolder decode + CenterCrop + Scale against the preprocessed store, on --image_folder_dir or synthetic jpgs
+	import preprocess
+	dir_tmp = tempfile.mkdtemp()
+	if len(opts.image_folder_dir) > 0:
+		dataroot_dir, dataset = os.path.split(os.path.normpath(opts.image_folder_dir))
+	else:
+		dataroot_dir, dataset = dir_tmp, 'celebA'
+		os.makedirs(os.path.join(dir_tmp, dataset, 'faces'))
+		rng = np.random.RandomState(0)
+		for i in range(opts.n_scans*8):
+			image = rng.randint(0, 256, (218,178,3)).astype(np.uint8)
+			Image.fromarray(image).save(os.path.join(dir_tmp, dataset, 'faces', '{:06d}.jpg'.format(i)))
+	store_opts = preprocess.argparse.Namespace(dataroot_dir=dataroot_dir, dataset=dataset, crop=160, scale=64,
+						num_workers=0, fname_store=os.path.join(dir_tmp, 'store'))
+	preprocess.preprocess_image_folder(store_opts)
+
+	transform = transforms.Compose([transforms.CenterCrop(160), transforms.Scale(64), transforms.ToTensor()])
+	for name, fname_store in [('ImageFolder', ''), ('image store', store_opts.fname_store)]:
+		for num_workers in [0, opts.num_workers]:
+			data_loader = utils.CustomDataLoader(os.path.join(dataroot_dir, dataset), transform, opts.batch_size, True,
+												num_workers=num_workers, fname_store=fname_store)
+			time_start = time.time()
+			nImages = sum(x.size(0) for x, _ in data_loader)
+			print( '{} num_workers={}: {:.1f} images/sec'.format(name, num_workers, nImages/(time.time()-time_start)) )
+	shutil.rmtree(dir_tmp)
+
+def prepare_batch_loop(y_, batch_size, Npcode, Nz, gpu_mode):
+	# per-tensor host construction and transfer the DRGAN3D family did before BatchPreparer, kept as reference
+	z_ = torch.rand((batch_size, Nz))
+	y_random_pcode_ = torch.floor(torch.rand(batch_size)*Npcode).long()
+	y_random_pcode_onehot_ = torch.zeros( batch_size, Npcode )
+	y_random_pcode_onehot_.scatter_(1, y_random_pcode_.view(-1,1), 1)
+	y_id_ = y_['id']
+	y_pcode_ = y_['pcode']
+	y_pcode_onehot_ = torch.zeros( batch_size, Npcode )
+	y_pcode_onehot_.scatter_(1, y_pcode_.view(-1,1), 1)
+	tensors = [y_id_, y_pcode_, y_pcode_onehot_, y_random_pcode_, y_random_pcode_onehot_, z_]
+	if gpu_mode:
+		tensors = [t.cuda() for t in tensors]
+	return [Variable(t) for t in tensors]
+
+def bench_batch_prep(opts):
+	gpu_mode = torch.cuda.is_available()
+	Npcode, Nz = 12, 50
+	y_ = {'id': torch.LongTensor(opts.batch_size).random_(0, 105), 'pcode': torch.LongTensor(opts.batch_size).random_(0, Npcode)}
+	prepare_batch = utils.BatchPreparer(opts.batch_size, Npcode, Nz, gpu_mode)
+	out = prepare_batch(y_)
+	assert (out[0].data.cpu() == y_['id']).all() and (out[2].data.cpu().max(1)[1] == y_['pcode']).all()
+	for name, func in [('per-tensor', lambda y: prepare_batch_loop(y, opts.batch_size, Npcode, Nz, gpu_mode)),
+						('BatchPreparer', prepare_batch)]:
+		time_start = time.time()
+		for _ in range(opts.n_iters*10):
+			func(y_)
+		if gpu_mode:
+			torch.cuda.synchronize()
+		print( '{} (gpu_mode={}): {:.1f} batches/sec'.format(name, gpu_mode, opts.n_iters*10/(time.time()-time_start)) )
+
+class SparseVoxelFaces(Dataset):
+	# (sparse voxel, labels, image) samples shaped like Bosphorus(sparse_voxel=True) items
+	def __init__(self, nSamples, shape=64, image_shape=256, seed=0):
+		self.nSamples = nSamples
+		self.shape = shape
+		self.image_shape = image_shape
+		self.seed = seed
+
+	def __len__(self):
+		return self.nSamples
+
+	def __getitem__(self, idx):
+		rng = np.random.RandomState(self.seed+idx)
+		cells = np.unique(rng.randint(0, self.shape**3, self.shape**3//20))
+		colors = rng.randint(0, 256, (len(cells), 3))
+		voxel = {'indices': torch.from_numpy(cells),
+				'values': torch.from_numpy(np.concatenate([np.ones(len(cells)), colors.T.ravel()/255.]).astype(np.float32)),
+				'size': torch.LongTensor([4, self.shape, self.shape, self.shape])}
+		image = torch.from_numpy(rng.rand(3, self.image_shape, self.image_shape).astype(np.float32))
+		return voxel, {'id': int(rng.randint(105)), 'pcode': int(rng.randint(12))}, image
+
+def bench_prefetch(opts):
+	gpu_mode = torch.cuda.is_available()
+	shape = int(opts.shapes.split(',')[0])
+	conv = torch.nn.Conv3d(4, 32, 4, 2, 1)
+	if gpu_mode:
+		conv.cuda()
+	loader = DataLoader(SparseVoxelFaces(opts.batch_size*(opts.n_iters+1), shape, opts.image_shape), batch_size=opts.batch_size,
+						shuffle=True, num_workers=opts.num_workers, collate_fn=utils.collate_voxel)
+	for depth in [0, 2]:
+		prefetcher = utils.Prefetcher(loader, depth, gpu_mode)
+		time_start = time.time()
+		for iB, (x3D_, y_, x2D_) in enumerate(prefetcher):
+			if iB == opts.n_iters:
+				break
+			x3D_ = utils.densify_voxel(x3D_)
+			if gpu_mode:
+				x3D_ = x3D_.cuda()
+			# stand-in for a D update of DRGAN3D
+			conv(Variable(x3D_)).mean().backward()
+		if gpu_mode:
+			torch.cuda.synchronize()
+		elapsed = time.time()-time_start
+		print( 'prefetch {} (gpu_mode={}): {:.1f} iters/sec, waited on data {:.2f} of {:.2f} sec'.format(
+				depth, gpu_mode, iB/elapsed, prefetcher.wait_time, elapsed) )
+
+def augment_sample_loop(voxel, max_shift=4, max_angle=10., color_jitter=0.1):
+	# per sample numpy/scipy augmentation as __getitem__ would do it, for comparison with utils.VoxelAugmenter
+	import scipy.ndimage
+	if np.random.rand() < 0.5:
+		voxel = voxel[:,::-1]
+	angles = np.deg2rad(np.random.uniform(-max_angle, max_angle, 3))
+	c, s = np.cos(angles), np.sin(angles)
+	R = np.array([[1,0,0],[0,c[0],-s[0]],[0,s[0],c[0]]]).dot(np.array([[c[1],0,s[1]],[0,1,0],[-s[1],0,c[1]]]))
+	center = (np.array(voxel.shape[1:])-1)/2.
+	voxel = np.stack([scipy.ndimage.affine_transform(channel, R, center-R.dot(center), order=1) for channel in voxel])
+	voxel[0] = voxel[0] > 0.5
+	for axis, shift in enumerate(np.random.randint(-max_shift, max_shift+1, 3)):
+		voxel = np.roll(voxel, shift, axis+1)
+	voxel[1:] = np.clip(voxel[1:]*np.random.uniform(1-color_jitter, 1+color_jitter, (3,1,1,1)), 0, 1)*voxel[0]
+	return voxel
+
+def bench_voxel_augment(opts):
+	gpu_mode = torch.cuda.is_available()
+	augment = utils.VoxelAugmenter(['flip', 'shift', 'rotate', 'color'], gpu_mode=gpu_mode)
+	for shape in [int(s) for s in opts.shapes.split(',')]:
+		voxel = torch.zeros(opts.batch_size, 4, shape, shape, shape)
+		voxel[:,:,shape//4:3*shape//4,shape//4:3*shape//4,shape//3:2*shape//3] = 0.5
+		n_repeat = max(1, opts.n_repeat//2)
+		time_start = time.time()
+		for _ in range(n_repeat):
+			np.stack([augment_sample_loop(v) for v in voxel.numpy()])
+		rate_loop = n_repeat*opts.batch_size/(time.time()-time_start)
+		if gpu_mode:
+			voxel = voxel.cuda()
+		augment(voxel)
+		time_start = time.time()
+		for _ in range(opts.n_repeat):
+			augment(voxel)
+		if gpu_mode:
+			torch.cuda.synchronize()
+		rate_batch = opts.n_repeat*opts.batch_size/(time.time()-time_start)
+		print( 'voxel augmentation {}^3 (gpu_mode={}): per sample {:.1f} samples/sec, batched {:.1f} samples/sec (x{:.1f})'.format(
+				shape, gpu_mode, rate_loop, rate_batch, rate_batch/rate_loop) )
+
+class PairStats(object):
+	# dataset statistics consumed by utils.PairwiseDistanceLoss
+	muA, stddevA, muB, stddevB = 30000., 5000., 200000., 40000.
+
+def dist_loss_loop(x2D_, x3D_hat, dataset, eps=1e-16):
+	# per sample loop of the dist option as DRGAN3D.train had it, for comparison with utils.PairwiseDistanceLoss
+	batch_size = x2D_.size(0)
+	nPairs = batch_size*(batch_size-1)
+	sumA = 0
+	sumB = 0
+	for iA in range(batch_size):
+		sumA += torch.norm((x2D_[iA]-x2D_+eps).view(batch_size,-1), 1, dim=1)
+		sumB += torch.norm((x3D_hat[iA]-x3D_hat+eps).view(batch_size,-1), 1, dim=1)
+	sumA = sumA/dataset.stddevA/nPairs
+	sumB = sumB/dataset.stddevB/nPairs
+	return torch.abs(torch.sum(sumA - sumB - dataset.muA/dataset.stddevA + dataset.muB/dataset.stddevB))/batch_size
+
+def bench_dist_loss(opts):
+	gpu_mode = torch.cuda.is_available()
+	dist_loss = utils.PairwiseDistanceLoss(PairStats)
+	for shape in [int(s) for s in opts.shapes.split(',')]:
+		x2D_ = torch.rand(opts.batch_size, 3, opts.image_shape, opts.image_shape)
+		x3D_hat = torch.rand(opts.batch_size, 4, shape, shape, shape)
+		if gpu_mode:
+			x2D_, x3D_hat = x2D_.cuda(), x3D_hat.cuda()
+		x3D_hat = Variable(x3D_hat, requires_grad=True)
+		rates = []
+		for loss in [lambda x2D_, x3D_hat: dist_loss_loop(x2D_, x3D_hat, PairStats), dist_loss]:
+			loss(x2D_, x3D_hat).backward()
+			time_start = time.time()
+			for _ in range(opts.n_repeat):
+				loss(x2D_, x3D_hat).backward()
+			if gpu_mode:
+				torch.cuda.synchronize()
+			rates.append(opts.n_repeat/(time.time()-time_start))
+		print( 'dist loss {}^3 batch {} (gpu_mode={}): loop {:.2f} iters/sec, pairwise {:.2f} iters/sec (x{:.1f})'.format(
+				shape, opts.batch_size, gpu_mode, rates[0], rates[1], rates[1]/rates[0]) )
+
+MNIST_GAN_TYPES = ['GAN', 'LSGAN', 'WGAN', 'WGAN_GP', 'DRAGAN', 'EBGAN', 'BEGAN', 'ACGAN', 'CGAN', 'infoGAN']
+
+def write_mnist(root_dir, rng):
+	# synthetic files in the load_mnist layout, <root_dir>/mnist/<name>.gz
+	data_dir = os.path.join(root_dir, 'mnist')
+	os.makedirs(data_dir)
+	for name, nSamples, head_size, data_size, high in [('train-images-idx3-ubyte', 60000, 16, 28*28, 256),
+														('train-labels-idx1-ubyte', 60000, 8, 1, 10),
+														('t10k-images-idx3-ubyte', 10000, 16, 28*28, 256),
+														('t10k-labels-idx1-ubyte', 10000, 8, 1, 10)]:
+		with gzip.open(os.path.join(data_dir, name+'.gz'), 'wb', compresslevel=1) as f:
+			f.write(b'\0'*head_size)
+			f.write(rng.randint(0, high, nSamples*data_size).astype(np.uint8).tobytes())
+
+def mnist_model(gan_type, opts, root_dir, fuse_step, gpu_mode):
+	# the model main.py builds for --dataset mnist, its data cut to opts.n_iters batches
+	module = importlib.import_module(gan_type)
+	args = argparse.Namespace(gan_type=gan_type, dataset='mnist', dataroot_dir=root_dir, epoch=1, batch_size=opts.batch_size,
+							save_dir=os.path.join(root_dir, 'models'), result_dir=os.path.join(root_dir, 'results'),
+							log_dir=os.path.join(root_dir, 'logs'), lrG=0.0002, lrD=0.0002, beta1=0.5, beta2=0.999,
+							gpu_mode=gpu_mode, num_workers=0, comment='', fname_image_store='', fuse_step=fuse_step,
+							flush_metrics=100, keep_last=1, keep_every=0)
+	gan = getattr(module, gan_type)(args)
+	nSamples = opts.n_iters*opts.batch_size
+	if hasattr(gan, 'data_X'):
+		gan.data_X, gan.data_Y = gan.data_X[:nSamples], gan.data_Y[:nSamples]
+	else:
+		gan.data_loader = utils.TensorLoader(gan.data_loader.data[:nSamples], gan.data_loader.labels[:nSamples],
+											opts.batch_size, gpu_mode=gpu_mode)
+	return gan
+
+def train_loop_secs(gan_type, opts, root_dir, fuse_step, gpu_mode):
+	# sec/iter of one epoch of the model's own train(), without the visualization and saving after it
+	torch.manual_seed(0)
+	gan = mnist_model(gan_type, opts, root_dir, fuse_step, gpu_mode)
+	gan.train()
+	return gan.train_hist['per_epoch_time'][0]/opts.n_iters
+
+def adversarial_step(G, Ds, G_inputs, reals, optimizers, fuse_step):
+	# one D and one G update with every output of G judged by its discriminator in Ds,
+	# the generator pass shared by both in fuse_step mode
+	G_optimizer, D_optimizer = optimizers
+	def critic(D, x):
+		out = D(x)
+		return torch.mean(out[0] if isinstance(out, tuple) else out)
+	def generate():
+		outputs = G(*G_inputs)
+		return outputs if isinstance(outputs, tuple) else (outputs,)
+	D_optimizer.zero_grad()
+	fakes = generate()
+	if fuse_step:
+		fakes_fused, fakes = fakes, [fake.detach() for fake in fakes]
+	D_loss = sum(critic(D, fake) - critic(D, real) for D, fake, real in zip(Ds, fakes, reals))
+	D_loss.backward()
+	D_optimizer.step()
+
+	G_optimizer.zero_grad()
+	if fuse_step:
+		fakes = fakes_fused
+	else:
+		fakes = generate()
+	G_loss = -sum(critic(D, fake) for D, fake in zip(Ds, fakes))
+	G_loss.backward()
+	G_optimizer.step()
+
+def step_model(gan_type, opts):
+	# generator, discriminators and generator inputs of the models whose train() needs Bosphorus
+	batch_size = opts.batch_size
+	Nid, Npcode, Nz = 105, 48, 50
+	x2D_ = torch.rand(batch_size, 3, 256, 256)
+	y_pcode_onehot_ = torch.eye(Npcode)[torch.arange(batch_size) % Npcode]
+	if gan_type == 'DRGAN3D':
+		import DRGAN3D
+		return DRGAN3D.generator(Nid, Npcode, Nz), [DRGAN3D.discriminator(Nid, Npcode)], \
+				[x2D_, y_pcode_onehot_, torch.rand(batch_size, Nz)]
+	if gan_type == 'DRecon3DGAN':
+		import DRecon3DGAN
+		return DRecon3DGAN.generator2d3d(320, Nid, Npcode, nOutputCh={'2d':3,'3d':1}), \
+				[DRecon3DGAN.discriminator2d(Nid, Npcode, nInputCh=3), DRecon3DGAN.discriminator3d(Nid, Npcode, nInputCh=1)], \
+				[x2D_, y_pcode_onehot_]
+	exit('no fused_step benchmark for ' + gan_type)
+
+def adversarial_step_secs(gan_type, opts, fuse_step, gpu_mode):
+	torch.manual_seed(0)
+	G, Ds, G_inputs = step_model(gan_type, opts)
+	if gpu_mode:
+		G, Ds, G_inputs = G.cuda(), [D.cuda() for D in Ds], [v.cuda() for v in G_inputs]
+	G_inputs = [Variable(v) for v in G_inputs]
+	with torch.no_grad():
+		outputs = G(*G_inputs)
+	reals = [Variable(torch.rand_like(output)) for output in (outputs if isinstance(outputs, tuple) else (outputs,))]
+	optimizers = (torch.optim.Adam(G.parameters()), torch.optim.Adam(itertools.chain(*[D.parameters() for D in Ds])))
+	adversarial_step(G, Ds, G_inputs, reals, optimizers, fuse_step)
+	time_start = time.time()
+	for _ in range(opts.n_repeat):
+		adversarial_step(G, Ds, G_inputs, reals, optimizers, fuse_step)
+	if gpu_mode:
+		torch.cuda.synchronize()
+	return (time.time()-time_start)/opts.n_repeat
+
+def bench_fused_step(opts):
+	gpu_mode = torch.cuda.is_available()
+	root_dir = tempfile.mkdtemp()
+	try:
+		gan_types = opts.gan_types.split(',')
+		if any(gan_type in MNIST_GAN_TYPES for gan_type in gan_types):
+			write_mnist(root_dir, np.random.RandomState(0))
+		for gan_type in gan_types:
+			if gan_type in MNIST_GAN_TYPES:
+				secs = [train_loop_secs(gan_type, opts, root_dir, fuse_step, gpu_mode) for fuse_step in [False, True]]
+				loop = 'train()'
+			else:
+				secs = [adversarial_step_secs(gan_type, opts, fuse_step, gpu_mode) for fuse_step in [False, True]]
+				loop = 'generic step'
+			print( '{} {} batch {} (gpu_mode={}): {:.3f} sec/iter, fused {:.3f} sec/iter, saved {:.3f} sec/iter (x{:.2f})'.format(
+					gan_type, loop, opts.batch_size, gpu_mode, secs[0], secs[1], secs[0]-secs[1], secs[0]/secs[1]) )
+	finally:
+		shutil.rmtree(root_dir)
+
+"""parsing and configuration"""
+def parse_opts():
+	desc = "throughput benchmarks of data loading"
+	parser = argparse.ArgumentParser(description=desc)
+
+	parser.add_argument('--target', type=str, default='bnt2voxel', choices=['bnt2voxel', 'bnt2voxel_wColor', 'read_bnt', 'voxel_dtype',
+								'bosphorus_image', 'binvox', 'mnist_loader', 'image_folder',
+								'batch_prep', 'prefetch', 'voxel_augment', 'dist_loss', 'fused_step'],
+						help='what to benchmark')
+	parser.add_argument('--fname_bnt', type=str, default='', help='comma separated .bnt files, synthetic scans if empty')
+	parser.add_argument('--dataroot_dir', type=str, default='', help='Bosphorus root to scan for .bnt files')
+	parser.add_argument('--n_scans', type=int, default=8, help='number of synthetic scans')
+	parser.add_argument('--n_repeat', type=int, default=5, help='number of repetitions for fast paths')
+	parser.add_argument('--batch_size', type=int, default=20, help='The size of batch')
+	parser.add_argument('--image_folder_dir', type=str, default='', help='ImageFolder dataset, ex)data/celebA, synthetic jpgs if empty')
+	parser.add_argument('--num_workers', type=int, default=4, help='number of processes for DataLoader')
+	parser.add_argument('--n_iters', type=int, default=200, help='number of iterations for training loop benchmarks')
+	parser.add_argument('--shapes', type=str, default='64,128', help='comma separated voxel resolutions')
+	parser.add_argument('--binvox_resolution', type=int, default=128, help='resolution of synthetic .binvox models')
+	parser.add_argument('--image_shape', type=int, default=256, help='size of resized and padded face images')
+	parser.add_argument('--gan_types', type=str, default=','.join(MNIST_GAN_TYPES+['DRGAN3D', 'DRecon3DGAN']),
+						help='comma separated models for fused_step, those trained on mnist run their own train()')
+
+	return check_opts(parser.parse_args())
+
+"""checking arguments"""
+def check_opts(opts):
+	return opts
+
+def main():
+	opts = parse_opts()
+	if opts is None:
+		exit()
+
+	if opts.target == 'bnt2voxel':
+		bench_bnt2voxel(opts)
+	elif opts.target == 'bnt2voxel_wColor':
+		bench_bnt2voxel_wColor(opts)
+	elif opts.target == 'read_bnt':
+		bench_read_bnt(opts)
+	elif opts.target == 'voxel_dtype':
+		bench_voxel_dtype(opts)
+	elif opts.target == 'bosphorus_image':
+		bench_bosphorus_image(opts)
+	elif opts.target == 'binvox':
+		bench_binvox(opts)
+	elif opts.target == 'mnist_loader':
+		bench_mnist_loader(opts)
+	elif opts.target == 'image_folder':
+		bench_image_folder(opts)
+	elif opts.target == 'batch_prep':
+		bench_batch_prep(opts)
+	elif opts.target == 'prefetch':
+		bench_prefetch(opts)
+	elif opts.target == 'voxel_augment':
+		bench_voxel_augment(opts)
+	elif opts.target == 'dist_loss':
+		bench_dist_loss(opts)
+	elif opts.target == 'fused_step':
+		bench_fused_step(opts)
+
+if __name__ == '__main__':
+	main()
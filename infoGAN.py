@@ -1,4 +1,4 @@
-import utils, torch, time, os, pickle, itertools
+import utils, torch, time, os, itertools
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
@@ -92,6 +92,8 @@ class infoGAN(object):
         self.dataset = args.dataset
         self.log_dir = args.log_dir
         self.gpu_mode = args.gpu_mode
+        self.flush_metrics = args.flush_metrics
+        self.fuse_step = args.fuse_step
         self.model_name = args.gan_type
         self.SUPERVISED = SUPERVISED        # if it is true, label info is directly used for code
         self.len_discrete_code = 10         # categorical distribution (i.e. label)
@@ -103,6 +105,9 @@ class infoGAN(object):
         self.G_optimizer = optim.Adam(self.G.parameters(), lr=args.lrG, betas=(args.beta1, args.beta2))
         self.D_optimizer = optim.Adam(self.D.parameters(), lr=args.lrD, betas=(args.beta1, args.beta2))
         self.info_optimizer = optim.Adam(itertools.chain(self.G.parameters(), self.D.parameters()), lr=args.lrD, betas=(args.beta1, args.beta2))
+        self.checkpointer = utils.Checkpointer( os.path.join(self.save_dir, self.dataset, self.model_name), self.model_name,
+                                                {'G': self.G, 'D': self.D},
+                                                {'G': self.G_optimizer, 'D': self.D_optimizer, 'info': self.info_optimizer}, args.keep_last, args.keep_every )
 
         if self.gpu_mode:
             self.G.cuda()
@@ -174,7 +179,7 @@ class infoGAN(object):
                 Variable(self.sample_y2_, volatile=True), Variable(self.sample_c2_, volatile=True)
 
     def train(self):
-        self.train_hist = {}
+        self.train_hist = utils.MetricStore( os.path.join(self.save_dir, self.dataset, self.model_name, self.model_name + '_metrics'), self.flush_metrics )
         self.train_hist['D_loss'] = []
         self.train_hist['G_loss'] = []
         self.train_hist['info_loss'] = []
@@ -217,11 +222,13 @@ class infoGAN(object):
                 D_real_loss = self.BCE_loss(D_real, self.y_real_)
 
                 G_ = self.G(z_, y_cont_, y_disc_)
+                if self.fuse_step:
+                    G_fused, G_ = G_, G_.detach()
                 D_fake, _, _ = self.D(G_)
                 D_fake_loss = self.BCE_loss(D_fake, self.y_fake_)
 
                 D_loss = D_real_loss + D_fake_loss
-                self.train_hist['D_loss'].append(D_loss.data[0])
+                self.train_hist['D_loss'].append(D_loss.data)
 
                 D_loss.backward(retain_graph=True)
                 self.D_optimizer.step()
@@ -229,11 +236,14 @@ class infoGAN(object):
                 # update G network
                 self.G_optimizer.zero_grad()
 
-                G_ = self.G(z_, y_cont_, y_disc_)
+                if self.fuse_step:
+                    G_ = G_fused
+                else:
+                    G_ = self.G(z_, y_cont_, y_disc_)
                 D_fake, D_cont, D_disc = self.D(G_)
 
                 G_loss = self.BCE_loss(D_fake, self.y_real_)
-                self.train_hist['G_loss'].append(G_loss.data[0])
+                self.train_hist['G_loss'].append(G_loss.data)
 
                 G_loss.backward(retain_graph=True)
                 self.G_optimizer.step()
@@ -242,7 +252,7 @@ class infoGAN(object):
                 disc_loss = self.CE_loss(D_disc, torch.max(y_disc_, 1)[1])
                 cont_loss = self.MSE_loss(D_cont, y_cont_)
                 info_loss = disc_loss + cont_loss
-                self.train_hist['info_loss'].append(info_loss.data[0])
+                self.train_hist['info_loss'].append(info_loss.data)
 
                 info_loss.backward()
                 self.info_optimizer.step()
@@ -261,6 +271,7 @@ class infoGAN(object):
         print("Training finish!... save training results")
 
         self.save()
+        self.checkpointer.wait()
         utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name,
                                  self.epoch)
         utils.generate_animation(self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name + '_cont',
@@ -296,22 +307,10 @@ class infoGAN(object):
                           self.result_dir + '/' + self.dataset + '/' + self.model_name + '/' + self.model_name + '_cont_epoch%03d' % epoch + '.png')
 
     def save(self):
-        save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-
-        torch.save(self.G.state_dict(), os.path.join(save_dir, self.model_name + '_G.pkl'))
-        torch.save(self.D.state_dict(), os.path.join(save_dir, self.model_name + '_D.pkl'))
-
-        with open(os.path.join(save_dir, self.model_name + '_history.pkl'), 'wb') as f:
-            pickle.dump(self.train_hist, f)
+        self.checkpointer.save( self.train_hist )
 
     def load(self):
-        save_dir = os.path.join(self.save_dir, self.dataset, self.model_name)
-
-        self.G.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_G.pkl')))
-        self.D.load_state_dict(torch.load(os.path.join(save_dir, self.model_name + '_D.pkl')))
+        self.checkpointer.load()
 
     def loss_plot(self, hist, path='Train_hist.png', model_name=''):
         x = range(len(hist['D_loss']))
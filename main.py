@@ -51,6 +51,7 @@ def parse_args():
 						choices=['mnist', 'fashion-mnist', 'celebA', 'MultiPie', 'miniPie', 'CASIA-WebFace','ShapeNet', 'Bosphorus'],
 						help='The name of dataset')
 	parser.add_argument('--synsetId', type=str, default='chair', help='synsetId of ShapeNet')
+	parser.add_argument('--voxel_cache_dir', type=str, default='cache_ShapeNet_voxel', help='decoded ShapeNet voxels per resolution, empty to disable')
 	parser.add_argument('--dataroot_dir', type=str, default='data', help='root path of data')
 	parser.add_argument('--epoch', type=int, default=25, help='The number of epochs to run')
 	parser.add_argument('--batch_size', type=int, default=64, help='The size of batch')
@@ -68,13 +69,30 @@ def parse_args():
 	parser.add_argument('--gpu_mode', type=str2bool, default=True)
 	parser.add_argument('--multi_gpu', type=str2bool, default=False)
 	parser.add_argument('--num_workers', type=int, default='1', help='number of threads for DataLoader')
+	parser.add_argument('--prefetch', type=int, default=2, help='batches prepared ahead of the training loop, 0 to load synchronously')
 	parser.add_argument('--comment', type=str, default='', help='comment to put on model_name')
 	parser.add_argument('--fname_cache', type=str, default='', help='filename of cached datalist, ex)cache_Bosphorus.txt')
+	parser.add_argument('--fname_store', type=str, default='', help='preprocessed voxel store from preprocess.py, ex)store_Bosphorus_128_center1_color1')
+	parser.add_argument('--fname_image_store', type=str, default='', help='preprocessed image store from preprocess.py (Bosphorus faces, celebA, ...), ex)store_BosphorusImage_256')
+	parser.add_argument('--dir_shards', type=str, default='', help='Bosphorus shard store from preprocess.py, ex)shards_Bosphorus_128_256_center1_color1')
+	parser.add_argument('--shuffle_buffer', type=int, default=256, help='records in the shuffle buffer of the shard reader and of streams')
+	parser.add_argument('--stream', type=str2bool, default=False, help='stream Bosphorus shards, ShapeNet and MultiPie directories split across workers and ranks')
+	parser.add_argument('--sparse_voxel', type=str2bool, default=False, help='Bosphorus and ShapeNet samples as coordinate lists, densified per batch')
+	parser.add_argument('--compact_voxel', type=str2bool, default=False, help='keep voxels uint8 on host, convert to float per batch')
 	parser.add_argument('--resume', type=str2bool, default=False, help='resume training from saved model')
+	parser.add_argument('--save_every', type=int, default=0, help='also save the model every n batches, to resume within an epoch')
+	parser.add_argument('--keep_last', type=int, default=3, help='number of latest checkpoints kept')
+	parser.add_argument('--keep_every', type=int, default=0, help='also keep the checkpoint of every n-th epoch, 0 for none')
+	parser.add_argument('--flush_metrics', type=int, default=100, help='loss values and D accuracies kept on device before they are copied into the history and the D_acc gate')
+	parser.add_argument('--augment_voxel', type=str, default='', help='comma separated batch augmentations of real voxels: flip,shift,rotate,color')
+	parser.add_argument('--augment_shift', type=int, default=4, help='largest voxel translation of shift augmentation')
+	parser.add_argument('--augment_angle', type=float, default=10., help='largest angle in degrees of rotate augmentation')
+	parser.add_argument('--augment_color', type=float, default=0.1, help='largest gain and offset change of color augmentation')
 	parser.add_argument('--centerBosphorus', type=str2bool, default=True, help='center Bosphorus PCL in voxel space')
 	parser.add_argument('--loss_option', type=str, default='', help='recon,dist,GP(omitted)')
 	parser.add_argument('--n_critic', type=int, default=1, help='n_critic')
 	parser.add_argument('--n_gen', type=int, default=1, help='n_gen')
+	parser.add_argument('--fuse_step', type=str2bool, default=False, help='run G once per batch, detached for the D update and reused by the first G update. DRGAN3D and DRecon3DGAN then train D on the pose codes of the G update instead of random ones')
 	parser.add_argument('--nDaccAvg', type=int, default=5, help='number of batches for moving averaging D_acc')
 
 	# below arguments are for eval mode
@@ -0,0 +1,281 @@
+from __future__ import print_function
+import argparse, os, sys, time, pickle
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+from torchvision import datasets, transforms
+
+import utils
+from utils3D.voxel_store import VoxelStoreWriter, write_mip_level
+from utils3D.image_store import ImageStoreWriter
+from utils3D.shard_store import ShardWriter
+from utils3D.pair_stats import PairSamples, pairwise_l1_stats
+
+def str2bool(v):
+	if v.lower() in ('yes', 'true', 't', 'y', '1'):
+		return True
+	elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+		return False
+	else:
+		raise argparse.ArgumentTypeError('Boolean value expected.')
+
+def preprocess_bosphorus_voxel(opts):
+	data_dir = os.path.join( opts.dataroot_dir, 'Bosphorus' )
+	dataset = utils.Bosphorus( data_dir, use_image=False, use_colorPCL=opts.use_colorPCL,
+								fname_cache=opts.fname_cache, transform=transforms.ToTensor(),
+								shape=opts.shape, center=opts.centerBosphorus )
+	data_loader = DataLoader( dataset, batch_size=1, shuffle=False, num_workers=opts.num_workers )
+
+	nChannels = 4 if opts.use_colorPCL else 1
+	meta = { 'filenames': dataset.filenames,
+				'center': opts.centerBosphorus,
+				'use_colorPCL': opts.use_colorPCL }
+	writer = VoxelStoreWriter( opts.fname_store, len(dataset), opts.shape, nChannels,
+								label_keys=['id', 'pclass', 'pcode'], meta=meta )
+
+	time_start = time.time()
+	for iS, (voxel, labels) in enumerate(data_loader):
+		writer.append( voxel[0].numpy(), [int(labels[key][0]) for key in writer.label_keys] )
+		if ((iS + 1) % 100) == 0:
+			print( '[{}/{}] {:.1f} samples/sec'.format(iS+1, len(dataset), (iS+1)/(time.time()-time_start)) )
+			sys.stdout.flush()
+	writer.close()
+	print( '{} samples stored in {}'.format(len(dataset), opts.fname_store) )
+
+	# coarser shapes are pooled from the stored one, precomputed levels only save the pooling while training
+	for shape in opts.mip_levels:
+		time_start = time.time()
+		write_mip_level( opts.fname_store, shape )
+		print( 'shape={} pooled in {:.0f}sec'.format(shape, time.time()-time_start) )
+
+class BosphorusImages( Dataset ):
+	# face images of a Bosphorus file list, resized and padded as Bosphorus(use_image=True) does
+	def __init__( self, filenames, suffix, image_shape ):
+		self.filenames = filenames
+		self.suffix = suffix
+		self.image_shape = image_shape
+
+	def __len__( self ):
+		return len( self.filenames )
+
+	def __getitem__( self, idx ):
+		image = Image.open( self.filenames[idx][:-len(self.suffix)]+'.png' )
+		return torch.from_numpy( utils.resize_pad_image( image, self.image_shape ) )
+
+def preprocess_bosphorus_image(opts):
+	data_dir = os.path.join( opts.dataroot_dir, 'Bosphorus' )
+	dataset = utils.Bosphorus( data_dir, use_image=False, fname_cache=opts.fname_cache, image_shape=opts.image_shape )
+	images = BosphorusImages( dataset.filenames, dataset.suffix, opts.image_shape )
+	data_loader = DataLoader( images, batch_size=1, shuffle=False, num_workers=opts.num_workers )
+
+	writer = ImageStoreWriter( opts.fname_store, dataset.filenames, opts.image_shape )
+
+	time_start = time.time()
+	for iS, image in enumerate(data_loader):
+		writer.append( image[0].numpy() )
+		if ((iS + 1) % 100) == 0:
+			print( '[{}/{}] {:.1f} images/sec'.format(iS+1, len(images), (iS+1)/(time.time()-time_start)) )
+			sys.stdout.flush()
+	writer.close()
+	print( '{} images stored in {}'.format(len(images), opts.fname_store) )
+
+class GrayImages( Dataset ):
+	# grayscale images of a file list after the deterministic head of a training transform
+	def __init__( self, filenames, transform ):
+		self.filenames = filenames
+		self.transform = transform
+
+	def __len__( self ):
+		return len( self.filenames )
+
+	def __getitem__( self, idx ):
+		image = self.transform( Image.open( self.filenames[idx] ).convert('L') )
+		return torch.from_numpy( np.array( image, dtype=np.uint8 )[:,:,None] )
+
+def preprocess_multipie_image(opts):
+	data_dir = os.path.join( opts.dataroot_dir, opts.dataset )
+	cam_ids = [int(cam) for cam in opts.cam_ids.split(',')] if len(opts.cam_ids) > 0 else None
+	dataset = utils.MultiPie( data_dir, cam_ids=cam_ids, fname_cache=opts.fname_cache )
+	pre_transforms = [transforms.Scale(opts.scale)]
+	images = GrayImages( dataset.filenames, transforms.Compose(pre_transforms) )
+	data_loader = DataLoader( images, batch_size=1, shuffle=False, num_workers=opts.num_workers )
+
+	image_shape = tuple( images[0].size()[:2] )
+	meta = { 'pre_transforms': [utils.transform_key(t) for t in pre_transforms] }
+	writer = ImageStoreWriter( opts.fname_store, dataset.filenames, image_shape, nChannels=1, meta=meta )
+
+	time_start = time.time()
+	for iS, image in enumerate(data_loader):
+		writer.append( image[0].numpy() )
+		if ((iS + 1) % 1000) == 0:
+			print( '[{}/{}] {:.1f} images/sec'.format(iS+1, len(images), (iS+1)/(time.time()-time_start)) )
+			sys.stdout.flush()
+	writer.close()
+	print( '{} images of {}x{} stored in {}'.format(len(images), image_shape[0], image_shape[1], opts.fname_store) )
+
+def pil_to_uint8(image):
+	return torch.from_numpy( np.array( image.convert('RGB'), dtype=np.uint8 ) )
+
+def preprocess_image_folder(opts):
+	data_dir = os.path.join( opts.dataroot_dir, opts.dataset )
+	pre_transforms = []
+	if opts.crop > 0:
+		pre_transforms.append( transforms.CenterCrop(opts.crop) )
+	pre_transforms.append( transforms.Scale(opts.scale) )
+	dataset = datasets.ImageFolder( data_dir, transforms.Compose(pre_transforms + [transforms.Lambda(pil_to_uint8)]) )
+	data_loader = DataLoader( dataset, batch_size=1, shuffle=False, num_workers=opts.num_workers )
+
+	image_shape = tuple( dataset[0][0].size()[:2] )
+	meta = { 'classes': dataset.classes,
+				'targets': [target for path, target in dataset.imgs],
+				'pre_transforms': [utils.transform_key(t) for t in pre_transforms] }
+	writer = ImageStoreWriter( opts.fname_store, [path for path, target in dataset.imgs], image_shape, meta=meta )
+
+	time_start = time.time()
+	for iS, (image, target) in enumerate(data_loader):
+		writer.append( image[0].numpy() )
+		if ((iS + 1) % 1000) == 0:
+			print( '[{}/{}] {:.1f} images/sec'.format(iS+1, len(dataset), (iS+1)/(time.time()-time_start)) )
+			sys.stdout.flush()
+	writer.close()
+	print( '{} images of {}x{} stored in {}'.format(len(dataset), image_shape[0], image_shape[1], opts.fname_store) )
+
+def first_sample(batch):
+	return batch[0]
+
+def preprocess_bosphorus_shards(opts):
+	data_dir = os.path.join( opts.dataroot_dir, 'Bosphorus' )
+	dataset = utils.Bosphorus( data_dir, use_image=True, use_colorPCL=opts.use_colorPCL,
+								fname_cache=opts.fname_cache, fname_image_store=opts.fname_image_store,
+								transform=transforms.ToTensor(), shape=opts.shape, image_shape=opts.image_shape,
+								center=opts.centerBosphorus, sparse=True, compact=True )
+	# records are written in a fixed random order so that every shard mixes subjects and expressions
+	order = np.random.RandomState(opts.seed).permutation(len(dataset)).tolist()
+	data_loader = DataLoader( dataset, batch_size=1, sampler=order, num_workers=opts.num_workers,
+								collate_fn=first_sample )
+
+	nChannels = 4 if opts.use_colorPCL else 1
+	meta = { 'filenames': [dataset.filenames[i] for i in order],
+				'poseclasses': dataset.poseclasses,
+				'posecodes': dataset.posecodes,
+				'stats': {'muA': dataset.muA, 'muB': dataset.muB, 'stddevA': dataset.stddevA, 'stddevB': dataset.stddevB},
+				'center': opts.centerBosphorus,
+				'use_colorPCL': opts.use_colorPCL }
+	writer = ShardWriter( opts.fname_store, opts.shape, opts.image_shape, nChannels,
+							label_keys=['id', 'pclass', 'pcode'], meta=meta, shard_size=opts.shard_size )
+
+	time_start = time.time()
+	for iS, (voxel, labels, image) in enumerate(data_loader):
+		image = np.rint( image.numpy().transpose(1,2,0)*255 ).astype(np.uint8)
+		colors = voxel['values'].numpy().reshape(nChannels, -1)[1:].T
+		writer.append( image, voxel['indices'].numpy(), colors, [labels[key] for key in writer.label_keys] )
+		if ((iS + 1) % 100) == 0:
+			print( '[{}/{}] {:.1f} samples/sec'.format(iS+1, len(dataset), (iS+1)/(time.time()-time_start)) )
+			sys.stdout.flush()
+	writer.close()
+	print( '{} samples stored in {} shards of {}'.format(len(dataset), writer.nShards, opts.fname_store) )
+
+def preprocess_bosphorus_stats(opts):
+	data_dir = os.path.join( opts.dataroot_dir, 'Bosphorus' )
+	dataset = utils.Bosphorus( data_dir, use_image=True, use_colorPCL=opts.use_colorPCL,
+								fname_cache=opts.fname_cache, fname_image_store=opts.fname_image_store,
+								transform=transforms.ToTensor(), shape=opts.shape, image_shape=opts.image_shape,
+								center=opts.centerBosphorus, sparse=True, compact=True )
+	order = np.arange(len(dataset))
+	if 0 < opts.stats_samples < len(dataset):
+		order = np.sort( np.random.RandomState(opts.seed).choice(len(dataset), opts.stats_samples, replace=False) )
+	data_loader = DataLoader( dataset, batch_size=1, sampler=order.tolist(), num_workers=opts.num_workers,
+								collate_fn=first_sample )
+
+	nChannels = 4 if opts.use_colorPCL else 1
+	images = np.empty( (len(order), opts.image_shape*opts.image_shape*3), dtype=np.uint8 )
+	cells, colors = [], []
+	time_start = time.time()
+	for iS, (voxel, labels, image) in enumerate(data_loader):
+		images[iS] = np.rint( image.numpy()*255 ).reshape(-1)
+		cells.append( voxel['indices'].numpy() )
+		colors.append( voxel['values'].numpy().reshape(nChannels, -1)[1:].T )
+	print( '{} samples loaded in {:.0f}sec'.format(len(order), time.time()-time_start) )
+
+	time_start = time.time()
+	stats = pairwise_l1_stats( PairSamples(images, cells, colors, opts.shape**3), num_workers=opts.num_workers )
+	print( '{} pairs in {:.0f}sec : muA {:.2f} stddevA {:.2f} muB {:.2f} stddevB {:.2f}'.format(stats['nPairs'],
+			time.time()-time_start, stats['muA'], stats['stddevA'], stats['muB'], stats['stddevB']) )
+	with open( opts.fname_stats, 'wb' ) as f:
+		pickle.dump( stats, f, protocol=2 )
+	print( 'written to {}'.format(opts.fname_stats) )
+
+"""parsing and configuration"""
+def parse_opts():
+	desc = "one-time conversion of datasets into preprocessed stores"
+	parser = argparse.ArgumentParser(description=desc)
+
+	parser.add_argument('--target', type=str, default='bosphorus_voxel', choices=['bosphorus_voxel', 'bosphorus_image', 'bosphorus_shards', 'image_folder',
+								'multipie_image', 'bosphorus_stats'],
+						help='what to preprocess')
+	parser.add_argument('--dataroot_dir', type=str, default='data', help='root path of data')
+	parser.add_argument('--dataset', type=str, default='celebA', help='dataset under dataroot_dir for image_folder and multipie_image')
+	parser.add_argument('--cam_ids', type=str, default='', help='comma separated MultiPie cameras for multipie_image, default cameras if empty')
+	parser.add_argument('--crop', type=int, default=160, help='center crop before scaling for image_folder, 0 to skip')
+	parser.add_argument('--scale', type=int, default=64, help='size after scaling for image_folder')
+	parser.add_argument('--fname_cache', type=str, default='', help='filename of cached datalist, ex)cache_Bosphorus.txt')
+	parser.add_argument('--fname_store', type=str, default='', help='directory of the store to write')
+	parser.add_argument('--shape', type=int, default=128, help='voxel resolution')
+	parser.add_argument('--mip_levels', type=str, default='', help='comma separated coarser shapes to precompute in the voxel store, ex)64,32')
+	parser.add_argument('--fname_image_store', type=str, default='', help='image store to read face images from, ex)store_BosphorusImage_256')
+	parser.add_argument('--shard_size', type=int, default=256, help='number of records per shard')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the record order in shards and of the samples for stats')
+	parser.add_argument('--fname_stats', type=str, default='', help='distance statistics to write, <dataroot_dir>/Bosphorus/stats.pkl if empty')
+	parser.add_argument('--stats_samples', type=int, default=1000, help='number of randomly chosen samples whose pairs make the statistics, 0 for all')
+	parser.add_argument('--image_shape', type=int, default=256, help='size of resized and padded face images')
+	parser.add_argument('--centerBosphorus', type=str2bool, default=True, help='center Bosphorus PCL in voxel space')
+	parser.add_argument('--use_colorPCL', type=str2bool, default=True, help='store colors of occupied voxels')
+	parser.add_argument('--num_workers', type=int, default=4, help='number of processes for DataLoader')
+
+	return check_opts(parser.parse_args())
+
+"""checking arguments"""
+def check_opts(opts):
+	if len(opts.fname_store) == 0 and opts.target == 'bosphorus_voxel':
+		opts.fname_store = 'store_Bosphorus_{}_center{}_color{}'.format(opts.shape,
+								int(opts.centerBosphorus), int(opts.use_colorPCL))
+	elif len(opts.fname_store) == 0 and opts.target == 'bosphorus_image':
+		opts.fname_store = 'store_BosphorusImage_{}'.format(opts.image_shape)
+	elif len(opts.fname_store) == 0 and opts.target == 'bosphorus_shards':
+		opts.fname_store = 'shards_Bosphorus_{}_{}_center{}_color{}'.format(opts.shape, opts.image_shape,
+								int(opts.centerBosphorus), int(opts.use_colorPCL))
+	elif len(opts.fname_store) == 0 and opts.target == 'image_folder':
+		opts.fname_store = 'store_{}_crop{}_scale{}'.format(opts.dataset, opts.crop, opts.scale)
+	elif len(opts.fname_store) == 0 and opts.target == 'multipie_image':
+		opts.fname_store = 'store_{}_gray_scale{}'.format(opts.dataset, opts.scale)
+	opts.mip_levels = [ int(shape) for shape in opts.mip_levels.split(',') if len(shape) > 0 ]
+	for shape in opts.mip_levels:
+		if shape >= opts.shape or opts.shape % shape != 0:
+			print( 'mip level {} does not divide shape={}'.format(shape, opts.shape) )
+			return None
+	if len(opts.fname_stats) == 0:
+		opts.fname_stats = os.path.join( opts.dataroot_dir, 'Bosphorus', 'stats.pkl' )
+	print( opts )
+	return opts
+
+def main():
+	opts = parse_opts()
+	if opts is None:
+		exit()
+
+	if opts.target == 'bosphorus_voxel':
+		preprocess_bosphorus_voxel(opts)
+	elif opts.target == 'bosphorus_image':
+		preprocess_bosphorus_image(opts)
+	elif opts.target == 'bosphorus_shards':
+		preprocess_bosphorus_shards(opts)
+	elif opts.target == 'image_folder':
+		preprocess_image_folder(opts)
+	elif opts.target == 'multipie_image':
+		preprocess_multipie_image(opts)
+	elif opts.target == 'bosphorus_stats':
+		preprocess_bosphorus_stats(opts)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,27 @@
+python preprocess.py \
+ --target bosphorus_voxel \
+ --dataroot_dir data \
+ --shape 128 \
+ --mip_levels 64 \
+ --num_workers 4
+# then train with --fname_store store_Bosphorus_128_center1_color1 at shape 128 or 64
+python preprocess.py \
+ --target bosphorus_image \
+ --dataroot_dir data \
+ --image_shape 256 \
+ --num_workers 4
+# then train with --fname_image_store store_BosphorusImage_256
+python preprocess.py \
+ --target bosphorus_stats \
+ --dataroot_dir data \
+ --fname_image_store store_BosphorusImage_256 \
+ --shape 128 \
+ --num_workers 4
+# writes data/Bosphorus/stats.pkl for the dist loss, before the shards which keep a copy
+python preprocess.py \
+ --target bosphorus_shards \
+ --dataroot_dir data \
+ --shape 128 \
+ --image_shape 256 \
+ --num_workers 4
+# then train with --dir_shards shards_Bosphorus_128_256_center1_color1
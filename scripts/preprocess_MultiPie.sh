@@ -0,0 +1,7 @@
+python preprocess.py \
+ --target multipie_image \
+ --dataroot_dir data \
+ --dataset MultiPie \
+ --scale 100 \
+ --num_workers 8
+# then train DRGAN/AE with --fname_image_store store_MultiPie_gray_scale100
@@ -0,0 +1,16 @@
+python preprocess.py \
+ --target image_folder \
+ --dataroot_dir data \
+ --dataset celebA \
+ --crop 160 \
+ --scale 64 \
+ --num_workers 8
+# then train with --fname_image_store store_celebA_crop160_scale64
+python preprocess.py \
+ --target image_folder \
+ --dataroot_dir data \
+ --dataset CASIA-WebFace \
+ --crop 0 \
+ --scale 100 \
+ --num_workers 8
+# then train with --fname_image_store store_CASIA-WebFace_crop0_scale100
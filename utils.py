@@ -1,6 +1,8 @@
 from __future__ import print_function
-import os, csv, sys, gzip, torch, time, pickle, argparse
+import os, csv, sys, gzip, torch, time, pickle, argparse, hashlib, threading
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
 import numpy as np
 import scipy.misc
 import imageio
@@ -9,40 +11,65 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from torchvision import datasets, transforms
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.sampler import Sampler
 from PIL import Image
-
-from utils3D.data_io import read_binvox, read_bnt, bnt2voxel, bnt2voxel_wColor
+from multiprocessing.pool import ThreadPool
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+from utils3D.data_io import read_binvox_packed, unpack_voxel, read_bnt, bnt2voxel, bnt2voxel_wColor, bnt2sparse, bnt2sparse_wColor
+from utils3D.voxel_store import VoxelStore, dense_voxel
+from utils3D.shard_store import ShardStore
+from utils3D.image_store import ImageStore
 from utils3D.visualize import plot_voxel
 
 import pdb
 
-def load_mnist(dataset, dataroot_dir="./data"):
+def find_mnist_file(data_dir, name):
+	# load_mnist layout (<name>.gz in data_dir) or what torchvision downloads (raw/, <Dataset>/raw/)
+	for subdir in ['', 'raw', os.path.join('MNIST','raw'), os.path.join('FashionMNIST','raw')]:
+		for ext in ['.gz', '']:
+			path = os.path.join(data_dir, subdir, name+ext)
+			if os.path.exists(path):
+				return path
+	return None
+
+def load_mnist_uint8(dataset, dataroot_dir="./data", split='all'):
+	"""
+	images as a (N,1,28,28) uint8 array and labels as a (N,) int64 array
+	split is 'train' (60000), 'test' (10000) or 'all' (train followed by test)
+	files missing in the load_mnist layout are downloaded by torchvision
+	"""
 	data_dir = os.path.join(dataroot_dir, dataset)
 
-	def extract_data(filename, num_data, head_size, data_size):
-		with gzip.open(filename) as bytestream:
+	def extract_data(name, num_data, head_size, data_size):
+		path = find_mnist_file(data_dir, name)
+		if path is None:
+			if dataset == 'fashion-mnist':
+				datasets.FashionMNIST(data_dir, train=True, download=True)
+			else:
+				datasets.MNIST(data_dir, train=True, download=True)
+			path = find_mnist_file(data_dir, name)
+		with (gzip.open(path) if path.endswith('.gz') else open(path, 'rb')) as bytestream:
 			bytestream.read(head_size)
 			buf = bytestream.read(data_size * num_data)
-			data = np.frombuffer(buf, dtype=np.uint8).astype(np.float)
-		return data
-
-	data = extract_data(data_dir + '/train-images-idx3-ubyte.gz', 60000, 16, 28 * 28)
-	trX = data.reshape((60000, 28, 28, 1))
-
-	data = extract_data(data_dir + '/train-labels-idx1-ubyte.gz', 60000, 8, 1)
-	trY = data.reshape((60000))
+		return np.frombuffer(buf, dtype=np.uint8)
+
+	X = []
+	y = []
+	if split in ['train', 'all']:
+		X.append(extract_data('train-images-idx3-ubyte', 60000, 16, 28 * 28).reshape((60000, 1, 28, 28)))
+		y.append(extract_data('train-labels-idx1-ubyte', 60000, 8, 1))
+	if split in ['test', 'all']:
+		X.append(extract_data('t10k-images-idx3-ubyte', 10000, 16, 28 * 28).reshape((10000, 1, 28, 28)))
+		y.append(extract_data('t10k-labels-idx1-ubyte', 10000, 8, 1))
+	return np.concatenate(X, axis=0), np.concatenate(y, axis=0).astype(np.int64)
 
-	data = extract_data(data_dir + '/t10k-images-idx3-ubyte.gz', 10000, 16, 28 * 28)
-	teX = data.reshape((10000, 28, 28, 1))
-
-	data = extract_data(data_dir + '/t10k-labels-idx1-ubyte.gz', 10000, 8, 1)
-	teY = data.reshape((10000))
-
-	trY = np.asarray(trY).astype(np.int)
-	teY = np.asarray(teY)
-
-	X = np.concatenate((trX, teX), axis=0)
-	y = np.concatenate((trY, teY), axis=0).astype(np.int)
+def load_mnist(dataset, dataroot_dir="./data"):
+	X, y = load_mnist_uint8(dataset, dataroot_dir)
 
 	seed = 547
 	np.random.seed(seed)
@@ -50,18 +77,86 @@ def load_mnist(dataset, dataroot_dir="./data"):
 	np.random.seed(seed)
 	np.random.shuffle(y)
 
-	y_vec = np.zeros((len(y), 10), dtype=np.float)
-	for i, label in enumerate(y):
-		y_vec[i, y[i]] = 1
+	y_vec = np.zeros((len(y), 10), dtype=np.float32)
+	y_vec[np.arange(len(y)), y] = 1
 
-	X = X.transpose(0, 3, 1, 2) / 255.
-	# y_vec = y_vec.transpose(0, 3, 1, 2)
-
-	X = torch.from_numpy(X).type(torch.FloatTensor)
-	y_vec = torch.from_numpy(y_vec).type(torch.FloatTensor)
+	X = torch.from_numpy(X).type(torch.FloatTensor) / 255.
+	y_vec = torch.from_numpy(y_vec)
 	return X, y_vec
 
-def CustomDataLoader(path, transform, batch_size, shuffle):
+class TensorLoader(object):
+	"""
+	DataLoader replacement for datasets held in memory as a whole (on the GPU with gpu_mode).
+	uint8 images are gathered by shuffled index slicing and converted to float in [0,1] per batch.
+	only full batches are produced, as the training loops use them.
+	"""
+	def __init__(self, data, labels, batch_size, shuffle=True, gpu_mode=False):
+		data = torch.from_numpy(data) if isinstance(data, np.ndarray) else data
+		labels = torch.from_numpy(labels) if isinstance(labels, np.ndarray) else labels
+		if gpu_mode:
+			data, labels = data.cuda(), labels.cuda()
+		self.dataset = torch.utils.data.TensorDataset(data, labels)
+		self.data = data
+		self.labels = labels
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.gpu_mode = gpu_mode
+
+	def __len__(self):
+		return len(self.data) // self.batch_size
+
+	def __iter__(self):
+		if self.shuffle:
+			order = torch.randperm(len(self.data))
+		else:
+			order = torch.arange(0, len(self.data)).long()
+		if self.gpu_mode:
+			order = order.cuda()
+		for iB in range(len(self)):
+			idx = order[iB*self.batch_size:(iB+1)*self.batch_size]
+			x = self.data.index_select(0, idx)
+			if x.type().endswith('ByteTensor'):
+				x = x.float().div_(255.)
+			yield x, self.labels.index_select(0, idx)
+
+def transform_key(transform):
+	# (name, size) of a crop/scale transform, used to match the transforms an image store already applied
+	size = getattr(transform, 'size', None)
+	if isinstance(size, (list, tuple)):
+		size = tuple(size)
+	return (type(transform).__name__, size)
+
+def strip_pre_transforms(transform, pre_transforms, fname_store):
+	"""
+	transforms left to apply on images of a store that already went through pre_transforms
+	"""
+	nPre = len(pre_transforms)
+	if [transform_key(t) for t in transform.transforms[:nPre]] != list(pre_transforms):
+		exit( '{} holds images after {}, which does not match {}'.format(fname_store, pre_transforms, transform) )
+	return transforms.Compose(transform.transforms[nPre:])
+
+class ImageStoreFolder(Dataset):
+	"""
+	datasets.ImageFolder served from an image store written by preprocess.py --target image_folder.
+	the store holds images after its pre_transforms, transform is applied to a PIL image of that result.
+	"""
+	def __init__(self, dir_store, transform=None):
+		self.store = ImageStore(dir_store)
+		self.classes = self.store.meta['classes']
+		self.targets = self.store.meta['targets']
+		self.pre_transforms = self.store.meta['pre_transforms']
+		self.transform = transform
+
+	def __len__(self):
+		return len(self.store)
+
+	def __getitem__(self, idx):
+		image = Image.fromarray(self.store.get(idx))
+		if self.transform:
+			image = self.transform(image)
+		return image, self.targets[idx]
+
+def CustomDataLoader(path, transform, batch_size, shuffle, num_workers=0, fname_store=''):
 	# transform = transforms.Compose([
 	#	 transforms.CenterCrop(160),
 	#	 transform.Scale(64)
@@ -70,12 +165,16 @@ def CustomDataLoader(path, transform, batch_size, shuffle):
 	# ])
 
 	# data_dir = 'data/celebA'  # this path depends on your computer
-	dset = datasets.ImageFolder(path, transform)
-	data_loader = torch.utils.data.DataLoader(dset, batch_size, shuffle)
+	if len(fname_store) > 0:
+		# leading crop/scale transforms are already applied in the store
+		dset = ImageStoreFolder(fname_store)
+		dset.transform = strip_pre_transforms(transform, dset.pre_transforms, fname_store)
+	else:
+		dset = datasets.ImageFolder(path, transform)
+	data_loader = torch.utils.data.DataLoader(dset, batch_size, shuffle, num_workers=num_workers)
 
 	return data_loader
 
-
 class IKEA(Dataset):
 	def __init__(self,root_dir="data", transform=None):
 		self.filenames = []
@@ -99,9 +198,71 @@ class IKEA(Dataset):
 		return image , labels
 
 
+def bosphorus_index_name( root_dir, suffix, inclCodes, skipCodes ):
+	# one metadata index per filter configuration
+	config = repr( (os.path.abspath(root_dir), suffix, sorted(inclCodes), sorted(skipCodes)) )
+	return 'cache_Bosphorus_{}.npz'.format( hashlib.md5(config.encode('utf-8')).hexdigest()[:8] )
+
+def scan_bosphorus( root_dir, suffix, inclCodes, num_threads=16 ):
+	"""
+	list the files under root_dir ending with suffix whose poseclass_posecode is in inclCodes.
+	subject directories are walked in parallel.
+	"""
+	def checkCode(fname):
+		identity, poseclass, posecode, samplenum =  fname[:-len(suffix)].split('_')
+		return poseclass+"_"+posecode in inclCodes
+
+	def walk(path):
+		return [os.path.join(dirpath,f) for dirpath, dirnames, files in os.walk(path)
+					for f in files if f.endswith(suffix) and checkCode(f)]
+
+	entries = [os.path.join(root_dir,e) for e in sorted(os.listdir(root_dir))]
+	filenames = [f for f in entries if os.path.isfile(f)
+					and f.endswith(suffix) and checkCode(os.path.basename(f))]
+	pool = ThreadPool( num_threads )
+	for found in pool.map( walk, [e for e in entries if os.path.isdir(e)] ):
+		filenames += found
+	pool.close()
+	return filenames
+
+def build_bosphorus_index( filenames, suffix ):
+	"""
+	typed label arrays of Bosphorus samples parsed once from their filenames
+	identity, poseclass, posecode, samplenum of sample i are read from their arrays at i,
+	poseclass and posecode are indices into the sorted 'poseclasses' and 'posecodes'.
+	"""
+	names = [ os.path.basename(f)[:-len(suffix)].split('_') for f in filenames ]
+	poseclasses = sorted( set( [ n[1] for n in names ] ) )
+	posecodes = sorted( set( [ n[2] for n in names ] ) )
+	poseclassmap = dict( (c, i) for i, c in enumerate(poseclasses) )
+	posecodemap = dict( (c, i) for i, c in enumerate(posecodes) )
+	try:
+		index = { 'paths': np.array( filenames ),
+					'identity': np.array( [ int(n[0][2:]) for n in names ], dtype=np.int16 ),
+					'poseclass': np.array( [ poseclassmap[n[1]] for n in names ], dtype=np.int16 ),
+					'posecode': np.array( [ posecodemap[n[2]] for n in names ], dtype=np.int16 ),
+					'samplenum': np.array( [ int(n[3]) for n in names ], dtype=np.int16 ),
+					'poseclasses': np.array( poseclasses ),
+					'posecodes': np.array( posecodes ) }
+	except (ValueError, IndexError):
+		exit("parsing failed")
+	return index
+
+def resize_pad_image( image, image_shape ):
+	"""
+	resize a PIL image to height image_shape keeping its aspect ratio, and zero-pad the width to image_shape
+	"""
+	ratio = float(image_shape)/image.size[1] # size returns (w,h), we need h (longer side)
+	image = scipy.misc.imresize( image, (image_shape,int(ratio*image.size[0])) )
+	width = image.shape[1]
+	w = (image_shape-width)//2
+	image = np.pad( image, ((0,0),(w,w+width%2),(0,0)),'constant',constant_values=0 )
+	return image
+
 class Bosphorus( Dataset ):
 	def __init__( self, root_dir, transform=None, use_image=False, use_colorPCL=True, fname_cache='',
-					inclCodes=[], skipCodes=[], shape=64, image_shape=256, center=True):
+					inclCodes=[], skipCodes=[], shape=64, image_shape=256, center=True, fname_store='', sparse=False, compact=False,
+					fname_image_store=''):
 		self.root_dir = root_dir
 		self.filenames = {}
 		self.transform = transform
@@ -111,6 +272,11 @@ class Bosphorus( Dataset ):
 		self.shape = shape
 		self.image_shape = image_shape
 		self.center = center
+		self.sparse = sparse
+		self.compact = compact
+		self.voxel_dtype = np.uint8 if compact else np.float64
+		self.store = None
+		self.image_store = None
 
 		if len(skipCodes) > 0:
 			self.skipCodes = skipCodes
@@ -161,41 +327,69 @@ class Bosphorus( Dataset ):
 		time_start = time.time()
 
 		if len(fname_cache) == 0:
-			fname_cache = 'cache_Bosphorus.txt'
-		if os.path.exists(fname_cache):
-			self.filenames = open(fname_cache).read().splitlines()
-			print( '{} samples restored from {}'.format(len(self.filenames),fname_cache) )
+			fname_cache = bosphorus_index_name( root_dir, self.suffix, self.inclCodes, self.skipCodes )
+		elif not fname_cache.endswith('.txt') and not fname_cache.endswith('.npz'):
+			fname_cache += '.npz'
+		if len(fname_store) > 0:
+			# one store at the finest shape serves every coarser shape that divides it
+			meta = VoxelStore(fname_store).meta
+			if meta['shape'] % shape != 0 or meta['center'] != center or (use_colorPCL and not meta['use_colorPCL']):
+				exit( '{} holds shape={} center={} use_colorPCL={}'.format(fname_store,
+						meta['shape'], meta['center'], meta['use_colorPCL']) )
+			self.store = VoxelStore(fname_store, shape)
+			index = build_bosphorus_index( meta['filenames'], self.suffix )
+			print( '{} samples restored from {}'.format(len(index['paths']),fname_store) )
+		elif fname_cache.endswith('.txt') and os.path.exists(fname_cache):
+			# plain filename list of older versions
+			index = build_bosphorus_index( open(fname_cache).read().splitlines(), self.suffix )
+			print( '{} samples restored from {}'.format(len(index['paths']),fname_cache) )
+		elif os.path.exists(fname_cache):
+			index = dict( np.load(fname_cache) )
+			print( '{} samples restored from {}'.format(len(index['paths']),fname_cache) )
 		else:
-			def checkCode(fname, codes, skipCodes = []):
-				identity, poseclass, posecode, samplenum =  fname[:-len(self.suffix)].split('_')
-#				return poseclass in codes and poseclass not in skipCodes
-				return poseclass+"_"+posecode in codes
-				
-			self.filenames = [os.path.join(dirpath,f) for dirpath, dirnames, files in os.walk(root_dir)
-							for f in files if f.endswith(self.suffix) and checkCode(f,self.inclCodes,self.skipCodes) ]
+			filenames = scan_bosphorus( root_dir, self.suffix, self.inclCodes )
+			print('{:.0f}sec, {} files found.'.format( time.time()-time_start, len(filenames)))
 	
-			print('{:.0f}sec, {} files found.'.format( time.time()-time_start, len(self.filenames)))
-	
-			with open(fname_cache, 'w') as f:
-				for fname in self.filenames:
-					f.write(fname+'\n')
+			index = build_bosphorus_index( filenames, self.suffix )
+			if fname_cache.endswith('.txt'):
+				with open(fname_cache, 'w') as f:
+					for fname in filenames:
+						f.write(fname+'\n')
+			else:
+				np.savez( fname_cache, **index )
 			print( 'cached in {}'.format(fname_cache) )
-	
-		self.poseclasses = sorted( set( [ os.path.basename(f).split('_')[1]
-											for f in self.filenames ] ) )
+
+		self.filenames = [ str(f) for f in index['paths'] ]
+		self.identities = index['identity']
+		self.poseclass_ids = index['poseclass']
+		self.posecode_ids = index['posecode']
+		self.samplenums = index['samplenum']
+
+		self.poseclasses = [ str(c) for c in index['poseclasses'] ]
 		self.poseclassmap = {}
 		for i, poseclass in enumerate( self.poseclasses ):
 			self.poseclassmap[poseclass] = i
 
-		self.posecodes = sorted( set( [ os.path.basename(f).split('_')[2]
-											for f in self.filenames ] ) )
+		self.posecodes = [ str(c) for c in index['posecodes'] ]
 		self.posecodemap = {}
 		for i, posecode in enumerate( self.posecodes ):
 			self.posecodemap[posecode] = i
 
+		if use_image and len(fname_image_store) > 0:
+			self.image_store = ImageStore(fname_image_store)
+			if self.image_store.image_shape != image_shape:
+				exit( '{} holds image_shape={}'.format(fname_image_store, self.image_store.image_shape) )
+			self.image_rows = self.image_store.rows( self.filenames )
+			if self.image_rows is None:
+				exit( '{} does not cover all samples, rebuild it with preprocess.py'.format(fname_image_store) )
+
 		fname_stats = os.path.join( root_dir, 'stats.pkl' )
-		with open( fname_stats ) as fhandle:
-			stats = pickle.load( fhandle )
+		if os.path.exists( fname_stats ):
+			with open( fname_stats, 'rb' ) as fhandle:
+				stats = pickle.load( fhandle )
+		else:
+			print( '[warning] {} is not found, make it with preprocess.py --target bosphorus_stats'.format(fname_stats) )
+			stats = dict( (key, None) for key in ['muA', 'muB', 'stddevA', 'stddevB'] )
 		self.muA = stats['muA']
 		self.muB = stats['muB']
 		self.stddevA = stats['stddevA']
@@ -208,42 +402,46 @@ class Bosphorus( Dataset ):
 	
 	def __getitem__( self, idx ):
 		# load image
-		if self.use_image or self.use_colorPCL:
-			image = Image.open( self.filenames[idx][:-len(self.suffix)]+'.png' )
-			image_original = image
+		if (self.use_image and self.image_store is None) or (self.use_colorPCL and self.store is None):
+			image_original = Image.open( self.filenames[idx][:-len(self.suffix)]+'.png' )
 		if self.use_image:
-			ratio = float(self.image_shape)/image.size[1] # size returns (w,h), we need h (longer side)
-			image = scipy.misc.imresize( image, (self.image_shape,int(ratio*image.size[0])) )
-			width = image.shape[1]
-			w = (self.image_shape-width)//2
-			image = np.pad( image, ((0,0),(w,w+width%2),(0,0)),'constant',constant_values=0 )
+			if self.image_store is not None:
+				image = self.image_store.get( self.image_rows[idx] )
+			else:
+				image = resize_pad_image( image_original, self.image_shape )
 			if self.transform:
 				image = self.transform(image)
-		if self.use_colorPCL and self.transform:
+		if self.use_colorPCL and self.transform and self.store is None:
 			image_original = self.transform(image_original)
 
-		# load point cloud and fill voxel
-		bnt_data, nrows, ncols, imfile = read_bnt( self.filenames[idx] )
-		if self.use_colorPCL:
-			voxel = bnt2voxel_wColor( bnt_data, image_original, self.shape, self.center )
+		# load voxel and labels
+		if self.store is not None:
+			if self.sparse:
+				cells, colors = self.store.get_sparse(idx)
+				voxel = self.sparse_voxel( cells, colors if self.use_colorPCL else None )
+			else:
+				voxel = self.voxel_tensor( self.store.get(idx, self.voxel_dtype, 4 if self.use_colorPCL else 1) )
+			labels = dict( (key, int(value)) for key, value in self.store.get_labels(idx).items() )
 		else:
-			voxel = bnt2voxel( bnt_data, self.shape, self.center )
-		voxel = torch.Tensor( voxel )
-
-		# parsing
-		basename = os.path.basename( self.filenames[idx] )
-		assert( imfile == (basename[:-len(self.suffix)]+'.png') )
-		identity, poseclass, posecode, samplenum =  basename[:-len(self.suffix)].split('_')
-		try:
-			identity = int(identity[2:])
-			poseclass = self.poseclassmap[poseclass]
-			posecode = self.posecodemap[posecode]
-		except:
-			print( identity, poseclass, posecode )
-			exit("parsing failed")
-		labels = { 'id': identity,
-					'pclass': poseclass,
-					'pcode': posecode }
+			# load point cloud and fill voxel
+			bnt_data, nrows, ncols, imfile = read_bnt( self.filenames[idx] )
+			if self.sparse and self.use_colorPCL:
+				cells, colors, _ = bnt2sparse_wColor( bnt_data, image_original, self.shape, self.center )
+				voxel = self.sparse_voxel( cells, colors )
+			elif self.sparse:
+				cells, _ = bnt2sparse( bnt_data, self.shape, self.center )
+				voxel = self.sparse_voxel( cells )
+			elif self.use_colorPCL:
+				voxel = self.voxel_tensor( bnt2voxel_wColor( bnt_data, image_original, self.shape, self.center,
+																dtype=self.voxel_dtype ) )
+			else:
+				voxel = self.voxel_tensor( bnt2voxel( bnt_data, self.shape, self.center, dtype=self.voxel_dtype ) )
+
+			basename = os.path.basename( self.filenames[idx] )
+			assert( imfile == (basename[:-len(self.suffix)]+'.png') )
+			labels = { 'id': int(self.identities[idx]),
+						'pclass': int(self.poseclass_ids[idx]),
+						'pcode': int(self.posecode_ids[idx]) }
 
 		# return
 		if self.use_image:
@@ -251,11 +449,333 @@ class Bosphorus( Dataset ):
 		else:
 			return voxel, labels
 
+	def voxel_tensor( self, voxel ):
+		# compact voxels stay uint8 (colors in 0-255) until voxel_to_float right before the forward pass
+		if self.compact:
+			return torch.from_numpy( voxel )
+		return torch.Tensor( voxel )
+
+	def sparse_voxel( self, cells, colors=None ):
+		# coordinate-list voxel, densified per batch by collate_voxel and densify_voxel
+		# values hold the occupancy followed by each color channel of the cells
+		nChannels = 4 if self.use_colorPCL else 1
+		values = np.ones( (nChannels, len(cells)), dtype=np.uint8 if self.compact else np.float32 )
+		if colors is not None:
+			if self.compact and colors.dtype != np.uint8:
+				colors = np.rint( colors*255 )
+			elif not self.compact and colors.dtype == np.uint8:
+				colors = colors/255.
+			values[1:] = colors.T
+		voxel = { 'indices': torch.from_numpy( cells.astype(np.int64) ),
+					'values': torch.from_numpy( values.reshape(-1) ),
+					'size': torch.LongTensor( (nChannels,)+(self.shape,)*3 ) }
+		return voxel
+
+class ShardedBosphorus( Bosphorus ):
+	"""
+	Bosphorus(use_image=True) served from a shard store written by preprocess.py --target bosphorus_shards.
+	meant to be iterated in ShardShuffleSampler order, which reads every shard front to back.
+	"""
+	def __init__( self, dir_store, transform=None, use_colorPCL=True, shape=64, image_shape=256, center=True,
+					sparse=False, compact=False ):
+		meta = ShardStore( dir_store ).meta
+		if meta['shape'] % shape != 0 or (meta['image_shape'], meta['center']) != (image_shape, center):
+			exit( '{} holds shape={} image_shape={} center={}'.format(dir_store,
+					meta['shape'], meta['image_shape'], meta['center']) )
+		if use_colorPCL and meta['nChannels'] == 1:
+			exit( '{} holds no colors'.format(dir_store) )
+		self.store = ShardStore( dir_store, shape )
+		self.transform = transform
+		self.suffix = '_trim.bnt'
+		self.use_image = True
+		self.use_colorPCL = use_colorPCL
+		self.shape = shape
+		self.image_shape = image_shape
+		self.center = center
+		self.sparse = sparse
+		self.compact = compact
+		self.voxel_dtype = np.uint8 if compact else np.float64
+
+		self.filenames = meta['filenames']
+		self.poseclasses = meta['poseclasses']
+		self.poseclassmap = dict( (c, i) for i, c in enumerate(self.poseclasses) )
+		self.posecodes = meta['posecodes']
+		self.posecodemap = dict( (c, i) for i, c in enumerate(self.posecodes) )
+
+		stats = meta['stats']
+		self.muA = stats['muA']
+		self.muB = stats['muB']
+		self.stddevA = stats['stddevA']
+		self.stddevB = stats['stddevB']
+		print( '{} samples in {} shards of {}'.format(len(self.store), self.store.nShards, dir_store) )
+
+	def __getitem__( self, idx ):
+		image, cells, colors = self.store.get( idx )
+		image = np.array( image )
+		if self.transform:
+			image = self.transform( image )
+		if not self.use_colorPCL:
+			colors = None
+		if self.sparse:
+			voxel = self.sparse_voxel( cells, colors )
+		else:
+			nChannels = 4 if self.use_colorPCL else 1
+			voxel = self.voxel_tensor( dense_voxel( cells, colors, nChannels, self.shape, self.voxel_dtype ) )
+		labels = dict( (key, int(value)) for key, value in self.store.get_labels(idx).items() )
+		return voxel, labels, image
+
+def shuffle_buffer( items, buffer_size, rng ):
+	"""
+	approximate shuffle of a stream : items pass through a buffer of buffer_size from which they leave at random
+	"""
+	buf = []
+	for item in items:
+		if len(buf) < buffer_size:
+			buf.append( item )
+			continue
+		i = rng.randint( buffer_size )
+		yield buf[i]
+		buf[i] = item
+	for i in rng.permutation( len(buf) ):
+		yield buf[i]
+
+class ShardShuffleSampler( Sampler ):
+	"""
+	visits shards in random order and records of a shard front to back,
+	mixing them through a shuffle buffer of buffer_size records
+	"""
+	def __init__( self, shard_ids, buffer_size=256 ):
+		self.shard_ids = np.asarray( shard_ids )
+		self.buffer_size = buffer_size
+		self.shards = [ np.flatnonzero(self.shard_ids == shard) for shard in np.unique(self.shard_ids) ]
+
+	def __iter__( self ):
+		return self.order( np.random )
+
+	def order( self, rng ):
+		records = ( int(idx) for shard in rng.permutation( len(self.shards) ) for idx in self.shards[shard] )
+		return shuffle_buffer( records, self.buffer_size, rng )
+
+	def __len__( self ):
+		return len( self.shard_ids )
+
+class DataPosition( object ):
+	"""
+	epoch and samples consumed in it by the training loop, saved with the model.
+	loaders that cannot skip ahead resume at the start of the epoch.
+	"""
+	def __init__( self ):
+		self.epoch = 0
+		self.position = 0
+
+	def set_epoch( self, epoch ):
+		if epoch != self.epoch:
+			self.epoch = epoch
+			self.position = 0
+
+	def state_dict( self ):
+		return { 'epoch': self.epoch, 'position': self.position }
+
+	def load_state_dict( self, state ):
+		self.epoch = state['epoch']
+		self.position = 0
+
+class ResumableSampler( Sampler, DataPosition ):
+	"""
+	shuffling sampler whose order is a function of its seed and the epoch, so that a run restored from
+	state_dict continues at the sample it stopped at. order( rng ) gives the indices of an epoch,
+	a random permutation by default.
+	"""
+	def __init__( self, nSamples, order=None, seed=None ):
+		DataPosition.__init__( self )
+		self.nSamples = nSamples
+		self.order = order
+		self.seed = np.random.randint( 2**31 ) if seed is None else seed
+
+	def __iter__( self ):
+		rng = np.random.RandomState( [self.seed, self.epoch] )
+		if self.order is None:
+			indices = rng.permutation( self.nSamples )
+		else:
+			indices = np.fromiter( self.order( rng ), dtype=np.int64 )
+		# position is read once here, the training loop keeps moving it
+		return iter( indices[self.position:].tolist() )
+
+	def __len__( self ):
+		return self.nSamples
+
+	def state_dict( self ):
+		return { 'epoch': self.epoch, 'position': self.position, 'seed': self.seed }
+
+	def load_state_dict( self, state ):
+		self.epoch = state['epoch']
+		self.position = state['position']
+		self.seed = state['seed']
+
+def resumable_loader( dataset, batch_size=1, num_workers=0, collate_fn=default_collate ):
+	"""
+	DataLoader( dataset, shuffle=True ) with a ResumableSampler
+	"""
+	return DataLoader( dataset, batch_size=batch_size, sampler=ResumableSampler( len(dataset) ),
+						num_workers=num_workers, collate_fn=collate_fn )
+
+def data_position( loader ):
+	"""
+	DataPosition of a loader, saved and restored by the models
+	"""
+	if isinstance( getattr(loader, 'sampler', None), ResumableSampler ):
+		return loader.sampler
+	if isinstance( loader, DataPosition ):
+		return loader
+	if not hasattr( loader, 'data_position' ):
+		loader.data_position = DataPosition()
+	return loader.data_position
+
+# torch < 1.2 has no iterable-style datasets, StreamLoader then iterates them in the main process
+IterableDataset = getattr( torch.utils.data, 'IterableDataset', Dataset )
+get_worker_info = getattr( torch.utils.data, 'get_worker_info', lambda: None )
+
+def distributed_rank():
+	"""
+	rank and world size of this process, from torch.distributed once initialized or the RANK and WORLD_SIZE of the launcher
+	"""
+	dist = getattr( torch, 'distributed', None )
+	if dist is not None and hasattr( dist, 'is_initialized' ) and dist.is_available() and dist.is_initialized():
+		return dist.get_rank(), dist.get_world_size()
+	return int( os.environ.get('RANK', 0) ), int( os.environ.get('WORLD_SIZE', 1) )
+
+class StreamDataset( IterableDataset ):
+	"""
+	iterable dataset reading an ordered list of parts (shards, directories) front to back.
+	every epoch the parts are permuted with a seed shared by all processes and dealt round-robin to the
+	DataLoader workers of all ranks, so no sample is read twice, then mixed through a shuffle buffer of buffer_size.
+	subclasses pass the parts and their total number of samples nSamples, and define read_part( part ),
+	a generator of the samples of a part, which must yield nSamples over all parts.
+	"""
+	def __init__( self, parts, nSamples, buffer_size=256, seed=0 ):
+		self.parts = list(parts)
+		self.nSamples = nSamples
+		self.buffer_size = buffer_size
+		self.seed = seed
+		self.epoch = 0
+		self.rank, self.world_size = distributed_rank()
+
+	def set_epoch( self, epoch ):
+		self.epoch = epoch
+
+	def __len__( self ):
+		# samples read by this rank, approximate : parts differ in size and are dealt anew every epoch
+		return self.nSamples // self.world_size
+
+	def worker_parts( self ):
+		worker_info = get_worker_info()
+		worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+		order = np.random.RandomState( self.seed+self.epoch ).permutation( len(self.parts) )
+		stream = self.rank*num_workers + worker_id
+		return [ self.parts[i] for i in order[stream::self.world_size*num_workers] ], stream
+
+	def __iter__( self ):
+		parts, stream = self.worker_parts()
+		samples = ( sample for part in parts for sample in self.read_part( part ) )
+		rng = np.random.RandomState( (self.seed+self.epoch)*1000003 + stream )
+		return shuffle_buffer( samples, self.buffer_size, rng )
+
+class StreamLoader( DataPosition ):
+	"""
+	DataLoader over a StreamDataset that moves it to the next epoch on every pass.
+	a restored stream starts over at the beginning of its epoch.
+	"""
+	def __init__( self, dataset, batch_size, num_workers=0, collate_fn=default_collate ):
+		DataPosition.__init__( self )
+		self.dataset = dataset
+		self.batch_size = batch_size
+		self.num_workers = num_workers
+		self.collate_fn = collate_fn
+
+	def __len__( self ):
+		return len(self.dataset) // self.batch_size
+
+	def __iter__( self ):
+		epoch = self.epoch
+		self.dataset.set_epoch( epoch )
+		try:
+			if IterableDataset is not Dataset:
+				for batch in DataLoader( self.dataset, batch_size=self.batch_size, num_workers=self.num_workers,
+										collate_fn=self.collate_fn, drop_last=True ):
+					yield batch
+			else:
+				for batch in self.batches():
+					yield batch
+		finally:
+			# also when the pass is cut short, setting rather than incrementing keeps this idempotent
+			self.set_epoch( epoch+1 )
+
+	def batches( self ):
+		batch = []
+		for sample in self.dataset:
+			batch.append( sample )
+			if len(batch) == self.batch_size:
+				yield self.collate_fn( batch )
+				batch = []
+
+class StreamBosphorus( StreamDataset, ShardedBosphorus ):
+	"""
+	ShardedBosphorus read as a stream, one shard after the other
+	"""
+	def __init__( self, dir_store, buffer_size=256, seed=0, **kwargs ):
+		ShardedBosphorus.__init__( self, dir_store, **kwargs )
+		StreamDataset.__init__( self, range(self.store.nShards), len(self.store), buffer_size, seed )
+
+	def read_part( self, shard ):
+		# records of a shard are stored in index order, so this is one sequential read of the shard file
+		for idx in np.flatnonzero( self.store.shard_ids == shard ):
+			yield self[idx]
+
+def bosphorus_shard_loader( dir_store, batch_size, num_workers=1, buffer_size=256, shape=128, image_shape=256,
+							center=True, use_colorPCL=True, sparse=False, compact=False, stream=False ):
+	"""
+	drop-in replacement of DataLoader(Bosphorus(use_image=True, ...), shuffle=True) reading a shard store,
+	with stream as a StreamDataset split across workers and ranks
+	"""
+	kwargs = dict( transform=transforms.ToTensor(), use_colorPCL=use_colorPCL,
+					shape=shape, image_shape=image_shape, center=center, sparse=sparse, compact=compact )
+	if stream:
+		return StreamLoader( StreamBosphorus( dir_store, buffer_size, **kwargs ), batch_size, num_workers, collate_voxel )
+	dataset = ShardedBosphorus( dir_store, **kwargs )
+	sampler = ResumableSampler( len(dataset), ShardShuffleSampler( dataset.store.shard_ids, buffer_size ).order )
+	return DataLoader( dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, collate_fn=collate_voxel )
+
+def multipie_index_name( root_dir, cam_ids, max_subject ):
+	# one index per filter configuration
+	key = repr( (os.path.abspath(root_dir), sorted(cam_ids), max_subject) )
+	return 'cache_MultiPie_{}.npz'.format( hashlib.md5(key.encode('utf-8')).hexdigest()[:8] )
+
+def build_multipie_index( filenames, cam_ids, max_subject=None ):
+	"""
+	typed label arrays of MultiPie images <identity>_<session>_<recording>_<pose>_<illum>.png
+	kept when pose is one of cam_ids and identity is at most max_subject
+	"""
+	try:
+		fields = np.array( [os.path.basename(f)[:-4].split('_') for f in filenames], dtype=np.int64 ).reshape(-1,5)
+	except ValueError:
+		exit("parsing failed")
+	keep = np.in1d( fields[:,3], cam_ids )
+	if max_subject is not None:
+		keep &= fields[:,0] <= max_subject
+	fields = fields[keep].astype(np.int16)
+	return { 'paths': np.array( [f for f, k in zip(filenames, keep) if k] ),
+				'identity': fields[:,0],
+				'session': fields[:,1],
+				'recording': fields[:,2],
+				'pose': fields[:,3],
+				'illum': fields[:,4] }
+
 class MultiPie( Dataset ):
-	def __init__( self, root_dir, transform=None, cam_ids=None):
+	def __init__( self, root_dir, transform=None, cam_ids=None, max_subject=None, fname_cache='', fname_image_store=''):
 		self.filenames = []
 		self.root_dir = root_dir
 		self.transform = transform
+		self.image_store = None
 
 		#cam_ids = [10, 41, 50, 51, 80, 81, 90, 110, 120, 130, 140, 190, 191, 200, 240]
 		#cam_ids = [41, 50, 51, 80, 90, 130, 140, 190, 200]
@@ -269,70 +789,154 @@ class MultiPie( Dataset ):
 		sys.stdout.flush()
 		time_start = time.time()
 
-		fname_cache = 'cache_multipie.txt'
+		if len(fname_cache) == 0:
+			fname_cache = multipie_index_name( root_dir, cam_ids, max_subject )
 		if os.path.exists(fname_cache):
-			self.filenames = open(fname_cache).read().splitlines()
-			print( 'restored from {} : {} samples'.format(fname_cache, len(self.filenames)) )
+			index = dict( np.load(fname_cache) )
+			print( 'restored from {} : {} samples'.format(fname_cache, len(index['paths'])) )
 		else:
-			path = os.path.join( root_dir, 'Multi-Pie', 'data' )
-			self.filenames = [os.path.join(dirpath,f) for dirpath, dirnames, files in os.walk(path)
-							for f in files if f.endswith('.png') ]
-	
-			print('{:.0f}sec, {} images found.'.format( time.time()-time_start, len(self.filenames)))
-	
-			with open(fname_cache, 'w') as f:
-				for fname in self.filenames:
-					f.write(fname+'\n')
+			# unfiltered file list, shared by all filter configurations
+			fname_list = 'cache_multipie.txt'
+			if os.path.exists(fname_list):
+				filenames = open(fname_list).read().splitlines()
+			else:
+				path = os.path.join( root_dir, 'Multi-Pie', 'data' )
+				filenames = [os.path.join(dirpath,f) for dirpath, dirnames, files in os.walk(path)
+								for f in files if f.endswith('.png') ]
+				print('{:.0f}sec, {} images found.'.format( time.time()-time_start, len(filenames)))
+				with open(fname_list, 'w') as f:
+					for fname in filenames:
+						f.write(fname+'\n')
+
+			# filtering : 9 cams and 200 subjects
+			index = build_multipie_index( filenames, cam_ids, max_subject )
+			np.savez( fname_cache, **index )
 			print( 'cached in {}'.format(fname_cache) )
 
-		# filtering : 9 cams and 200 subjects
-		self.filenames = [ f for f in self.filenames 
-							if int(os.path.basename(f)[10:13]) in cam_ids ]
-							#if int(os.path.basename(f)[10:13]) in cam_ids and int(os.path.basename(f)[:3]) < 201 ]
-		self.subj_ids = sorted( set( [ int(os.path.basename(f)[:3]) for f in self.filenames ] ) )
+		self.filenames = [ str(f) for f in index['paths'] ]
+		self.identities = index['identity']
+		self.sessions = index['session']
+		self.recordings = index['recording']
+		self.poses = index['pose']
+		self.illums = index['illum']
+
+		self.subj_ids = sorted( set( self.identities.tolist() ) )
 		self.subj_map = {}
 		for i, subj in enumerate( self.subj_ids ):
 			self.subj_map[subj] = i
+		# labels as model inputs, looked up once instead of per sample
+		self.subj_idx = np.searchsorted( self.subj_ids, self.identities ).astype(np.int64)
+		self.pose_idx = np.array( [self.cam_map[int(pose)] for pose in self.poses], dtype=np.int64 )
 		print( '{} samples remain after filtering'.format( len(self.filenames) ) )
-	
+
+		if len(fname_image_store) > 0:
+			self.image_store = ImageStore( fname_image_store )
+			self.image_rows = self.image_store.rows( self.filenames )
+			if self.image_rows is None:
+				exit( '{} does not cover all samples, rebuild it with preprocess.py'.format(fname_image_store) )
+			if self.transform:
+				self.transform = strip_pre_transforms( self.transform, self.image_store.meta['pre_transforms'], fname_image_store )
 
 	def __len__( self ):
 		return len( self.filenames )
 	
 	def __getitem__( self, idx ):
-		basename = os.path.basename( self.filenames[idx] )
-		identity, sessionNum, recordingNum, pose, illum =  basename[:-4].split('_')
-		image = Image.open( self.filenames[idx] ).convert('L')
-		pose = self.cam_map[int(pose)]
+		if self.image_store is not None:
+			image = Image.fromarray( self.image_store.get( self.image_rows[idx] )[:,:,0], mode='L' )
+		else:
+			image = Image.open( self.filenames[idx] ).convert('L')
 		if self.transform:
 			image = self.transform(image)
-		labels = { 'id': self.subj_map[int(identity)],
-					'pose': pose,
-					'illum': int(illum)}
+		labels = { 'id': int(self.subj_idx[idx]),
+					'pose': int(self.pose_idx[idx]),
+					'illum': int(self.illums[idx])}
 		return image, labels 
 
-class ShapeNet( Dataset ):
-	def __init__( self, root_dir, transform=None, synsetId='chair'):
-		self.dict_list = []
+class StreamMultiPie( StreamDataset ):
+	"""
+	MultiPie read as a stream of subject directories <root_dir>/Multi-Pie/data/<session>/multiview/<subject>,
+	without the file list and index caches. images are filtered and labeled as in MultiPie.
+	"""
+	def __init__( self, root_dir, transform=None, cam_ids=None, max_subject=None, buffer_size=256, seed=0 ):
 		self.root_dir = root_dir
 		self.transform = transform
+		self.max_subject = max_subject
+		if cam_ids is None:
+			cam_ids = [200, 190, 41, 50, 51, 140, 130, 80, 90]
+		self.cam_ids = cam_ids
+		self.cam_map = dict( (cam, i) for i, cam in enumerate(cam_ids) )
+
+		path = os.path.join( root_dir, 'Multi-Pie', 'data' )
+		parts = sorted( os.path.join(path, session, 'multiview', subj) for session in os.listdir(path)
+							if os.path.isdir( os.path.join(path, session, 'multiview') )
+							for subj in os.listdir( os.path.join(path, session, 'multiview') ) )
+		if max_subject is not None:
+			parts = [ part for part in parts if int(os.path.basename(part)) <= max_subject ]
+		if len(parts) == 0:
+			exit( 'no subject directories in {}'.format(path) )
+		self.subj_ids = sorted( set( int(os.path.basename(part)) for part in parts ) )
+
+		# counting walks the directories but keeps no file list
+		time_start = time.time()
+		nSamples = sum( len(self.index_part( part )['paths']) for part in parts )
+		StreamDataset.__init__( self, parts, nSamples, buffer_size, seed )
+		print( '{} samples in {} subject directories, counted in {:.0f}sec'.format( nSamples, len(parts), time.time()-time_start ) )
+
+	def index_part( self, part ):
+		filenames = sorted( os.path.join(dirpath,f) for dirpath, dirnames, files in os.walk(part)
+								for f in files if f.endswith('.png') )
+		return build_multipie_index( filenames, self.cam_ids, self.max_subject )
+
+	def read_part( self, part ):
+		index = self.index_part( part )
+		subj_idx = np.searchsorted( self.subj_ids, index['identity'] )
+		for fname, subj, pose, illum in zip( index['paths'], subj_idx, index['pose'], index['illum'] ):
+			image = Image.open( str(fname) ).convert('L')
+			if self.transform:
+				image = self.transform(image)
+			labels = { 'id': int(subj),
+						'pose': self.cam_map[int(pose)],
+						'illum': int(illum) }
+			yield image, labels
+
+def multipie_loader( root_dir, transform, batch_size, num_workers=1, cam_ids=None, fname_image_store='',
+						stream=False, buffer_size=256 ):
+	"""
+	DataLoader(MultiPie(...), shuffle=True), with stream a StreamMultiPie split across workers and ranks
+	"""
+	if stream:
+		return StreamLoader( StreamMultiPie( root_dir, transform, cam_ids, buffer_size=buffer_size ), batch_size, num_workers )
+	return DataLoader( MultiPie( root_dir, transform, cam_ids, fname_image_store=fname_image_store ),
+						batch_size=batch_size, shuffle=True, num_workers=num_workers )
+
+def shapenet_synset_id( synsetId ):
+	# convert word to synsetID
+	if synsetId.isdigit():
+		return synsetId
+	# read wordnet
+	wordnet = {}
+	with open('words.txt') as f_wordnet:
+		for line in f_wordnet:
+			tokens = line[:-1].split('\t')
+			if not tokens[1] in wordnet:
+				wordnet[ tokens[1] ] = tokens[0][1:]
+	try:
+		synsetId = wordnet[synsetId]
+	except:
+		exit( 'synsetId {} is not found in wordnet'.format(synsetId) )
+	print( 'synsetId = {}'.format(synsetId) )
+	return synsetId
 
-		fname_cache = 'cache_ShapeNet_'+synsetId+'.csv'
+def shapenet_binvox( root_dir, synsetId, modelId ):
+	return os.path.join( root_dir, 'ShapeNetCore.v2', synsetId, modelId, 'models', 'model_normalized.solid.binvox' )
 
-		# convert word to synsetID
-		if not synsetId.isdigit():
-			# read wordnet
-			wordnet = {}
-			with open('words.txt') as f_wordnet:
-				for line in f_wordnet:
-					tokens = line[:-1].split('\t')
-					if not tokens[1] in wordnet:
-						wordnet[ tokens[1] ] = tokens[0][1:]
-			try:
-				synsetId = wordnet[synsetId]
-			except:
-				exit( 'synsetId {} is not found in wordnet'.format(synsetId) )
-			print( 'synsetId = {}'.format(synsetId) )
+class ShapeNet( Dataset ):
+	def __init__( self, root_dir, transform=None, synsetId='chair', compact=False, resolution=64, voxel_cache_dir='', sparse=False ):
+		self.dict_list = []
+		self.setup( root_dir, transform, compact, resolution, voxel_cache_dir, sparse )
+
+		fname_cache = 'cache_ShapeNet_'+synsetId+'.csv'
+		synsetId = shapenet_synset_id( synsetId )
 
 		# read shapenet split
 		if os.path.exists(fname_cache):
@@ -352,8 +956,7 @@ class ShapeNet( Dataset ):
 			nRawSamples = len(self.dict_list)
 			print( 'checking existence of actual models from all.csv...')
 			self.dict_list = [ sample for sample in self.dict_list
-							if os.path.exists( os.path.join( self.root_dir, 'ShapeNetCore.v2', sample['synsetId'], sample['modelId'],
-												'models','model_normalized.solid.binvox' ) ) ]
+							if os.path.exists( shapenet_binvox( self.root_dir, sample['synsetId'], sample['modelId'] ) ) ]
 			nExistingSamples = len(self.dict_list)
 			print( '{} samples exist among {} samples from all.csv'.format(nExistingSamples,nRawSamples) )
 
@@ -365,24 +968,176 @@ class ShapeNet( Dataset ):
 					writer.writerow(sample)
 			print( 'cached in {}'.format(fname_cache) )
 
+	def setup( self, root_dir, transform, compact, resolution, voxel_cache_dir, sparse=False ):
+		self.root_dir = root_dir
+		self.transform = transform
+		self.compact = compact
+		self.resolution = resolution
+		# sparse samples skip transform, which works on dense grids
+		self.sparse = sparse
+		self.voxel_cache_dir = ''
+		if len(voxel_cache_dir) > 0:
+			# one packed occupancy file per (modelId, resolution)
+			self.voxel_cache_dir = os.path.join( voxel_cache_dir, str(resolution) )
+			if not os.path.exists( self.voxel_cache_dir ):
+				os.makedirs( self.voxel_cache_dir )
+
 	def __len__( self ):
 		return len( self.dict_list )
 	
 	def __getitem__( self, idx ):
-		data = self.dict_list[idx]
-		path_sample = os.path.join( self.root_dir, 'ShapeNetCore.v2', data['synsetId'], data['modelId'] )
-		path_binvox = os.path.join( path_sample, 'models', 'model_normalized.solid.binvox' )
-		voxel_data = read_binvox( path_binvox )
+		return self.sample( self.dict_list[idx] )
+
+	def sample( self, data ):
+		path_binvox = shapenet_binvox( self.root_dir, data['synsetId'], data['modelId'] )
+		labels = { 'id': data['id'],
+					'synsetId': data['synsetId'] }
+		if self.sparse:
+			return self.sparse_voxel( self.load_packed( path_binvox, data['modelId'] ) ), labels
+
+		voxel_data = unpack_voxel( self.load_packed( path_binvox, data['modelId'] ), self.resolution,
+									dtype=np.uint8 if self.compact else np.float64 )
 		voxel_data = np.expand_dims(voxel_data,0)
 #		plot_voxel( voxel_data, save_file='sample_{}.png'.format(idx) )
 
 		if self.transform:
 			voxel_data = self.transform(voxel_data)
-		voxel_data = torch.Tensor( voxel_data )
-		labels = { 'id': data['id'],
-					'synsetId': data['synsetId'] }
+		if self.compact:
+			voxel_data = torch.from_numpy( np.ascontiguousarray(voxel_data) )
+		else:
+			voxel_data = torch.Tensor( voxel_data )
 		return voxel_data, labels 
 
+	def sparse_voxel( self, packed ):
+		# occupied cells of the packed occupancy as Bosphorus.sparse_voxel, densified per batch
+		cells = np.flatnonzero( np.unpackbits( packed )[:self.resolution**3] )
+		values = np.ones( len(cells), dtype=np.uint8 if self.compact else np.float32 )
+		return { 'indices': torch.from_numpy( cells.astype(np.int64) ),
+					'values': torch.from_numpy( values ),
+					'size': torch.LongTensor( (1,)+(self.resolution,)*3 ) }
+
+	def load_packed( self, path_binvox, modelId ):
+		# decode each model at most once per resolution, workers write through a temp file and rename
+		if len(self.voxel_cache_dir) == 0:
+			return read_binvox_packed( path_binvox, self.resolution )
+		fname = os.path.join( self.voxel_cache_dir, modelId+'.npy' )
+		if os.path.exists( fname ):
+			return np.load( fname )
+		packed = read_binvox_packed( path_binvox, self.resolution )
+		fname_tmp = '{}.{}.tmp'.format( fname, os.getpid() )
+		with open( fname_tmp, 'wb' ) as f:
+			np.save( f, packed )
+		os.rename( fname_tmp, fname )
+		return packed
+
+class StreamShapeNet( StreamDataset, ShapeNet ):
+	"""
+	ShapeNet read as a stream of model directories listed from ShapeNetCore.v2/<synsetId>,
+	without all.csv. models without a solid binvox are left out, labels id are modelIds.
+	"""
+	def __init__( self, root_dir, transform=None, synsetId='chair', compact=False, resolution=64, voxel_cache_dir='',
+					sparse=False, buffer_size=256, seed=0 ):
+		self.setup( root_dir, transform, compact, resolution, voxel_cache_dir, sparse )
+		self.synsetId = shapenet_synset_id( synsetId )
+		modelIds = sorted( os.listdir( os.path.join( root_dir, 'ShapeNetCore.v2', self.synsetId ) ) )
+		nModels = len(modelIds)
+		modelIds = [ modelId for modelId in modelIds
+						if os.path.exists( shapenet_binvox( root_dir, self.synsetId, modelId ) ) ]
+		StreamDataset.__init__( self, modelIds, len(modelIds), buffer_size, seed )
+		print( '{} of {} models of synsetId {} to stream'.format( len(modelIds), nModels, self.synsetId ) )
+
+	def read_part( self, modelId ):
+		yield self.sample( {'id': modelId, 'synsetId': self.synsetId, 'modelId': modelId} )
+
+def shapenet_loader( root_dir, batch_size, num_workers=1, synsetId='chair', compact=False, voxel_cache_dir='',
+						sparse=False, stream=False, buffer_size=256 ):
+	"""
+	DataLoader(ShapeNet(...), shuffle=True), with stream a StreamShapeNet split across workers and ranks
+	"""
+	if stream:
+		return StreamLoader( StreamShapeNet( root_dir, synsetId=synsetId, compact=compact, voxel_cache_dir=voxel_cache_dir,
+											sparse=sparse, buffer_size=buffer_size ), batch_size, num_workers, collate_voxel )
+	return DataLoader( ShapeNet( root_dir, synsetId=synsetId, compact=compact, voxel_cache_dir=voxel_cache_dir, sparse=sparse ),
+						batch_size=batch_size, shuffle=True, num_workers=num_workers, collate_fn=collate_voxel )
+
+
+def collate_voxel( batch ):
+	"""
+	collate_fn for datasets whose first element may be a sparse voxel (see Bosphorus.sparse_voxel).
+	sparse voxels of the batch are merged into one flat index/value list, which is all that travels
+	from DataLoader workers; densify_voxel turns it into the dense batch tensor.
+	"""
+	if not isinstance( batch[0][0], dict ):
+		return default_collate( batch )
+
+	size = [int(s) for s in batch[0][0]['size']]
+	nChannels = size[0]
+	nCells = size[1]*size[2]*size[3]
+	indices = []
+	values = []
+	for iS, sample in enumerate(batch):
+		voxel = sample[0]
+		for iC in range(nChannels):
+			indices.append( voxel['indices']+(iS*nChannels+iC)*nCells )
+		values.append( voxel['values'] )
+	sparse = { 'index': torch.cat(indices),
+				'values': torch.cat(values),
+				'size': torch.LongTensor( [len(batch)]+size ) }
+	return [sparse] + default_collate( [sample[1:] for sample in batch] )
+
+class VoxelBuffers(object):
+	"""
+	preallocated dense batches for densify_voxel, a ring of nBuffers per (size, type), pinned with pin_memory.
+	a buffer is handed out again nBuffers calls later, so no more than nBuffers-1 batches densified into it
+	may still be in use.
+	"""
+	def __init__( self, nBuffers=1, pin_memory=False ):
+		self.nBuffers = nBuffers
+		self.pin_memory = pin_memory
+		self.rings = {}
+
+	def get( self, size, values ):
+		key = (tuple(size), values.type())
+		ring = self.rings.setdefault( key, [] )
+		if len(ring) < self.nBuffers:
+			buf = values.new( int(np.prod(size)) )
+			ring.append( buf.pin_memory() if self.pin_memory else buf )
+			return ring[-1]
+		# oldest buffer first
+		ring.append( ring.pop(0) )
+		return ring[-1]
+
+def densify_voxel( voxel, buffers=None ):
+	"""
+	scatter a batch collated by collate_voxel into a dense (B,C,D,H,W) tensor in one call,
+	taken from buffers (VoxelBuffers) if given. dense batches are returned as they are.
+	"""
+	if not isinstance( voxel, dict ):
+		return voxel
+	size = [int(s) for s in voxel['size']]
+	if buffers is not None:
+		dense = buffers.get( size, voxel['values'] )
+	else:
+		dense = voxel['values'].new( int(np.prod(size)) )
+	dense.zero_()
+	dense.index_copy_( 0, voxel['index'], voxel['values'] )
+	return dense.view( *size )
+
+def voxel_to_float( voxel, has_occupancy=True ):
+	"""
+	float voxel batch for the forward pass.
+	compact uint8 batches (occupancy 0/1, colors 0-255) are converted and their color channels
+	rescaled to [0,1]; float batches are returned as they are. without occupancy (e.g. projected
+	colors) every channel is rescaled.
+	"""
+	if not voxel.type().endswith('ByteTensor'):
+		return voxel
+	voxel = voxel.float()
+	if not has_occupancy:
+		voxel /= 255.
+	elif voxel.size(1) > 1:
+		voxel[:,1:] /= 255.
+	return voxel
 
 def sample_z( nSamples, nDims, isCuda=False ):
 	z = torch.rand( nSamples, nDims )
@@ -392,6 +1147,367 @@ def sample_z( nSamples, nDims, isCuda=False ):
 		z = Variable(z)
 	return z
 
+class BatchPreparer(object):
+	"""
+	per-batch label tensors of the DRGAN3D family built in one pass on the training device.
+	id and pose code labels go to the device in a single copy, their one-hots and the random pose codes
+	with one-hots and noise z are filled in place in buffers reused across iterations.
+	outputs are overwritten by the next call, so they must not be kept beyond the iteration.
+	"""
+	def __init__( self, batch_size, Npcode, Nz=0, gpu_mode=False ):
+		self.batch_size = batch_size
+		self.Npcode = Npcode
+		self.Nz = Nz
+		self.gpu_mode = gpu_mode
+
+		self.host_labels = torch.LongTensor( 2, batch_size )
+		self.labels = torch.LongTensor( 2, batch_size )
+		self.random_pcode = torch.LongTensor( batch_size )
+		self.onehot = torch.FloatTensor( 2, batch_size, Npcode )
+		self.z = torch.FloatTensor( batch_size, max(Nz,1) )
+		if gpu_mode:
+			self.host_labels = self.host_labels.pin_memory()
+			self.labels = self.labels.cuda()
+			self.random_pcode = self.random_pcode.cuda()
+			self.onehot = self.onehot.cuda()
+			self.z = self.z.cuda()
+
+	def __call__( self, y_ ):
+		"""
+		Variables y_id_, y_pcode_, y_pcode_onehot_, y_random_pcode_, y_random_pcode_onehot_ and z_ (None without Nz)
+		"""
+		if y_['id'].is_cuda:
+			# already moved by Prefetcher
+			self.labels[0].copy_( y_['id'] )
+			self.labels[1].copy_( y_['pcode'] )
+		else:
+			self.host_labels[0].copy_( y_['id'] )
+			self.host_labels[1].copy_( y_['pcode'] )
+			self.labels.copy_( self.host_labels )
+
+		self.random_pcode.random_( 0, self.Npcode )
+		self.onehot.zero_()
+		self.onehot[0].scatter_( 1, self.labels[1].view(-1,1), 1 )
+		self.onehot[1].scatter_( 1, self.random_pcode.view(-1,1), 1 )
+
+		z_ = None
+		if self.Nz > 0:
+			z_ = Variable( self.z.uniform_() )
+		return Variable( self.labels[0] ), Variable( self.labels[1] ), Variable( self.onehot[0] ), \
+				Variable( self.random_pcode ), Variable( self.onehot[1] ), z_
+
+class VoxelAugmenter(object):
+	"""
+	random augmentation of a dense (B,C,D,H,W) voxel batch with tensor ops on the device it lives on, channel 0 being
+	occupancy and channels 1-3 colors. ops are any of
+		flip	mirror samples along flip_dims, their paired (B,3,H,W) images along the width
+		shift	integer translations of up to max_shift cells per axis, zero filled
+		rotate	rotations of up to max_angle degrees about each axis, resampled trilinearly (needs torch >= 0.4.1)
+		color	per sample gain of each color channel and brightness offset of up to color_jitter
+	random parameters are drawn on the host per batch and applied to all samples sharing a value at once,
+	so the cost grows with the batch size rather than with per-sample python work.
+	without ops batches are returned untouched.
+	"""
+	def __init__( self, ops=[], max_shift=4, max_angle=10., color_jitter=0.1, flip_dims=(2,), gpu_mode=False ):
+		for op in ops:
+			if op not in ['flip', 'shift', 'rotate', 'color']:
+				exit( 'unknown voxel augmentation: {}'.format(op) )
+		self.ops = ops
+		self.max_shift = max_shift
+		self.max_angle = max_angle
+		self.color_jitter = color_jitter
+		self.flip_dims = flip_dims
+		self.gpu_mode = gpu_mode
+
+	def __call__( self, voxel, image=None ):
+		if len(self.ops) == 0:
+			return voxel, image
+		if self.gpu_mode and not voxel.is_cuda:
+			voxel = voxel.cuda()
+			image = image.cuda() if image is not None else None
+		voxel = voxel_to_float( voxel ).clone()
+		if 'flip' in self.ops:
+			voxel, image = self.flip( voxel, image )
+		if 'rotate' in self.ops:
+			voxel = self.rotate( voxel )
+		if 'shift' in self.ops:
+			voxel = self.shift( voxel )
+		if 'color' in self.ops and voxel.size(1) > 1:
+			voxel = self.color( voxel )
+		return voxel, image
+
+	def index( self, indices, like ):
+		indices = torch.from_numpy( np.asarray(indices, dtype=np.int64) )
+		return indices.cuda() if like.is_cuda else indices
+
+	def flip( self, voxel, image ):
+		for dim in self.flip_dims:
+			sel = np.flatnonzero( np.random.rand( voxel.size(0) ) < 0.5 )
+			if len(sel) == 0:
+				continue
+			sel = self.index( sel, voxel )
+			reverse = self.index( np.arange( voxel.size(dim)-1, -1, -1 ), voxel )
+			voxel.index_copy_( 0, sel, voxel.index_select( 0, sel ).index_select( dim, reverse ) )
+			if image is not None and dim == 2:
+				# voxel axis 0 runs along the image width
+				reverse = self.index( np.arange( image.size(3)-1, -1, -1 ), image )
+				image = image.clone()
+				image.index_copy_( 0, sel, image.index_select( 0, sel ).index_select( 3, reverse ) )
+		return voxel, image
+
+	def shift( self, voxel ):
+		for dim in [2, 3, 4]:
+			shifts = np.random.randint( -self.max_shift, self.max_shift+1, voxel.size(0) )
+			size = voxel.size(dim)
+			for v in np.unique( shifts ):
+				if v == 0:
+					continue
+				sel = self.index( np.flatnonzero( shifts == v ), voxel )
+				samples = voxel.index_select( 0, sel )
+				shifted = samples.new( samples.size() ).zero_()
+				if v > 0:
+					shifted.narrow( dim, v, size-v ).copy_( samples.narrow( dim, 0, size-v ) )
+				else:
+					shifted.narrow( dim, 0, size+v ).copy_( samples.narrow( dim, -v, size+v ) )
+				voxel.index_copy_( 0, sel, shifted )
+		return voxel
+
+	def rotate( self, voxel ):
+		nSamples = voxel.size(0)
+		angles = np.deg2rad( np.random.uniform( -self.max_angle, self.max_angle, (nSamples, 3) ) )
+		c, s = np.cos(angles), np.sin(angles)
+		one, zero = np.ones(nSamples), np.zeros(nSamples)
+		Rx = np.stack( [one, zero, zero, zero, c[:,0], -s[:,0], zero, s[:,0], c[:,0]], 1 ).reshape(-1,3,3)
+		Ry = np.stack( [c[:,1], zero, s[:,1], zero, one, zero, -s[:,1], zero, c[:,1]], 1 ).reshape(-1,3,3)
+		Rz = np.stack( [c[:,2], -s[:,2], zero, s[:,2], c[:,2], zero, zero, zero, one], 1 ).reshape(-1,3,3)
+		theta = np.concatenate( [np.matmul( Rz, np.matmul( Ry, Rx ) ), np.zeros((nSamples,3,1))], 2 )
+		theta = torch.from_numpy( theta.astype(np.float32) )
+		theta = theta.cuda() if voxel.is_cuda else theta
+		try:
+			grid = F.affine_grid( Variable(theta), voxel.size(), align_corners=False )
+			resampled = F.grid_sample( Variable(voxel), grid, align_corners=False ).data
+		except TypeError:
+			# pytorch < 1.3
+			grid = F.affine_grid( Variable(theta), voxel.size() )
+			resampled = F.grid_sample( Variable(voxel), grid ).data
+
+		# colors are zero off the surface, dividing by the resampled occupancy undoes the blending with empty cells
+		occupancy = resampled[:,0:1]
+		occupied = (occupancy > 0.5).float()
+		if voxel.size(1) > 1:
+			resampled[:,1:] = resampled[:,1:] / occupancy.clamp( min=1e-6 ) * occupied
+		resampled[:,0:1] = occupied
+		return resampled
+
+	def color( self, voxel ):
+		nSamples = voxel.size(0)
+		occupancy = voxel[:,0:1]
+		gain = voxel.new( nSamples, voxel.size(1)-1, 1, 1, 1 ).uniform_( 1-self.color_jitter, 1+self.color_jitter )
+		offset = voxel.new( nSamples, 1, 1, 1, 1 ).uniform_( -self.color_jitter, self.color_jitter )
+		voxel[:,1:] = (voxel[:,1:]*gain + occupancy*offset).clamp( 0, 1 )
+		return voxel
+
+class UpdateGate(object):
+	"""
+	accuracy-gated discriminator updates : D trains while the mean of its last nAvg accuracies is below threshold.
+	the decision is taken before the step, so a closed gate costs a forward pass without graph and no backward.
+	accuracies stay on their device and their mean is read back every sync_every updates, so the gate syncs
+	once per sync_every steps and its decision follows the accuracies with that delay.
+	the window and counts go into checkpoints (state_dict), so a resumed run gates D as the uninterrupted one.
+	"""
+	def __init__( self, threshold=0.8, nAvg=5, sync_every=1 ):
+		self.threshold = threshold
+		self.nAvg = nAvg
+		self.sync_every = max( 1, sync_every )
+		self.window = None
+		self.nAccs = 0
+		self.nUnsynced = 0
+		self.mean = 0.
+		self.reset_counts()
+
+	def reset_counts( self ):
+		self.nSteps = 0
+		self.nSkipped = 0
+
+	def average( self ):
+		return self.mean
+
+	def is_open( self ):
+		return self.mean < self.threshold
+
+	def update( self, acc, trained ):
+		"""
+		acc is a number or a one element tensor
+		"""
+		if self.nAvg > 0:
+			if not torch.is_tensor( acc ) and hasattr( acc, 'data' ) and torch.is_tensor( acc.data ):
+				acc = acc.data
+			if not torch.is_tensor( acc ):
+				acc = torch.DoubleTensor( [acc] )
+			if self.window is None or self.window.is_cuda != acc.is_cuda:
+				window = acc.new( self.nAvg ).double().zero_()
+				if self.window is not None:
+					window.copy_( self.window )
+				self.window = window
+			# ring buffer of the last nAvg accuracies
+			i = self.nAccs % self.nAvg
+			self.window[i:i+1].copy_( acc.contiguous().view(-1)[:1] )
+			self.nAccs += 1
+			self.nUnsynced += 1
+			if self.nUnsynced >= self.sync_every:
+				self.sync()
+		self.nSteps += 1
+		if not trained:
+			self.nSkipped += 1
+
+	def sync( self ):
+		self.mean = float( self.window[:min(self.nAccs, self.nAvg)].mean() )
+		self.nUnsynced = 0
+
+	def skip_rate( self ):
+		return float( self.nSkipped )/self.nSteps if self.nSteps > 0 else 0.
+
+	def state_dict( self ):
+		return { 'window': self.window.cpu().numpy().tolist() if self.window is not None else None,
+					'nAccs': self.nAccs, 'nUnsynced': self.nUnsynced, 'mean': self.mean,
+					'nSteps': self.nSteps, 'nSkipped': self.nSkipped }
+
+	def load_state_dict( self, state ):
+		if state['window'] is not None and len( state['window'] ) != self.nAvg:
+			print( '[warning] D_acc gate of {} accuracies is not restored into a window of {}'.format(len(state['window']), self.nAvg) )
+			return
+		self.window = torch.DoubleTensor( state['window'] ) if state['window'] is not None else None
+		self.nAccs = state['nAccs']
+		self.nUnsynced = state['nUnsynced']
+		self.mean = state['mean']
+		self.nSteps = state['nSteps']
+		self.nSkipped = state['nSkipped']
+
+class _NullContext(object):
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *args ):
+		return False
+
+def set_grad_enabled( mode ):
+	"""
+	torch.set_grad_enabled as a context manager, a no-op on torch < 0.4 which records every graph
+	"""
+	if hasattr( torch, 'set_grad_enabled' ):
+		return torch.set_grad_enabled( mode )
+	return _NullContext()
+
+def map_tensors( func, batch ):
+	"""
+	apply func to every tensor of a (nested) batch of lists, tuples and dicts
+	"""
+	if torch.is_tensor( batch ):
+		return func( batch )
+	if isinstance( batch, dict ):
+		return dict( (key, map_tensors( func, value )) for key, value in batch.items() )
+	if isinstance( batch, (list, tuple) ):
+		return type(batch)( map_tensors( func, value ) for value in batch )
+	return batch
+
+def to_device( tensor ):
+	if not tensor.is_pinned():
+		tensor = tensor.pin_memory()
+	try:
+		return tensor.cuda( non_blocking=True )
+	except TypeError:
+		# pytorch < 0.4
+		return tensor.cuda( **{'async': True} )
+
+class Prefetcher(object):
+	"""
+	iterates a DataLoader (or any iterable of batches) keeping up to depth batches ready ahead of the training loop.
+	a background thread pulls batches, densifies sparse voxels (see collate_voxel) and, in gpu_mode, copies every
+	tensor from pinned memory to the device on a side stream, so loading and transfers overlap with compute.
+	depth 0 iterates synchronously in the training loop.
+	wait_time is the time the training loop spent waiting on data during the last pass.
+	"""
+	def __init__( self, loader, depth=2, gpu_mode=False ):
+		self.loader = loader
+		self.dataset = loader.dataset
+		self.depth = depth
+		self.gpu_mode = gpu_mode
+		self.stream = torch.cuda.Stream() if gpu_mode else None
+		# in gpu_mode a batch leaves its pinned buffer once copied, otherwise the queued batches, the one in
+		# the training loop and the one being filled each hold a buffer
+		self.buffers = VoxelBuffers( 1 if gpu_mode else depth+2, pin_memory=gpu_mode )
+		self.wait_time = 0.
+
+	def __len__( self ):
+		return len(self.loader)
+
+	def prepare( self, batch ):
+		batch = list(batch)
+		if isinstance( batch[0], dict ) and 'index' in batch[0]:
+			batch[0] = densify_voxel( batch[0], self.buffers )
+		if self.gpu_mode:
+			with torch.cuda.stream( self.stream ):
+				batch = map_tensors( to_device, batch )
+			# the pinned buffer is reused by the next batch
+			self.stream.synchronize()
+		return batch
+
+	def fill( self, batches, stop ):
+		def put( item ):
+			while not stop.is_set():
+				try:
+					batches.put( item, timeout=0.1 )
+					return True
+				except queue.Full:
+					pass
+			return False
+
+		try:
+			for batch in self.loader:
+				if not put( ('batch', self.prepare( batch )) ):
+					return
+			put( ('end', None) )
+		except Exception as e:
+			put( ('error', e) )
+
+	def __iter__( self ):
+		self.wait_time = 0.
+		if self.depth <= 0:
+			iterator = iter(self.loader)
+			while True:
+				time_start = time.time()
+				try:
+					batch = self.prepare( next(iterator) )
+				except StopIteration:
+					return
+				self.wait_time += time.time()-time_start
+				yield batch
+			return
+
+		batches = queue.Queue( maxsize=self.depth )
+		stop = threading.Event()
+		thread = threading.Thread( target=self.fill, args=(batches, stop) )
+		thread.daemon = True
+		thread.start()
+		try:
+			while True:
+				time_start = time.time()
+				kind, batch = batches.get()
+				if kind == 'batch' and self.gpu_mode:
+					torch.cuda.current_stream().wait_stream( self.stream )
+					# memory allocated on the side stream is now used by the default stream
+					map_tensors( lambda t: t.record_stream( torch.cuda.current_stream() ), batch )
+				self.wait_time += time.time()-time_start
+				if kind == 'end':
+					break
+				if kind == 'error':
+					raise batch
+				yield batch
+		finally:
+			# also reached when the training loop breaks out early
+			stop.set()
+			thread.join()
+
 def print_network(net):
 	num_params = 0
 	for param in net.parameters():
@@ -433,6 +1549,342 @@ def generate_animation(path, num):
 		images.append(imageio.imread(img_name))
 	imageio.mimsave(path + '_generate_animation.gif', images, fps=5)
 
+# training history : values of a key are appended step by step, tensors stay on their device until
+# flush_every of them are pending and are then copied out together, so a step costs no device sync.
+# flushed values live in float64 arrays grown by doubling and are appended to a binary log,
+#	<fname_log>			records of (key index uint16, value float64)
+#	<fname_log>.keys	key names, one per line, in order of their first value
+# the history pickle of a checkpoint only holds the length of every key (state_dict) and the log is cut back
+# to those lengths when training resumes (load_metric_store).
+METRIC_RECORD = np.dtype( [('key', '<u2'), ('value', '<f8')] )
+
+class MetricSeries(object):
+	def __init__( self, store, key, values=[], flush_every=100 ):
+		self.store = store
+		self.key = key
+		self.flush_every = max( 1, flush_every )
+		self.array = np.zeros( max(16, len(values)), dtype=np.float64 )
+		self.count = 0
+		# values since the last flush, those given as tensors are kept in buffer on their device
+		self.pending = np.zeros( self.flush_every, dtype=np.float64 )
+		self.on_device = np.zeros( self.flush_every, dtype=bool )
+		self.buffer = None
+		self.nPending = 0
+		self.write( np.asarray( values, dtype=np.float64 ) )
+
+	def append( self, value ):
+		"""
+		value is a number or a one element tensor, which is not read back until the next flush
+		"""
+		if not torch.is_tensor( value ) and hasattr( value, 'data' ) and torch.is_tensor( value.data ):
+			value = value.data
+		if torch.is_tensor( value ):
+			if self.buffer is not None and self.buffer.is_cuda != value.is_cuda:
+				self.flush()
+				self.buffer = None
+			if self.buffer is None:
+				self.buffer = value.new( self.flush_every ).double()
+			self.buffer[self.nPending:self.nPending+1].copy_( value.contiguous().view(-1)[:1] )
+			self.on_device[self.nPending] = True
+		else:
+			self.pending[self.nPending] = value
+			self.on_device[self.nPending] = False
+		self.nPending += 1
+		if self.nPending >= self.flush_every:
+			self.flush()
+
+	def flush( self ):
+		if self.nPending == 0:
+			return
+		values = self.pending[:self.nPending].copy()
+		on_device = self.on_device[:self.nPending]
+		if on_device.any():
+			# one copy, and one sync, for all values kept on device
+			values[on_device] = self.buffer[:self.nPending].cpu().numpy()[on_device]
+		self.nPending = 0
+		self.write( values )
+
+	def write( self, values ):
+		if self.count + len(values) > len(self.array):
+			array = np.zeros( max(2*len(self.array), self.count+len(values)), dtype=np.float64 )
+			array[:self.count] = self.array[:self.count]
+			self.array = array
+		self.array[self.count:self.count+len(values)] = values
+		self.count += len(values)
+		self.store.log( self.key, values )
+
+	def values( self ):
+		self.flush()
+		return self.array[:self.count]
+
+	def __len__( self ):
+		return self.count + self.nPending
+
+	def __getitem__( self, idx ):
+		return self.values()[idx]
+
+	def __iter__( self ):
+		return iter( self.values() )
+
+	def __array__( self, dtype=None ):
+		return self.values() if dtype is None else self.values().astype( dtype )
+
+class MetricStore(object):
+	"""
+	dict-like history of MetricSeries by key, logged to fname_log ('' keeps it in memory only).
+	assigning a list starts a series, anything else is kept as a scalar entry of the state_dict.
+	"""
+	def __init__( self, fname_log='', flush_every=100 ):
+		self.fname_log = fname_log
+		self.flush_every = flush_every
+		self.series = {}
+		self.scalars = {}
+		self.key_ids = {}
+		self.f_log = None
+		self.f_keys = None
+
+	def log( self, key, values ):
+		if len( self.fname_log ) == 0 or len( values ) == 0:
+			return
+		if self.f_log is None:
+			dir_log = os.path.dirname( self.fname_log )
+			if len( dir_log ) > 0 and not os.path.exists( dir_log ):
+				os.makedirs( dir_log )
+			# a fresh store starts a fresh log, load_metric_store reopens it for appending
+			mode = 'ab' if len( self.key_ids ) > 0 else 'wb'
+			self.f_log = open( self.fname_log, mode )
+			self.f_keys = open( self.fname_log + '.keys', mode )
+		if key not in self.key_ids:
+			self.key_ids[key] = len( self.key_ids )
+			self.f_keys.write( (key+'\n').encode('utf-8') )
+		records = np.zeros( len(values), dtype=METRIC_RECORD )
+		records['key'] = self.key_ids[key]
+		records['value'] = values
+		self.f_log.write( records.tobytes() )
+
+	def flush( self ):
+		for series in self.series.values():
+			series.flush()
+		if self.f_log is not None:
+			self.f_keys.flush()
+			self.f_log.flush()
+
+	def close( self ):
+		self.flush()
+		if self.f_log is not None:
+			self.f_keys.close()
+			self.f_log.close()
+			self.f_log = None
+			self.f_keys = None
+
+	def __setitem__( self, key, value ):
+		if isinstance( value, (list, tuple, np.ndarray) ):
+			self.scalars.pop( key, None )
+			self.series[key] = MetricSeries( self, key, value, self.flush_every )
+		else:
+			self.series.pop( key, None )
+			self.scalars[key] = value
+
+	def __getitem__( self, key ):
+		if key in self.series:
+			return self.series[key]
+		return self.scalars[key]
+
+	def __contains__( self, key ):
+		return key in self.series or key in self.scalars
+
+	def keys( self ):
+		return list( self.series.keys() ) + list( self.scalars.keys() )
+
+	def items( self ):
+		return [ (key, self[key]) for key in self.keys() ]
+
+	def iteritems( self ):
+		return iter( self.items() )
+
+	def state_dict( self ):
+		"""
+		lengths of the series and the scalars, what a checkpoint keeps of the history
+		"""
+		self.flush()
+		return { 'metric_lengths': dict( (key, len(series)) for key, series in self.series.items() ),
+					'metric_scalars': dict( self.scalars ) }
+
+def read_metric_log( fname_log ):
+	"""
+	values of every key in a metric log, a record cut short by a crash is dropped
+	"""
+	with open( fname_log + '.keys', 'rb' ) as f:
+		keys = f.read().decode('utf-8').splitlines()
+	with open( fname_log, 'rb' ) as f:
+		buf = f.read()
+	records = np.frombuffer( buf, dtype=METRIC_RECORD, count=len(buf)//METRIC_RECORD.itemsize )
+	return dict( (key, records['value'][records['key'] == i]) for i, key in enumerate(keys) )
+
+def load_metric_store( state, fname_log, flush_every=100 ):
+	"""
+	MetricStore of a checkpoint : state is what state_dict() returned, or a dict of lists pickled by older versions.
+	series are read from fname_log, cut back to the lengths of the checkpoint and the log is rewritten to match.
+	"""
+	store = MetricStore( fname_log, flush_every )
+	if 'metric_lengths' not in state:
+		for key, value in state.items():
+			store[key] = value
+		return store
+	values = read_metric_log( fname_log ) if os.path.exists( fname_log ) else {}
+	for key, length in state['metric_lengths'].items():
+		if len( values.get(key, []) ) < length:
+			print( '[warning] {} holds {} of {} values of {}'.format(fname_log, len(values.get(key, [])), length, key) )
+		store[key] = values.get( key, np.zeros(0) )[:length]
+	for key, value in state['metric_scalars'].items():
+		store[key] = value
+	store.flush()
+	return store
+
+# os.rename replaces an existing file atomically on posix only
+replace_file = getattr( os, 'replace', os.rename )
+
+def cpu_copy( tensor ):
+	return tensor.cpu() if tensor.is_cuda else tensor.clone()
+
+def unwrap_module( module ):
+	return module.module if isinstance( module, nn.DataParallel ) else module
+
+class Checkpointer(object):
+	"""
+	checkpoints of the modules and optimizers of a model (dicts by name) with its history and data position,
+	and of states, other objects with state_dict() and load_state_dict() such as an UpdateGate.
+	the state is copied to the cpu and written by a background thread to a temp file renamed into place,
+	so training does not wait on the disk and a crash leaves the earlier checkpoints whole.
+	the keep_last latest checkpoints are kept, and the end of every keep_every-th epoch (0 for none).
+	"""
+	def __init__( self, save_dir, model_name, modules, optimizers={}, keep_last=3, keep_every=0, states={} ):
+		self.save_dir = save_dir
+		self.model_name = model_name
+		self.prefix = model_name + '_ckpt_'
+		self.modules = modules
+		self.optimizers = optimizers
+		self.states = states
+		self.keep_last = max( 1, keep_last )
+		self.keep_every = keep_every
+		self.thread = None
+		self.error = None
+
+	def checkpoints( self ):
+		"""
+		(epoch, position, filename) of the checkpoints in save_dir, oldest first
+		"""
+		if not os.path.exists( self.save_dir ):
+			return []
+		found = []
+		for fname in os.listdir( self.save_dir ):
+			if not fname.startswith( self.prefix ) or not fname.endswith( '.pkl' ):
+				continue
+			try:
+				epoch, position = [int(s) for s in fname[len(self.prefix):-len('.pkl')].split('_')]
+			except ValueError:
+				continue
+			found.append( (epoch, position, fname) )
+		return sorted( found )
+
+	def save( self, train_hist, data_loader=None ):
+		"""
+		checkpoint of the epochs completed in train_hist and the samples of the data_loader consumed since
+		"""
+		self.wait()
+		position = data_position( data_loader ) if data_loader is not None else None
+		state = { 'modules': dict( (name, map_tensors( cpu_copy, unwrap_module(module).state_dict() ))
+									for name, module in self.modules.items() ),
+				'optimizers': dict( (name, map_tensors( cpu_copy, optimizer.state_dict() ))
+									for name, optimizer in self.optimizers.items() ),
+				'states': dict( (name, obj.state_dict()) for name, obj in self.states.items() ),
+				'history': train_hist.state_dict(),
+				'data_position': position.state_dict() if position is not None else None }
+		fname = '{}{:04d}_{:08d}.pkl'.format( self.prefix, len(train_hist['per_epoch_time']),
+												position.position if position is not None else 0 )
+		if not os.path.exists( self.save_dir ):
+			os.makedirs( self.save_dir )
+		self.thread = threading.Thread( target=self.write, args=(state, fname) )
+		self.thread.start()
+
+	def write( self, state, fname ):
+		path = os.path.join( self.save_dir, fname )
+		try:
+			with open( path + '.tmp', 'wb' ) as f:
+				torch.save( state, f )
+				f.flush()
+				os.fsync( f.fileno() )
+			replace_file( path + '.tmp', path )
+			self.prune()
+		except Exception as e:
+			print( '[warning] checkpoint {} is not written: {}'.format( path, e ) )
+			self.error = e
+
+	def prune( self ):
+		checkpoints = self.checkpoints()
+		for epoch, position, fname in checkpoints[:-self.keep_last]:
+			if position == 0 and epoch > 0 and self.keep_every > 0 and epoch % self.keep_every == 0:
+				continue
+			os.remove( os.path.join( self.save_dir, fname ) )
+		# temp files of writes cut short by a crash, this thread is the only writer
+		for fname in os.listdir( self.save_dir ):
+			if fname.startswith( self.prefix ) and fname.endswith( '.tmp' ):
+				os.remove( os.path.join( self.save_dir, fname ) )
+
+	def wait( self ):
+		"""
+		block until the checkpoint being written is on disk, raising the error of its write if any
+		"""
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+
+	def legacy_state( self ):
+		"""
+		state of the <model_name>_<name>.pkl, _history.pkl and _data.pkl files written by older versions
+		"""
+		fname = lambda suffix: os.path.join( self.save_dir, self.model_name + suffix )
+		state = { 'modules': dict( (name, torch.load( fname('_' + name + '.pkl'), map_location=lambda storage, loc: storage ))
+									for name in self.modules ),
+				'optimizers': {}, 'states': {}, 'history': None, 'data_position': None }
+		for key, suffix in [('history', '_history.pkl'), ('data_position', '_data.pkl')]:
+			if os.path.exists( fname(suffix) ):
+				with open( fname(suffix), 'rb' ) as f:
+					state[key] = pickle.load( f )
+		return state
+
+	def load( self, data_loader=None ):
+		"""
+		restore the modules, optimizers, states and data position from the latest checkpoint and return its state,
+		'history' of which is None if it was not saved
+		"""
+		self.wait()
+		checkpoints = self.checkpoints()
+		if len( checkpoints ) > 0:
+			fname = os.path.join( self.save_dir, checkpoints[-1][2] )
+			print( 'loading from {}...'.format( fname ) )
+			state = torch.load( fname, map_location=lambda storage, loc: storage )
+		else:
+			print( 'loading from {}...'.format( self.save_dir ) )
+			state = self.legacy_state()
+
+		for name, module in self.modules.items():
+			unwrap_module( module ).load_state_dict( state['modules'][name] )
+		for name, optimizer in self.optimizers.items():
+			if name in state['optimizers']:
+				optimizer.load_state_dict( state['optimizers'][name] )
+		for name, obj in self.states.items():
+			if name in state.get( 'states', {} ):
+				obj.load_state_dict( state['states'][name] )
+		if data_loader is not None and state['data_position'] is not None:
+			position = data_position( data_loader )
+			position.load_state_dict( state['data_position'] )
+			print( 'data position restored: epoch {} sample {}'.format( position.epoch+1, position.position ) )
+		return state
+
 def loss_plot(hist, path='.', model_name='model', y_max=None, use_subplot=False, keys_to_show=[] ):
 	try:
 		x = range(len(hist['D_loss']))
@@ -451,8 +1903,8 @@ def loss_plot(hist, path='.', model_name='model', y_max=None, use_subplot=False,
 
 	if len(keys_to_show) == 0:
 		keys_to_show = hist.keys()
-	for key,value in hist.iteritems():
-		if 'time' in key or key not in keys_to_show:
+	for key,value in hist.items():
+		if 'time' in key or key not in keys_to_show or not hasattr(value, '__len__'):
 			continue
 		y = value
 		if len(x) != len(y):
@@ -526,16 +1978,59 @@ class Inflate(nn.Module):
 		return x.view(shape)
 
 
+def pairwise_l1( x, max_elements=2**24 ):
+	"""
+	(N,N) L1 distances between the rows of x, summed over column chunks so that
+	the N*N*chunk temporaries of cdist and its backward stay under max_elements
+	"""
+	chunk = max( 1, max_elements//(x.size(0)*x.size(0)) )
+	dist = 0
+	# split, unlike slicing, does not backpropagate a full-size gradient per chunk
+	for xc in x.split( chunk, 1 ):
+		if hasattr( torch, 'cdist' ):
+			dist = dist + torch.cdist( xc, xc, p=1 )
+		else:
+			dist = dist + torch.abs( xc.unsqueeze(1) - xc.unsqueeze(0) ).sum(2)
+	return dist
+
+class PairwiseDistanceLoss(nn.Module):
+	"""
+	distance preservation loss of the dist option : the L1 distances of a sample to the rest of the batch
+	should be as far from the dataset mean in units of stddev for images (muA, stddevA) as for voxels (muB, stddevB)
+	"""
+	def __init__(self, dataset, max_elements=2**24):
+		super(PairwiseDistanceLoss, self).__init__()
+		if dataset.stddevA is None or dataset.stddevB is None:
+			exit( 'dist loss needs stats.pkl, make it with preprocess.py --target bosphorus_stats' )
+		self.stddevA = dataset.stddevA
+		self.stddevB = dataset.stddevB
+		self.normalizerA = dataset.muA/dataset.stddevA
+		self.normalizerB = dataset.muB/dataset.stddevB
+		self.max_elements = max_elements
+
+	def forward(self, xA, xB):
+		batch_size = xA.size(0)
+		nPairs = batch_size*(batch_size-1)
+		sumA = pairwise_l1( xA.contiguous().view(batch_size, -1), self.max_elements ).sum(0)
+		sumB = pairwise_l1( xB.contiguous().view(batch_size, -1), self.max_elements ).sum(0)
+		sumA = sumA / self.stddevA / nPairs
+		sumB = sumB / self.stddevB / nPairs
+		return torch.abs( torch.sum( sumA - sumB - self.normalizerA + self.normalizerB ) ) / batch_size
+
+
 def parse_args():
 	desc = "plot loss"
 	parser = argparse.ArgumentParser(description=desc)
 
-	parser.add_argument('--fname_hist', type=str, default='', help='history path', required=True)
+	parser.add_argument('--fname_hist', type=str, default='', help='history path, or metric log (<model_name>_metrics)', required=True)
 	parser.add_argument('--fname_dest', type=str, default='.', help='filename of png')
 	return parser.parse_args()
 
 if __name__ == '__main__':
 	opts = parse_args()
-	with open( opts.fname_hist ) as fhandle:
-		history = pickle.load(fhandle)
-		loss_plot( history, opts.fname_dest )
+	if os.path.exists( opts.fname_hist + '.keys' ):
+		history = read_metric_log( opts.fname_hist )
+	else:
+		with open( opts.fname_hist, 'rb' ) as fhandle:
+			history = pickle.load(fhandle)
+	loss_plot( history, opts.fname_dest )
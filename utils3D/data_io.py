@@ -9,9 +9,12 @@ import h5py
 import binvox_rw
 import struct
 
-import pdb
-
-def read_bnt(path):
+def read_bnt(path, mmap=False):
+	"""
+	read a Bosphorus .bnt file
+	the point block is exposed as a Nx5 (x,y,z,u,v) view of the file bytes, or of a
+	read-only memory map when mmap is set, without decoding it value by value.
+	"""
 	with open(path, 'rb') as f:
 		nrows	= struct.unpack('h',f.read(2))[0]
 		ncols	= struct.unpack('h',f.read(2))[0]
@@ -19,78 +22,130 @@ def read_bnt(path):
 		length	= struct.unpack('h',f.read(2))[0]
 		imfile	= f.read(length)
 		length	= struct.unpack('I',f.read(4))[0]
-		pcl		= struct.unpack('d'*length,f.read(length*8))
-		pcl		= np.array(pcl).reshape(5,length/5).transpose()
+		if mmap:
+			pcl = np.memmap(f, dtype=np.float64, mode='r', offset=f.tell(), shape=(length,))
+		else:
+			pcl = np.frombuffer(f.read(length*8), dtype=np.float64)
+		pcl		= pcl.reshape(5,length//5).transpose()
 	
 	return pcl, nrows, ncols, imfile
 
-def bnt2voxel(pcl,shape=64, center=True):
+def bnt2index(pcl, shape=64, center=True):
+	"""
+	compute voxel indices of all points of pcl at once
+	returns flat indices into a shape^3 grid (one per kept point, in point order)
+	and a boolean mask of the points that were kept.
+	"""
 	# compute ratio
 	maxs = pcl[:,:3].max(0)
 	mins = pcl[:,:3].min(0)
 	centers = (maxs + mins)/2
-	xmax, ymax, zmax = maxs
-	xmin, ymin, zmin = mins
-	xc, yc, zc = centers
 	raw_shape = maxs-mins
-	ratio =float(shape-1)/raw_shape
+	ratio = float(shape-1)/raw_shape
 	ratio_min = min(ratio)
-	ratio = [ratio_min,ratio_min,ratio_min]
-	voxel_shape = (1,)+(shape,)*3
-	voxel = np.zeros(voxel_shape)
+
+	# same arithmetic as int(x)-xc, int(xx*ratio+shape/2) applied per point
+	xyz = np.trunc(pcl[:,:3])
+	if center:
+		coords = (xyz-centers)*ratio_min + shape//2
+	else:
+		coords = (xyz-mins)*ratio_min
+	coords = coords.astype(np.int64) # truncates toward zero like int()
+
+	# numpy indexing accepts [-shape,shape) and wraps negative indices
+	valid = np.all((coords >= -shape) & (coords < shape), axis=1)
+	coords = coords[valid] % shape
+	indices = np.ravel_multi_index(coords.T, (shape,)*3)
+
+	return indices, valid
+
+def bnt2sparse(pcl, shape=64, center=True):
+	"""
+	unique flat indices of the occupied cells of a shape^3 grid and the mask of kept points
+	"""
+	indices, valid = bnt2index(pcl, shape, center)
+	return np.unique(indices), valid
+
+def bnt2voxel(pcl,shape=64, center=True, return_clipped=False, dtype=np.float64):
+	cells, valid = bnt2sparse(pcl, shape, center)
 
 	# fill voxel
-	for i in range(pcl.shape[0]):
-		x,y,z,_,_ = pcl[i]
-		try:
-			if center:
-				xx,yy,zz = int(x)-xc,int(y)-yc,int(z)-zc
-				voxel[0,int(xx*ratio[0]+shape/2),int(yy*ratio[1]+shape/2),int(zz*ratio[2]+shape/2)] = 1
-			else:
-				xx,yy,zz = int(x)-xmin,int(y)-ymin,int(z)-zmin
-				voxel[0,int(xx*ratio[0]),int(yy*ratio[1]),int(zz*ratio[2])] = 1
-		except:
-			print( x,y,z )
-			print( int(x)-xmin,int(y)-ymin,int(z)-zmin )
+	voxel_shape = (1,)+(shape,)*3
+	voxel = np.zeros(voxel_shape, dtype=dtype)
+	voxel.reshape(-1)[cells] = 1
+
+	if return_clipped:
+		return voxel, pcl[~valid]
 	return voxel
 
-def bnt2voxel_wColor(pcl, image, shape=64, center=True):
-	# compute ratio
-	maxs = pcl[:,:3].max(0)
-	mins = pcl[:,:3].min(0)
-	centers = (maxs + mins)/2
-	xmax, ymax, zmax = maxs
-	xmin, ymin, zmin = mins
-	xc, yc, zc = centers
-	raw_shape = maxs-mins
-	ratio =float(shape-1)/raw_shape
-	ratio_min = min(ratio)
-	ratio = [ratio_min,ratio_min,ratio_min]
-	voxel_shape = (4,)+(shape,)*3
-	voxel = np.zeros(voxel_shape)
+def sample_uv(image, u, v, sample='nearest'):
+	"""
+	gather colors of a CxHxW image at texture coordinates (u,v) in [0,1]
+	returns an array of shape (len(u), C)
+	"""
+	if hasattr(image, 'numpy'):
+		image = image.numpy()
+	image = np.asarray(image)
+	H, W = image.shape[1], image.shape[2]
+
+	if sample == 'nearest':
+		rows = np.clip((v*H).astype(np.int64), 0, H-1)
+		cols = np.clip((u*W).astype(np.int64), 0, W-1)
+		return image[:,rows,cols].T
+	elif sample == 'bilinear':
+		py = np.clip(v*H-0.5, 0, H-1)
+		px = np.clip(u*W-0.5, 0, W-1)
+		r0 = np.floor(py).astype(np.int64)
+		c0 = np.floor(px).astype(np.int64)
+		r1 = np.minimum(r0+1, H-1)
+		c1 = np.minimum(c0+1, W-1)
+		wy = py-r0
+		wx = px-c0
+		colors = image[:,r0,c0]*(1-wy)*(1-wx) + image[:,r0,c1]*(1-wy)*wx \
+				+ image[:,r1,c0]*wy*(1-wx) + image[:,r1,c1]*wy*wx
+		return colors.T
+	else:
+		raise ValueError('unknown sampling method: {}'.format(sample))
+
+def bnt2sparse_wColor(pcl, image, shape=64, center=True, sample='nearest', collision='last'):
+	"""
+	unique flat indices of the occupied cells, their (K,C) colors and the mask of kept points
+	collision decides the color of a voxel hit by several points:
+	'last' keeps the color of the last point as the per-point loop did, 'mean' averages them
+	"""
+	indices, valid = bnt2index(pcl, shape, center)
+	colors = sample_uv(image, pcl[valid,3], pcl[valid,4], sample)
+
+	if collision == 'last':
+		cells, first = np.unique(indices[::-1], return_index=True)
+		colors = colors[len(indices)-1-first]
+	elif collision == 'mean':
+		cells, inverse, counts = np.unique(indices, return_inverse=True, return_counts=True)
+		colors = np.stack([np.bincount(inverse, weights=colors[:,c], minlength=len(cells))/counts
+							for c in range(colors.shape[1])], 1)
+	else:
+		raise ValueError('unknown collision rule: {}'.format(collision))
+	return cells, colors, valid
+
+def bnt2voxel_wColor(pcl, image, shape=64, center=True, sample='nearest', collision='last', return_clipped=False,
+						dtype=np.float64):
+	"""
+	fill occupancy and color channels of a (1+C)xshape^3 voxel from pcl and its texture image
+	with an integer dtype (np.uint8) colors are stored in 0-255 instead of [0,1]
+	"""
+	cells, colors, valid = bnt2sparse_wColor(pcl, image, shape, center, sample, collision)
+	if np.issubdtype(np.dtype(dtype), np.integer):
+		colors = np.rint(colors*255)
 
 	# fill voxel
-	for i in range(pcl.shape[0]):
-		x,y,z,u,v = pcl[i]
-		r,g,b = image[:,v*image.shape[1],u*image.shape[2]]
-		try:
-			if center:
-				xx,yy,zz = int(x)-xc,int(y)-yc,int(z)-zc
-				voxel[0,int(xx*ratio[0]+shape/2),int(yy*ratio[1]+shape/2),int(zz*ratio[2]+shape/2)] = 1
-				voxel[1,int(xx*ratio[0]+shape/2),int(yy*ratio[1]+shape/2),int(zz*ratio[2]+shape/2)] = r
-				voxel[2,int(xx*ratio[0]+shape/2),int(yy*ratio[1]+shape/2),int(zz*ratio[2]+shape/2)] = g
-				voxel[3,int(xx*ratio[0]+shape/2),int(yy*ratio[1]+shape/2),int(zz*ratio[2]+shape/2)] = b
-			else:
-				xx,yy,zz = int(x)-xmin,int(y)-ymin,int(z)-zmin
-				voxel[0,int(xx*ratio[0]),int(yy*ratio[1]),int(zz*ratio[2])] = 1
-				voxel[1,int(xx*ratio[0]),int(yy*ratio[1]),int(zz*ratio[2])] = r
-				voxel[2,int(xx*ratio[0]),int(yy*ratio[1]),int(zz*ratio[2])] = g
-				voxel[3,int(xx*ratio[0]),int(yy*ratio[1]),int(zz*ratio[2])] = b
-		except:
-			print( x,y,z )
-			print( xx,yy,zz )
-			print( xx*ratio[0]+shape/2, yy*ratio[1]+shape/2, zz*ratio[2]+shape/2 )
-			pdb.set_trace()
+	nCh = colors.shape[1]
+	voxel = np.zeros((1+nCh,)+(shape,)*3, dtype=dtype)
+	flat = voxel.reshape(1+nCh,-1)
+	flat[0,cells] = 1
+	flat[1:,cells] = colors.T
+
+	if return_clipped:
+		return voxel, pcl[~valid]
 	return voxel
 
 
@@ -119,16 +174,74 @@ def resize(voxel, shape, square=True):
 	voxel[np.nonzero(voxel)] = 1.0
 	return voxel
 
-def read_binvox(path, shape=(64,64,64), fix_coords=True):
+def max_pool_half(voxel):
+	"""
+	2x2x2 block max-pooling of a bool cube, one strided OR per axis
+	"""
+	n = voxel.shape[0]//2
+	voxel = voxel.reshape(-1,2)
+	voxel = (voxel[:,0] | voxel[:,1]).reshape(2*n,2*n,n)
+	voxel = voxel.reshape(2*n,n,2,n)
+	voxel = voxel[:,:,0] | voxel[:,:,1]
+	voxel = voxel.reshape(n,2,n*n)
+	return (voxel[:,0] | voxel[:,1]).reshape(n,n,n)
+
+def decode_binvox(path, resolution=None, fix_coords=True):
+	"""
+	occupancy of a .binvox file as a bool (resolution,)*3 grid, decoded straight from its RLE
+	power-of-two downsampling is done by block max-pooling, other resolutions fall back to resize()
+	"""
+	with open(path, 'rb') as f:
+		dims, translate, scale = binvox_rw.read_header(f)
+		raw_data = np.frombuffer(f.read(), dtype=np.uint8)
+	values, counts = raw_data[::2], raw_data[1::2]
+
+	# +1 at the start and -1 at the end of every filled run, the running sum is the occupancy
+	ends = np.cumsum(counts, dtype=np.int64)
+	filled = (values > 0) & (counts > 0)
+	edges = np.zeros(ends[-1]+1, dtype=np.int8)
+	edges[(ends-counts)[filled]] += 1
+	edges[ends[filled]] -= 1
+	voxel = np.cumsum(edges[:-1], dtype=np.int8).view(np.bool_).reshape(dims)
+
+	if resolution is not None and resolution != dims[0]:
+		ratio = dims[0]//resolution
+		if dims[0] == dims[1] == dims[2] and ratio*resolution == dims[0] and ratio & (ratio-1) == 0:
+			# pooling is done in the xzy order of the file, it commutes with the transpose below
+			while voxel.shape[0] > resolution:
+				voxel = max_pool_half(voxel)
+		else:
+			voxel = resize(voxel.astype(np.float64), (resolution,)*3) > 0
+	if fix_coords:
+		# xzy to xyz as binvox_rw.read_as_3d_array
+		voxel = np.transpose(voxel, (0,2,1))
+	return np.ascontiguousarray(voxel)
+
+def read_binvox_packed(path, resolution=64, fix_coords=True):
+	"""
+	np.packbits of the occupancy of a .binvox file at resolution^3
+	"""
+	return np.packbits(decode_binvox(path, resolution, fix_coords).reshape(-1))
+
+def unpack_voxel(packed, resolution=64, dtype=np.float64):
+	"""
+	inverse of read_binvox_packed
+	"""
+	return np.unpackbits(packed)[:resolution**3].reshape((resolution,)*3).astype(dtype)
+
+def read_binvox(path, shape=(64,64,64), fix_coords=True, dtype=np.float64):
 	"""
 	read voxel data from .binvox file
 	"""
+	if shape is not None and shape[0] == shape[1] == shape[2]:
+		return decode_binvox(path, shape[0], fix_coords).astype(dtype)
+
 	with open(path, 'rb') as f:
 		voxel = binvox_rw.read_as_3d_array(f, fix_coords)
 	
-	voxel_data = voxel.data.astype(np.float)
+	voxel_data = voxel.data.astype(dtype)
 	if shape is not None and voxel_data.shape != shape:
-		voxel_data = resize(voxel.data.astype(np.float64), shape)
+		voxel_data = resize(voxel.data.astype(np.float64), shape).astype(dtype)
 
 	return voxel_data
 
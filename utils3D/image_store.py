@@ -0,0 +1,66 @@
+#
+# preprocessed image store : decoded, resized uint8 images in a single memory-mapped array.
+#
+# layout of a store directory
+#	images.npy			(N, H, W, nChannels) uint8, HxWxC as fed to transforms.ToTensor()
+#						image_shape is an int for square images or (H, W)
+#	meta.pkl			image_shape, filenames (one per row) and any extra metadata of the writer
+#
+
+import os, pickle
+import numpy as np
+
+class ImageStoreWriter(object):
+	def __init__(self, dir_store, filenames, image_shape, nChannels=3, meta={}):
+		if not os.path.exists(dir_store):
+			os.makedirs(dir_store)
+		self.dir_store = dir_store
+		self.filenames = list(filenames)
+		self.image_shape = image_shape
+		self.meta = dict(meta)
+
+		shape = (image_shape, image_shape) if isinstance(image_shape, int) else tuple(image_shape)
+		self.images = np.lib.format.open_memmap(os.path.join(dir_store, 'images.npy'), mode='w+',
+									dtype=np.uint8, shape=(len(self.filenames),)+shape+(nChannels,))
+		self.count = 0
+
+	def append(self, image):
+		"""
+		image is a (H,W,nChannels) uint8 array
+		"""
+		self.images[self.count] = image
+		self.count += 1
+
+	def close(self):
+		assert self.count == len(self.filenames), 'store expects {} images, got {}'.format(len(self.filenames), self.count)
+		self.images.flush()
+		del self.images
+		meta = dict(self.meta)
+		meta.update({'image_shape': self.image_shape, 'filenames': self.filenames})
+		with open(os.path.join(self.dir_store, 'meta.pkl'), 'wb') as f:
+			pickle.dump(meta, f)
+
+class ImageStore(object):
+	def __init__(self, dir_store):
+		with open(os.path.join(dir_store, 'meta.pkl'), 'rb') as f:
+			self.meta = pickle.load(f)
+		self.image_shape = self.meta['image_shape']
+		self.filenames = self.meta['filenames']
+		self.images = np.load(os.path.join(dir_store, 'images.npy'), mmap_mode='r')
+
+	def __len__(self):
+		return self.images.shape[0]
+
+	def rows(self, filenames):
+		"""
+		row of each filename, None if any of them is not in the store
+		"""
+		rowmap = dict((os.path.basename(fname), i) for i, fname in enumerate(self.filenames))
+		try:
+			return np.array([rowmap[os.path.basename(fname)] for fname in filenames], dtype=np.int64)
+		except KeyError:
+			return None
+
+	def get(self, row):
+		# copy out of the memmap so the page cache is not pinned by the returned array
+		return np.array(self.images[row])
@@ -0,0 +1,128 @@
+#
+# mean and standard deviation of the L1 distances between all pairs of samples, the normalization of the dist loss
+# (muA, stddevA over face images and muB, stddevB over voxels in stats.pkl).
+#
+# pairs are visited row by row, each row against the samples after it in chunks, and the distances are folded into
+# running statistics so that memory does not grow with the number of pairs. rows are dealt to processes which
+# share the samples through fork.
+#
+
+import numpy as np
+from multiprocessing import Pool
+
+class RunningStats(object):
+	"""
+	count, mean and sum of squared deviations of a stream of values, merged chunk by chunk (Welford, Chan et al.)
+	"""
+	def __init__(self, count=0, mean=0., m2=0.):
+		self.count = count
+		self.mean = mean
+		self.m2 = m2
+
+	def update(self, values):
+		values = np.asarray(values, dtype=np.float64)
+		if len(values) == 0:
+			return
+		mean = values.mean()
+		self.merge(RunningStats(len(values), mean, np.square(values-mean).sum()))
+
+	def merge(self, other):
+		count = self.count + other.count
+		if count == 0:
+			return
+		delta = other.mean - self.mean
+		self.mean += delta*other.count/count
+		self.m2 += other.m2 + delta*delta*self.count*other.count/count
+		self.count = count
+
+	def std(self):
+		return np.sqrt(self.m2/self.count) if self.count > 0 else 0.
+
+class PairSamples(object):
+	"""
+	images (N, D) uint8 and sparse voxels, flat indices of occupied cells and their (nCells, nChannels-1) uint8 colors,
+	concatenated so that the voxels of consecutive samples are one slice
+	"""
+	def __init__(self, images, cells, colors, nCells):
+		self.images = images
+		self.nCells = nCells
+		self.counts = np.array([len(c) for c in cells], dtype=np.int64)
+		self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+		self.cells = np.concatenate(cells).astype(np.int64)
+		self.owner = np.repeat(np.arange(len(cells)), self.counts)
+		self.colors = None
+		self.colorsums = np.zeros(len(cells), dtype=np.int64)
+		if colors is not None and colors[0].shape[1] > 0:
+			self.colors = np.concatenate(colors).astype(np.int32)
+			self.colorsums = np.bincount(self.owner, weights=self.colors.sum(1), minlength=len(cells)).astype(np.int64)
+		self.marker = None
+
+	def __len__(self):
+		return len(self.counts)
+
+	def image_l1(self, i, j0, j1):
+		# |a-b| = max(a,b)-min(a,b) stays in uint8
+		images, image = self.images[j0:j1], self.images[i]
+		diff = np.maximum(images, image)
+		diff -= np.minimum(images, image)
+		return diff.sum(1, dtype=np.int64) / 255.
+
+	def voxel_l1(self, i, j0, j1):
+		"""
+		|a-b| = a+b-2min(a,b) for non-negative values, so only cells occupied in both voxels are visited
+		"""
+		if self.marker is None:
+			self.marker = np.full(self.nCells, -1, dtype=np.int64)
+		cells_i = self.cells[self.offsets[i]:self.offsets[i+1]]
+		self.marker[cells_i] = np.arange(len(cells_i))
+
+		lo, hi = self.offsets[j0], self.offsets[j1]
+		hits = self.marker[self.cells[lo:hi]]
+		both = np.flatnonzero(hits >= 0)
+		owner = self.owner[lo:hi][both] - j0
+		nBoth = np.bincount(owner, minlength=j1-j0)
+		dist = self.counts[i] + self.counts[j0:j1] - 2*nBoth
+		if self.colors is not None:
+			common = np.minimum(self.colors[self.offsets[i]+hits[both]], self.colors[lo+both]).sum(1)
+			common = np.bincount(owner, weights=common, minlength=j1-j0)
+			dist = dist + (self.colorsums[i] + self.colorsums[j0:j1] - 2*common) / 255.
+
+		self.marker[cells_i] = -1
+		return dist
+
+# samples of the running computation, inherited by the forked workers
+_samples = None
+
+def row_stats(args):
+	rows, chunk = args
+	statsA, statsB = RunningStats(), RunningStats()
+	for i in rows:
+		for j0 in range(i+1, len(_samples), chunk):
+			j1 = min(j0+chunk, len(_samples))
+			statsA.update(_samples.image_l1(i, j0, j1))
+			statsB.update(_samples.voxel_l1(i, j0, j1))
+	return (statsA.count, statsA.mean, statsA.m2), (statsB.count, statsB.mean, statsB.m2)
+
+def pairwise_l1_stats(samples, num_workers=1, chunk=64):
+	"""
+	muA, stddevA of image distances and muB, stddevB of voxel distances over all pairs of PairSamples
+	"""
+	global _samples
+	_samples = samples
+	# rows are interleaved so that every task gets short and long rows alike
+	nTasks = max(1, num_workers)*8
+	tasks = [(range(k, len(samples), nTasks), chunk) for k in range(nTasks)]
+	if num_workers > 1:
+		pool = Pool(num_workers)
+		results = pool.map(row_stats, tasks)
+		pool.close()
+		pool.join()
+	else:
+		results = [row_stats(task) for task in tasks]
+	_samples = None
+
+	statsA, statsB = RunningStats(), RunningStats()
+	for resultA, resultB in results:
+		statsA.merge(RunningStats(*resultA))
+		statsB.merge(RunningStats(*resultB))
+	return {'muA': statsA.mean, 'stddevA': statsA.std(), 'muB': statsB.mean, 'stddevB': statsB.std(), 'nPairs': statsA.count}
@@ -0,0 +1,133 @@
+#
+# sharded store of paired 2D/3D samples : records are packed back to back into large shard files
+# so that an epoch is a few long sequential reads instead of a .bnt and a .png per sample.
+#
+# layout of a store directory
+#	shard_00000.bin ...	records of consecutive samples, each record is
+#						image		(image_shape, image_shape, 3) uint8
+#						occupancy	(shape^3/8,) uint8, np.packbits of the occupancy grid
+#						colors		(nColors, nChannels-1) uint8, colors of occupied cells in np.flatnonzero order
+#	index.npy			(N, 3) int64, shard, byte offset and nColors of every record
+#	labels.npy			(N, len(label_keys)) int64
+#	meta.pkl			shape, nChannels, image_shape, label_keys, nShards and any extra metadata of the writer
+#
+# ShardStore(dir_store, shape) serves a coarser shape dividing the stored one, pooled as in voxel_store.pool_sparse.
+#
+
+import os, pickle
+import numpy as np
+
+from voxel_store import dense_voxel, pool_sparse
+
+def shard_name(dir_store, shard):
+	return os.path.join(dir_store, 'shard_{:05d}.bin'.format(shard))
+
+class ShardWriter(object):
+	def __init__(self, dir_store, shape, image_shape, nChannels=4, label_keys=[], meta={}, shard_size=256):
+		if not os.path.exists(dir_store):
+			os.makedirs(dir_store)
+		self.dir_store = dir_store
+		self.shape = shape
+		self.image_shape = image_shape
+		self.nChannels = nChannels
+		self.label_keys = list(label_keys)
+		self.meta = dict(meta)
+		self.shard_size = shard_size
+
+		self.index = []
+		self.labels = []
+		self.f_shard = None
+		self.nShards = 0
+
+	def append(self, image, cells, colors, labels=[]):
+		"""
+		image is a (image_shape,image_shape,3) uint8 array, cells the sorted flat indices of occupied voxels
+		and colors their (len(cells),nChannels-1) uint8 colors
+		"""
+		if len(self.index) % self.shard_size == 0:
+			if self.f_shard is not None:
+				self.f_shard.close()
+			self.f_shard = open(shard_name(self.dir_store, self.nShards), 'wb')
+			self.nShards += 1
+		occupied = np.zeros(self.shape**3, dtype=np.bool_)
+		occupied[cells] = True
+
+		self.index.append((self.nShards-1, self.f_shard.tell(), len(cells)))
+		self.f_shard.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+		self.f_shard.write(np.packbits(occupied).tobytes())
+		self.f_shard.write(np.ascontiguousarray(colors, dtype=np.uint8).tobytes())
+		self.labels.append(labels)
+
+	def close(self):
+		if self.f_shard is not None:
+			self.f_shard.close()
+		np.save(os.path.join(self.dir_store, 'index.npy'), np.array(self.index, dtype=np.int64).reshape(-1,3))
+		np.save(os.path.join(self.dir_store, 'labels.npy'),
+				np.array(self.labels, dtype=np.int64).reshape(-1,len(self.label_keys)))
+		meta = dict(self.meta)
+		meta.update({'shape': self.shape, 'nChannels': self.nChannels, 'image_shape': self.image_shape,
+					'label_keys': self.label_keys, 'nShards': self.nShards})
+		with open(os.path.join(self.dir_store, 'meta.pkl'), 'wb') as f:
+			pickle.dump(meta, f)
+
+class ShardStore(object):
+	def __init__(self, dir_store, shape=None):
+		with open(os.path.join(dir_store, 'meta.pkl'), 'rb') as f:
+			self.meta = pickle.load(f)
+		self.dir_store = dir_store
+		# coarser shapes than the stored one are pooled on the fly
+		self.factor = 1
+		if shape is not None and shape != self.meta['shape']:
+			assert self.meta['shape'] % shape == 0, '{} holds shape={}, which does not pool to {}'.format(dir_store, self.meta['shape'], shape)
+			self.factor = self.meta['shape']//shape
+		self.shape = self.meta['shape']//self.factor
+		self.nChannels = self.meta['nChannels']
+		self.image_shape = self.meta['image_shape']
+		self.label_keys = self.meta['label_keys']
+		self.nShards = self.meta['nShards']
+
+		self.index = np.load(os.path.join(dir_store, 'index.npy'))
+		self.labels = np.load(os.path.join(dir_store, 'labels.npy'))
+		self.shard_ids = self.index[:,0]
+		self.image_bytes = self.image_shape*self.image_shape*3
+		self.occupancy_bytes = self.meta['shape']**3//8
+
+		# shard files are opened lazily, per process, so the store can be handed to DataLoader workers
+		self.pid = None
+		self.files = {}
+
+	def __len__(self):
+		return self.index.shape[0]
+
+	def shard_file(self, shard):
+		if self.pid != os.getpid():
+			self.pid = os.getpid()
+			self.files = {}
+		if shard not in self.files:
+			self.files[shard] = open(shard_name(self.dir_store, shard), 'rb')
+		return self.files[shard]
+
+	def parse(self, buf, nColors):
+		image = np.frombuffer(buf, dtype=np.uint8, count=self.image_bytes).reshape(self.image_shape, self.image_shape, 3)
+		occupancy = np.frombuffer(buf, dtype=np.uint8, count=self.occupancy_bytes, offset=self.image_bytes)
+		colors = np.frombuffer(buf, dtype=np.uint8, offset=self.image_bytes+self.occupancy_bytes)
+		colors = colors.reshape(nColors, self.nChannels-1)
+		cells = np.flatnonzero(np.unpackbits(occupancy))
+		if self.factor > 1:
+			cells, colors = pool_sparse(cells, colors, self.meta['shape'], self.factor)
+		return image, cells, colors
+
+	def get(self, idx):
+		"""
+		image, flat indices of occupied cells and their uint8 colors of record idx
+		"""
+		shard, offset, nColors = self.index[idx]
+		f = self.shard_file(shard)
+		f.seek(offset)
+		return self.parse(f.read(self.image_bytes+self.occupancy_bytes+nColors*(self.nChannels-1)), nColors)
+
+	def get_labels(self, idx):
+		return dict(zip(self.label_keys, self.labels[idx]))
+
+	def get_voxel(self, cells, colors, dtype=np.float64):
+		return dense_voxel(cells, colors, self.nChannels, self.shape, dtype)
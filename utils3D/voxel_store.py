@@ -0,0 +1,163 @@
+#
+# preprocessed voxel store : bit-packed occupancy and uint8 colors of occupied cells.
+#
+# layout of a store directory
+#	occupancy.npy		(N, shape^3/8) uint8, np.packbits of the occupancy grid
+#	colors.bin			(M, nChannels-1) uint8, colors of occupied cells in np.flatnonzero order
+#	color_offsets.npy	(N+1,) int64, sample i owns colors[offsets[i]:offsets[i+1]]
+#	labels.npy			(N, len(label_keys)) int64
+#	meta.pkl			shape, nChannels, label_keys and any extra metadata of the writer
+#	mip_<shape>/		optional store of the same samples pooled to a coarser shape (write_mip_level)
+#
+# a store is written once at the finest resolution, coarser shapes are served from a mip level when present
+# and pooled on the fly otherwise.
+#
+
+import os, pickle
+import numpy as np
+
+def dense_voxel(indices, colors, nChannels, shape, dtype=np.float64):
+	"""
+	dense voxel as produced by bnt2voxel/bnt2voxel_wColor from flat indices of occupied cells and their uint8 colors
+	colors are scaled back to [0,1] for float dtypes and kept in 0-255 for integer dtypes
+	"""
+	voxel = np.zeros((nChannels,)+(shape,)*3, dtype=dtype)
+	flat = voxel.reshape(nChannels, -1)
+	flat[0,indices] = 1
+	if nChannels == 1:
+		return voxel
+	if np.issubdtype(np.dtype(dtype), np.integer):
+		flat[1:,indices] = colors.T
+	else:
+		flat[1:,indices] = colors.T/255.
+	return voxel
+
+def pool_sparse(indices, colors, shape, factor):
+	"""
+	occupied cells of a shape^3 grid pooled into blocks of factor^3 cells : a block is occupied when any of its
+	cells is and its uint8 colors are the mean of those cells
+	"""
+	coarse = shape//factor
+	x, y, z = indices//(shape*shape), indices//shape % shape, indices % shape
+	pooled = ((x//factor)*coarse + y//factor)*coarse + z//factor
+	cells, inverse, counts = np.unique(pooled, return_inverse=True, return_counts=True)
+	if colors.shape[1] == 0:
+		return cells, colors[:len(cells)]
+	sums = np.stack([np.bincount(inverse, weights=colors[:,c], minlength=len(cells)) for c in range(colors.shape[1])], 1)
+	return cells, np.rint(sums/counts[:,None]).astype(np.uint8)
+
+class VoxelStoreWriter(object):
+	def __init__(self, dir_store, nSamples, shape, nChannels=4, label_keys=[], meta={}):
+		if not os.path.exists(dir_store):
+			os.makedirs(dir_store)
+		self.dir_store = dir_store
+		self.nSamples = nSamples
+		self.shape = shape
+		self.nChannels = nChannels
+		self.label_keys = list(label_keys)
+		self.meta = dict(meta)
+
+		self.occupancy = np.lib.format.open_memmap(os.path.join(dir_store, 'occupancy.npy'), mode='w+',
+									dtype=np.uint8, shape=(nSamples, shape**3//8))
+		self.offsets = np.zeros(nSamples+1, dtype=np.int64)
+		self.labels = np.zeros((nSamples, len(self.label_keys)), dtype=np.int64)
+		self.f_colors = open(os.path.join(dir_store, 'colors.bin'), 'wb')
+		self.count = 0
+
+	def append(self, voxel, labels=[]):
+		"""
+		voxel is a (nChannels,shape,shape,shape) array with occupancy in channel 0 and colors in [0,1]
+		"""
+		occupied = voxel[0].reshape(-1) > 0.5
+		colors = voxel[1:].reshape(self.nChannels-1, -1)[:, occupied].T
+		self.append_sparse(np.flatnonzero(occupied), np.clip(np.rint(colors*255), 0, 255).astype(np.uint8), labels)
+
+	def append_sparse(self, indices, colors, labels=[]):
+		"""
+		sorted flat indices of occupied cells and their (len(indices),nChannels-1) uint8 colors
+		"""
+		i = self.count
+		occupied = np.zeros(self.shape**3, dtype=np.bool_)
+		occupied[indices] = True
+		self.occupancy[i] = np.packbits(occupied)
+		colors = np.ascontiguousarray(colors, dtype=np.uint8)
+		self.f_colors.write(colors.tobytes())
+		self.offsets[i+1] = self.offsets[i] + colors.shape[0]
+		self.labels[i] = labels
+		self.count += 1
+
+	def close(self):
+		assert self.count == self.nSamples, 'store expects {} samples, got {}'.format(self.nSamples, self.count)
+		self.occupancy.flush()
+		del self.occupancy
+		self.f_colors.close()
+		np.save(os.path.join(self.dir_store, 'color_offsets.npy'), self.offsets)
+		np.save(os.path.join(self.dir_store, 'labels.npy'), self.labels)
+		meta = dict(self.meta)
+		meta.update({'shape': self.shape, 'nChannels': self.nChannels, 'label_keys': self.label_keys})
+		with open(os.path.join(self.dir_store, 'meta.pkl'), 'wb') as f:
+			pickle.dump(meta, f)
+
+def mip_name(dir_store, shape):
+	return os.path.join(dir_store, 'mip_{}'.format(shape))
+
+class VoxelStore(object):
+	def __init__(self, dir_store, shape=None):
+		with open(os.path.join(dir_store, 'meta.pkl'), 'rb') as f:
+			self.meta = pickle.load(f)
+		self.factor = 1
+		if shape is not None and shape != self.meta['shape']:
+			if os.path.exists(mip_name(dir_store, shape)):
+				dir_store = mip_name(dir_store, shape)
+				with open(os.path.join(dir_store, 'meta.pkl'), 'rb') as f:
+					self.meta = pickle.load(f)
+			else:
+				assert self.meta['shape'] % shape == 0, '{} holds shape={}, which does not pool to {}'.format(dir_store, self.meta['shape'], shape)
+				self.factor = self.meta['shape']//shape
+		self.shape = self.meta['shape']//self.factor
+		self.nChannels = self.meta['nChannels']
+		self.label_keys = self.meta['label_keys']
+
+		self.occupancy = np.load(os.path.join(dir_store, 'occupancy.npy'), mmap_mode='r')
+		self.offsets = np.load(os.path.join(dir_store, 'color_offsets.npy'))
+		self.labels = np.load(os.path.join(dir_store, 'labels.npy'))
+		if self.nChannels > 1 and self.offsets[-1] > 0:
+			self.colors = np.memmap(os.path.join(dir_store, 'colors.bin'), dtype=np.uint8, mode='r',
+									shape=(self.offsets[-1], self.nChannels-1))
+		else:
+			self.colors = np.zeros((0, max(self.nChannels-1,0)), dtype=np.uint8)
+
+	def __len__(self):
+		return self.occupancy.shape[0]
+
+	def get_sparse(self, idx):
+		"""
+		flat indices of occupied cells and their uint8 colors
+		"""
+		indices = np.flatnonzero(np.unpackbits(self.occupancy[idx]))
+		colors = self.colors[self.offsets[idx]:self.offsets[idx+1]]
+		if self.factor > 1:
+			return pool_sparse(indices, colors, self.shape*self.factor, self.factor)
+		return indices, colors
+
+	def get(self, idx, dtype=np.float64, nChannels=None):
+		"""
+		dense voxel as produced by bnt2voxel/bnt2voxel_wColor, nChannels=1 drops the colors
+		"""
+		indices, colors = self.get_sparse(idx)
+		return dense_voxel(indices, colors, nChannels or self.nChannels, self.shape, dtype)
+
+	def get_labels(self, idx):
+		return dict(zip(self.label_keys, self.labels[idx]))
+
+def write_mip_level(dir_store, shape):
+	"""
+	store the samples of dir_store pooled to shape under mip_<shape>, served by VoxelStore(dir_store, shape)
+	"""
+	store = VoxelStore(dir_store, shape)
+	meta = dict((key, value) for key, value in store.meta.items() if key not in ['shape', 'nChannels', 'label_keys'])
+	writer = VoxelStoreWriter(mip_name(dir_store, shape), len(store), shape, store.nChannels, store.label_keys, meta)
+	for idx in range(len(store)):
+		indices, colors = store.get_sparse(idx)
+		writer.append_sparse(indices, colors, store.labels[idx])
+	writer.close()